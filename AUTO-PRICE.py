@@ -1,46 +1,606 @@
-import pandas as pd
-from docxtpl import DocxTemplate
 import os
-from pypdf import PdfWriter
+import sys
+import argparse
+import contextlib
+import functools
+import importlib.util
 import subprocess
-import tkinter as tk
-from tkinter import ttk, filedialog, messagebox, font
 import json
 import time
 import threading
 import warnings
-from docx import Document
-from docx.shared import Inches, Pt
-from docx.enum.text import WD_ALIGN_PARAGRAPH
 import platform
 import shutil
+import queue
+import socket
+import tempfile
+import atexit
+import weakref
+import copy
+import io
+import hashlib
+import asyncio
+import heapq
+import bisect
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # Tắt warnings không cần thiết
 warnings.filterwarnings("ignore", category=UserWarning, module="docxcompose")
 warnings.filterwarnings("ignore", category=UserWarning, module="openpyxl")
 
+class _LazyModule:
+    """Module chỉ được import ở lần truy cập đầu tiên (khởi động nhanh, nhất là chế độ dòng lệnh)"""
+    
+    def __init__(self, loader):
+        self._loader = loader
+        self._module = None
+    
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = self._loader()
+        return getattr(self._module, attr)
+
+def _import_pandas():
+    # Lệnh import viết tường minh để PyInstaller vẫn đóng gói pandas
+    import pandas
+    return pandas
+
+pd = _LazyModule(_import_pandas)
+
+def _load_tkinter():
+    """Nạp tkinter khi mở GUI (chế độ dòng lệnh chạy được trên máy không có màn hình)"""
+    global tk, ttk, filedialog, messagebox
+    import tkinter as tk
+    from tkinter import ttk, filedialog, messagebox
+
+def find_libreoffice_path(config):
+    """Tìm soffice (bản cài đặt, biến môi trường LIBREOFFICE_PATH hoặc bản Portable)"""
+    configured_path = config.get('libreoffice_path', r"C:\\Program Files\\LibreOffice\\program\\soffice.exe")
+    env_path = os.environ.get('LIBREOFFICE_PATH')
+    candidate_paths = [
+        configured_path,
+        env_path if env_path else '',
+        os.path.join(os.getcwd(), 'LibreOfficePortable', 'App', 'libreoffice', 'program', 'soffice.exe'),
+        os.path.join(os.getcwd(), 'LibreOfficePortable', 'App', 'libreoffice', 'program', 'soffice.com'),
+        os.path.join(os.getcwd(), 'libreoffice', 'program', 'soffice.exe'),
+        os.path.join(os.getcwd(), 'libreoffice', 'program', 'soffice.com'),
+        os.path.join(os.getcwd(), 'bin', 'LibreOffice', 'program', 'soffice.exe'),
+        os.path.join(os.getcwd(), 'bin', 'LibreOffice', 'program', 'soffice.com'),
+    ]
+    return next((p for p in candidate_paths if p and os.path.exists(p)), None)
+
+def _find_free_port():
+    """Lấy một cổng TCP trống trên localhost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class LibreOfficeServer:
+    """Một tiến trình soffice headless chạy nền, nhận lệnh chuyển đổi qua UNO socket"""
+
+    def __init__(self, soffice_path, timeout=60, startup_timeout=60):
+        self.soffice_path = soffice_path
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+        self.process = None
+        self.desktop = None
+        self.port = None
+        # Mỗi instance cần user profile riêng, nếu không các soffice sẽ khóa lẫn nhau
+        self.profile_dir = tempfile.mkdtemp(prefix="autoprice_lo_")
+
+    def start(self):
+        """Khởi động soffice và kết nối UNO (chờ tới khi listener sẵn sàng)"""
+        import uno
+
+        self.port = _find_free_port()
+        profile_url = uno.systemPathToFileUrl(self.profile_dir)
+        self.process = subprocess.Popen([
+            self.soffice_path,
+            f"-env:UserInstallation={profile_url}",
+            "--headless", "--invisible", "--nologo", "--norestore",
+            "--nodefault", "--nolockcheck",
+            f"--accept=socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext"
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context)
+        deadline = time.time() + self.startup_timeout
+        while True:
+            try:
+                context = resolver.resolve(
+                    f"uno:socket,host=127.0.0.1,port={self.port};urp;StarOffice.ComponentContext")
+                self.desktop = context.ServiceManager.createInstanceWithContext(
+                    "com.sun.star.frame.Desktop", context)
+                print(f"✅ LibreOffice server sẵn sàng (cổng {self.port})")
+                return
+            except Exception:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise Exception("Không khởi động được LibreOffice server")
+                time.sleep(0.5)
+
+    def is_alive(self):
+        return self.process is not None and self.process.poll() is None and self.desktop is not None
+
+    def _convert(self, word_file, pdf_file):
+        import uno
+        from com.sun.star.beans import PropertyValue
+
+        def prop(name, value):
+            p = PropertyValue()
+            p.Name = name
+            p.Value = value
+            return p
+
+        doc = self.desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(word_file)), "_blank", 0, (prop("Hidden", True),))
+        if doc is None:
+            raise Exception(f"LibreOffice không mở được {word_file}")
+        try:
+            doc.storeToURL(uno.systemPathToFileUrl(os.path.abspath(pdf_file)),
+                           (prop("FilterName", "writer_pdf_Export"),))
+        finally:
+            doc.close(True)
+
+    def convert(self, word_file, pdf_file):
+        """Chuyển đổi một file; nếu instance treo quá timeout thì bị kill và báo lỗi"""
+        result = {}
+
+        def target():
+            try:
+                self._convert(word_file, pdf_file)
+            except Exception as e:
+                result['error'] = e
+
+        worker = threading.Thread(target=target, daemon=True)
+        worker.start()
+        worker.join(self.timeout)
+        if worker.is_alive():
+            # Kill tiến trình để lời gọi UNO đang treo được giải phóng
+            self.stop(force=True)
+            raise TimeoutError(f"LibreOffice server bị treo khi chuyển đổi {os.path.basename(word_file)}")
+        if 'error' in result:
+            raise result['error']
+
+    def stop(self, force=False):
+        """Dừng tiến trình soffice (force=True: kill ngay, dùng khi instance bị treo)"""
+        if force and self.process is not None:
+            self.process.kill()
+        if self.desktop is not None:
+            try:
+                self.desktop.terminate()
+            except Exception:
+                pass
+            self.desktop = None
+        if self.process is not None:
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            self.process = None
+
+    def restart(self):
+        print("🔄 Khởi động lại LibreOffice server...")
+        self.stop()
+        self.start()
+
+    def close(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+# Các pool server LibreOffice còn sống, được tắt một lần khi thoát chương trình
+_LO_SERVER_POOLS = weakref.WeakSet()
+
+@atexit.register
+def _shutdown_libreoffice_server_pools():
+    for pool in list(_LO_SERVER_POOLS):
+        pool.shutdown()
+
+class LibreOfficeServerPool:
+    """Nhóm các instance LibreOffice chạy nền, giữ ấm trong suốt job"""
+
+    _CLOSED = object()  # Đặt vào hàng đợi idle khi shutdown để đánh thức các thread đang chờ
+
+    def __init__(self, soffice_path, instances=1, timeout=60):
+        self.soffice_path = soffice_path
+        self.instances = max(1, int(instances))
+        self.timeout = timeout
+        self.servers = []
+        self.idle = queue.Queue()
+        self.lock = threading.Lock()
+        self.closed = False
+        _LO_SERVER_POOLS.add(self)
+
+    def _acquire(self):
+        # Khởi động instance mới theo nhu cầu, tối đa self.instances
+        with self.lock:
+            if self.closed:
+                raise Exception("LibreOffice server pool đã dừng")
+            server = None
+            if self.idle.empty() and len(self.servers) < self.instances:
+                # Giữ chỗ trong lock, khởi động ngoài lock (có thể mất tới startup_timeout giây)
+                server = LibreOfficeServer(self.soffice_path, timeout=self.timeout)
+                self.servers.append(server)
+        if server is None:
+            server = self.idle.get()
+            if server is self._CLOSED:
+                self.idle.put(server)  # Đánh thức thread chờ kế tiếp
+                raise Exception("LibreOffice server pool đã dừng")
+            return server
+        try:
+            server.start()
+        except Exception:
+            with self.lock:
+                if server in self.servers:
+                    self.servers.remove(server)
+            server.close()
+            raise
+        return server
+
+    def _release(self, server):
+        """Trả instance về hàng đợi; pool đã dừng thì tắt luôn (có thể đã được restart sau shutdown)"""
+        with self.lock:
+            if not self.closed:
+                self.idle.put(server)
+                return
+        server.close()
+
+    def convert(self, word_file):
+        """Chuyển đổi Word sang PDF bằng một instance đang chạy, thử lại một lần sau khi restart"""
+        pdf_file = os.path.splitext(word_file)[0] + ".pdf"
+        server = self._acquire()
+        try:
+            for attempt in range(2):
+                try:
+                    if not server.is_alive():
+                        server.restart()
+                    server.convert(word_file, pdf_file)
+                    if os.path.exists(pdf_file):
+                        return pdf_file
+                    raise Exception(f"Không tạo được file PDF: {pdf_file}")
+                except Exception as e:
+                    print(f"❌ Lỗi LibreOffice server (lần {attempt + 1}): {e}")
+                    server.stop()
+            return None
+        finally:
+            self._release(server)
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            servers, self.servers = self.servers, []
+            # Dọn hàng đợi tại chỗ (thread đang chờ vẫn giữ đúng hàng đợi này) rồi đánh thức chúng
+            while True:
+                try:
+                    self.idle.get_nowait()
+                except queue.Empty:
+                    break
+            self.idle.put(self._CLOSED)
+        for server in servers:
+            server.close()
+
+class LibreOfficeProfilePool:
+    """Chạy song song nhiều lệnh soffice --convert-to, mỗi slot một user profile riêng.
+    
+    Hai soffice dùng chung profile mặc định sẽ khóa lẫn nhau, nên mỗi slot có thư mục profile
+    cố định (profile_folder/slot_N). Profile được khởi tạo một lần (lần chạy đầu của soffice
+    với profile mới rất chậm) rồi dùng lại cho mọi job sau, kể cả ở các lần mở ứng dụng sau.
+    
+    Các lệnh soffice được điều phối bằng asyncio (create_subprocess_exec) trên thread gọi:
+    số lệnh đồng thời bị giới hạn bởi số slot đang giữ, stdout/stderr được chuyển vào log,
+    lệnh quá hạn (từng file hoặc cả job) hoặc bị hủy thì bị kill.
+    """
+    
+    def __init__(self, soffice_path, slots, profile_folder, timeout=60):
+        self.soffice_path = soffice_path
+        self.slots = max(1, int(slots))
+        self.profile_folder = profile_folder
+        self.timeout = timeout
+        self.idle = queue.Queue()
+        for slot in range(self.slots):
+            self.idle.put(slot)
+        self.warmed = set()
+        self.lock = threading.Lock()
+    
+    def _profile_dir(self, slot):
+        return os.path.join(self.profile_folder, f"slot_{slot}")
+    
+    def _command(self, slot, *args):
+        import pathlib
+        profile_url = pathlib.Path(os.path.abspath(self._profile_dir(slot))).as_uri()
+        return [self.soffice_path, f"-env:UserInstallation={profile_url}",
+                "--headless", "--invisible", "--nologo", "--norestore", "--nodefault", *args]
+    
+    def convert(self, word_files, deadline=None, log=print):
+        """Chuyển đổi các file (chia cho các slot rảnh, chạy song song); trả về danh sách PDF
+        (None nếu lỗi) theo đúng thứ tự. deadline: time.monotonic() hết hạn của cả job."""
+        if not word_files:
+            return []
+        # Chờ ít nhất một slot, lấy thêm các slot đang rảnh (tối đa một slot mỗi file)
+        slots = [self.idle.get()]
+        while len(slots) < min(self.slots, len(word_files)):
+            try:
+                slots.append(self.idle.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            return asyncio.run(self._convert_async(word_files, slots, deadline, log))
+        finally:
+            for slot in slots:
+                self.idle.put(slot)
+    
+    async def _convert_async(self, word_files, slots, deadline, log):
+        free = asyncio.Queue()  # Slot rảnh = giới hạn số lệnh soffice chạy cùng lúc
+        for slot in slots:
+            free.put_nowait(slot)
+        size = -(-len(word_files) // len(slots))
+        chunks = [word_files[i:i + size] for i in range(0, len(word_files), size)]
+        results = {}
+        
+        async def run_chunk(chunk):
+            slot = await free.get()
+            try:
+                await self._warm_up(slot, deadline, log)
+                # Mỗi lệnh soffice ghi vào một thư mục xuất riêng, tên file trùng thì tách lệnh
+                for group in self._unique_name_groups(chunk):
+                    results.update(zip(group, await self._convert_group(slot, group, deadline, log)))
+            finally:
+                free.put_nowait(slot)
+        
+        tasks = [asyncio.ensure_future(run_chunk(chunk)) for chunk in chunks]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Lỗi hoặc bị hủy: dừng các lệnh còn lại (finally của _run sẽ kill soffice)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return [results.get(word_file) for word_file in word_files]
+    
+    async def _run(self, command, timeout, deadline, label, log):
+        """Chạy một lệnh, chuyển stdout/stderr vào log; trả về mã thoát, None nếu quá hạn"""
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                log(f"⏰ Hết thời gian cho phép của job, bỏ qua {label}")
+                return None
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        
+        async def pump(stream):
+            async for line in stream:
+                text = line.decode(errors='replace').strip()
+                if text:
+                    log(f"soffice: {text}")
+        
+        try:
+            await asyncio.wait_for(asyncio.gather(pump(process.stdout), pump(process.stderr), process.wait()),
+                                   timeout)
+            return process.returncode
+        except asyncio.TimeoutError:
+            log(f"Timeout LibreOffice ({label})")
+            return None
+        finally:
+            if process.returncode is None:
+                try:
+                    process.kill()
+                except ProcessLookupError:
+                    pass
+                await process.wait()
+    
+    async def _warm_up(self, slot, deadline, log):
+        """Tạo sẵn profile cho slot (chỉ lần đầu), để lần chuyển đổi đầu tiên không bị tính cả thời gian này"""
+        with self.lock:
+            if slot in self.warmed:
+                return
+        profile_dir = self._profile_dir(slot)
+        if not os.path.exists(os.path.join(profile_dir, "user", "registrymodifications.xcu")):
+            os.makedirs(profile_dir, exist_ok=True)
+            log(f"🔄 Khởi tạo profile LibreOffice cho slot {slot}...")
+            await self._run(self._command(slot, "--terminate_after_init"), max(60, self.timeout), deadline,
+                            f"khởi tạo profile slot {slot}", log)
+        with self.lock:
+            self.warmed.add(slot)
+    
+    @staticmethod
+    def _unique_name_groups(word_files):
+        groups = []
+        for word_file in word_files:
+            stem = os.path.splitext(os.path.basename(word_file))[0].lower()
+            for group, stems in groups:
+                if stem not in stems:
+                    group.append(word_file)
+                    stems.add(stem)
+                    break
+            else:
+                groups.append(([word_file], {stem}))
+        return [group for group, _ in groups]
+    
+    async def _convert_group(self, slot, word_files, deadline, log):
+        out_dir = tempfile.mkdtemp(prefix="lo_out_", dir=os.path.dirname(os.path.abspath(word_files[0])))
+        try:
+            label = (os.path.basename(word_files[0]) if len(word_files) == 1
+                     else f"{len(word_files)} file từ {os.path.basename(word_files[0])}")
+            returncode = await self._run(
+                self._command(slot, "--convert-to", "pdf", "--outdir", out_dir,
+                              *[os.path.abspath(f) for f in word_files]),
+                self.timeout * len(word_files), deadline, label, log)
+            if returncode:
+                log(f"Lỗi LibreOffice (mã {returncode}): {label}")
+            
+            # soffice luôn ghi <tên file>.pdf vào --outdir: không cần đoán vị trí đầu ra
+            results = []
+            for word_file in word_files:
+                produced = os.path.join(out_dir, os.path.splitext(os.path.basename(word_file))[0] + ".pdf")
+                if os.path.exists(produced):
+                    pdf_file = os.path.splitext(word_file)[0] + ".pdf"
+                    os.replace(produced, pdf_file)
+                    results.append(pdf_file)
+                else:
+                    results.append(None)
+            return results
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+# Pool profile LibreOffice dùng chung giữa các job (theo đường dẫn soffice + thư mục profile)
+_LO_PROFILE_POOLS = {}
+_LO_PROFILE_POOLS_LOCK = threading.Lock()
+
+def get_libreoffice_profile_pool(soffice_path, slots, profile_folder, timeout=60):
+    key = (os.path.abspath(soffice_path), os.path.abspath(profile_folder), int(slots))
+    with _LO_PROFILE_POOLS_LOCK:
+        pool = _LO_PROFILE_POOLS.get(key)
+        if pool is None:
+            pool = _LO_PROFILE_POOLS[key] = LibreOfficeProfilePool(soffice_path, slots, profile_folder, timeout)
+        pool.timeout = timeout
+        return pool
+
+# Kết quả dò công cụ theo (đường dẫn LibreOffice cấu hình, LIBREOFFICE_PATH, thư mục chạy)
+_TOOL_PROBE_CACHE = {}
+_TOOL_PROBE_LOCK = threading.Lock()
+
+class ToolHealth:
+    """Theo dõi tỉ lệ thành công / thời gian của từng công cụ chuyển đổi, kèm cầu dao (circuit breaker).
+    
+    Sau failure_threshold lần lỗi liên tiếp, công cụ bị ngắt: mọi file tiếp theo đi thẳng sang
+    công cụ khác. Hết cooldown giây thì cho đúng một file thử lại; thành công thì đóng cầu dao.
+    """
+    
+    def __init__(self, failure_threshold=3, cooldown=60):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown = max(0.0, float(cooldown))
+        self.tools = {}
+        self.lock = threading.Lock()
+    
+    def _state(self, tool):
+        state = self.tools.get(tool)
+        if state is None:
+            state = self.tools[tool] = {"successes": 0, "failures": 0, "consecutive_failures": 0,
+                                        "latency": None, "opened_at": None, "trial": False}
+        return state
+    
+    def allow(self, tool):
+        """Có nên gửi file cho tool không (cầu dao đóng, hoặc đã hết cooldown và chưa có file thử)"""
+        with self.lock:
+            state = self._state(tool)
+            if state["opened_at"] is None:
+                return True
+            if state["trial"] or time.time() - state["opened_at"] < self.cooldown:
+                return False
+            state["trial"] = True  # Cho một file thử lại
+            return True
+    
+    def record(self, tool, ok, seconds):
+        """Ghi nhận kết quả một lần gọi; trả về 'tripped' / 'recovered' khi cầu dao đổi trạng thái"""
+        with self.lock:
+            state = self._state(tool)
+            state["trial"] = False
+            if ok:
+                state["successes"] += 1
+                state["consecutive_failures"] = 0
+                # Trung bình trượt của thời gian mỗi lần gọi thành công
+                state["latency"] = seconds if state["latency"] is None else 0.8 * state["latency"] + 0.2 * seconds
+                if state["opened_at"] is not None:
+                    state["opened_at"] = None
+                    return "recovered"
+                return None
+            state["failures"] += 1
+            state["consecutive_failures"] += 1
+            if state["opened_at"] is not None:
+                state["opened_at"] = time.time()  # Thử lại vẫn lỗi: ngắt thêm một cooldown
+            elif state["consecutive_failures"] >= self.failure_threshold:
+                state["opened_at"] = time.time()
+                return "tripped"
+            return None
+    
+    def latency(self, tool):
+        with self.lock:
+            return self._state(tool)["latency"]
+    
+    def snapshot(self):
+        """Trạng thái từng công cụ (hiển thị / ghi log)"""
+        with self.lock:
+            return {
+                tool: {"successes": state["successes"], "failures": state["failures"],
+                       "open": state["opened_at"] is not None,
+                       "latency_ms": None if state["latency"] is None else round(state["latency"] * 1000, 1)}
+                for tool, state in self.tools.items()
+            }
+
 class PDFConverter:
     """Lớp chuyển đổi PDF với nhiều công cụ khác nhau"""
     
     def __init__(self, config):
         self.config = config
-        self.available_tools = self.detect_available_tools()
-        self.current_tool = self.select_best_tool()
+        self._lo_server_pool = None
+        # Dò công cụ khi cần lần đầu (không làm chậm lúc mở cửa sổ)
+        self._available_tools = None
+        self._current_tool = None
+        self.metrics = None  # RunMetrics của job đang chạy (tùy chọn)
+        self.log = print  # Nhận stdout/stderr của soffice
+        self.deadline = None  # time.monotonic() hết hạn của job đang chạy (conversion_job_timeout)
+        self.health = ToolHealth(config.get('breaker_failures', 3), config.get('breaker_cooldown', 60))
+        self._producers = {}  # file PDF -> công cụ đã tạo ra nó (có thể khác current_tool khi fallback)
+    
+    @property
+    def available_tools(self):
+        if self._available_tools is None:
+            self._available_tools = self.probe_tools(self.config)
+        return self._available_tools
+    
+    @property
+    def current_tool(self):
+        if self._current_tool is None:
+            self._current_tool = self.select_best_tool()
+        return self._current_tool
+    
+    @current_tool.setter
+    def current_tool(self, tool):
+        self._current_tool = tool
+    
+    def update_tools(self, config):
+        """Áp dụng cấu hình / kết quả dò công cụ mới cho converter này.
+        
+        Giữ nguyên tình trạng công cụ (ToolHealth) và LibreOffice server đang chạy; server chỉ
+        bị dừng khi đường dẫn LibreOffice thay đổi. Công cụ đang chọn được giữ nếu vẫn khả dụng.
+        """
+        tools = self.probe_tools(config)
+        old_path = (self._available_tools or {}).get('libreoffice_server', {}).get('path')
+        if old_path != tools.get('libreoffice_server', {}).get('path'):
+            self.close()
+        self.config = config
+        self._available_tools = tools
+        if not tools.get(self._current_tool, {}).get('available'):
+            self._current_tool = None
+    
+    @staticmethod
+    def probe_tools(config, force=False):
+        """Dò công cụ một lần cho mỗi cấu hình đường dẫn; force=True để dò lại"""
+        key = (config.get('libreoffice_path', ''), os.environ.get('LIBREOFFICE_PATH', ''), os.getcwd())
+        # Giữ lock trong lúc dò: lời gọi đồng thời chờ kết quả thay vì dò lần nữa
+        with _TOOL_PROBE_LOCK:
+            if force or key not in _TOOL_PROBE_CACHE:
+                _TOOL_PROBE_CACHE[key] = PDFConverter.detect_available_tools(config)
+            return copy.deepcopy(_TOOL_PROBE_CACHE[key])
     
-    def detect_available_tools(self):
+    @staticmethod
+    def detect_available_tools(config):
         """Phát hiện các công cụ chuyển đổi PDF có sẵn"""
         tools = {}
         
         # 1. Kiểm tra python-docx2pdf (CÔNG CỤ TỐT NHẤT)
-        try:
-            import docx2pdf
+        # Chỉ tìm module, không import (import docx2pdf nạp cả COM/AppleScript của Word)
+        if importlib.util.find_spec('docx2pdf') is not None:
             tools['docx2pdf'] = {
                 'name': 'python-docx2pdf',
                 'priority': 1,
                 'available': True,
                 'description': '🚀 THỦ VIỆN PYTHON THUẦN TÚY - NHANH VÀ NHẸ NHẤT (Khuyến nghị)'
             }
-        except ImportError:
+        else:
             tools['docx2pdf'] = {
                 'name': 'python-docx2pdf',
                 'priority': 1,
@@ -48,32 +608,38 @@ class PDFConverter:
                 'description': 'Cần cài đặt: pip install docx2pdf (Khuyến nghị)'
             }
         
-        # 2. Kiểm tra LibreOffice (hỗ trợ cả bản cài đặt và Portable)
-        configured_path = self.config.get('libreoffice_path', r"C:\\Program Files\\LibreOffice\\program\\soffice.exe")
-        env_path = os.environ.get('LIBREOFFICE_PATH')
-        candidate_paths = [
-            configured_path,
-            env_path if env_path else '',
-            os.path.join(os.getcwd(), 'LibreOfficePortable', 'App', 'libreoffice', 'program', 'soffice.exe'),
-            os.path.join(os.getcwd(), 'LibreOfficePortable', 'App', 'libreoffice', 'program', 'soffice.com'),
-            os.path.join(os.getcwd(), 'libreoffice', 'program', 'soffice.exe'),
-            os.path.join(os.getcwd(), 'libreoffice', 'program', 'soffice.com'),
-            os.path.join(os.getcwd(), 'bin', 'LibreOffice', 'program', 'soffice.exe'),
-            os.path.join(os.getcwd(), 'bin', 'LibreOffice', 'program', 'soffice.com'),
-        ]
-        detected_lo_path = next((p for p in candidate_paths if p and os.path.exists(p)), None)
+        # 2. Kiểm tra LibreOffice server chạy nền qua UNO (cần module 'uno' của LibreOffice)
+        detected_lo_path = find_libreoffice_path(config)
+        uno_available = importlib.util.find_spec('uno') is not None
+        if detected_lo_path and uno_available:
+            tools['libreoffice_server'] = {
+                'name': 'LibreOffice Server',
+                'priority': 2,
+                'available': True,
+                'description': 'LibreOffice chạy nền (UNO), khởi động một lần và giữ ấm suốt job - nhanh hơn nhiều so với gọi soffice từng file',
+                'path': detected_lo_path
+            }
+        else:
+            tools['libreoffice_server'] = {
+                'name': 'LibreOffice Server',
+                'priority': 2,
+                'available': False,
+                'description': 'Cần LibreOffice và module Python "uno" (python3-uno hoặc Python đi kèm LibreOffice).'
+            }
+
+        # 3. Kiểm tra LibreOffice (hỗ trợ cả bản cài đặt và Portable)
         if detected_lo_path:
             tools['libreoffice'] = {
                 'name': 'LibreOffice',
-                'priority': 2,
+                'priority': 3,
                 'available': True,
-                'description': 'LibreOffice/LibreOffice Portable (fallback, không cần cài đặt nếu dùng Portable)',
+                'description': 'LibreOffice/LibreOffice Portable (fallback, không cần cài đặt nếu dùng Portable); chạy song song nhiều soffice, mỗi soffice một profile riêng',
                 'path': detected_lo_path
             }
         else:
             tools['libreoffice'] = {
                 'name': 'LibreOffice',
-                'priority': 2,
+                'priority': 3,
                 'available': False,
                 'description': 'Không tìm thấy LibreOffice. Có thể dùng LibreOffice Portable (giải nén cạnh ứng dụng) hoặc chọn đường dẫn thủ công.'
             }
@@ -95,25 +661,94 @@ class PDFConverter:
         return best_tool
     
     def convert_to_pdf(self, word_file):
-        """Chuyển đổi Word sang PDF sử dụng công cụ được chọn"""
+        """Chuyển đổi Word sang PDF sử dụng công cụ được chọn; trả về đường dẫn file PDF hoặc None nếu lỗi"""
         try:
-            # Ưu tiên sử dụng python-docx2pdf (công cụ tốt nhất)
-            if self.current_tool == 'docx2pdf':
-                result = self._convert_with_docx2pdf(word_file)
+            tools = self._tool_order()
+        except Exception as e:
+            print(f"❌ Lỗi chọn công cụ chuyển đổi: {e}")
+            return None
+        tried = []
+        for tool in tools:
+            # Công cụ đang bị ngắt (lỗi liên tiếp) thì bỏ qua, không tốn một lần thử mỗi file
+            if not self.health.allow(tool):
+                continue
+            result = self._try_convert(tool, word_file, tried)
+            if result:
+                return result
+            tried.append(tool)
+        
+        if not tried:
+            # Mọi công cụ đều đang bị ngắt: vẫn thử lần lượt thay vì bỏ file
+            for tool in tools:
+                result = self._try_convert(tool, word_file, tried)
                 if result:
                     return result
-                else:
-                    print("⚠️ python-docx2pdf thất bại, thử fallback...")
-                    return self._fallback_convert(word_file)
-            elif self.current_tool == 'libreoffice':
-                return self._convert_with_libreoffice(word_file)
-            else:
-                raise Exception(f"Công cụ không được hỗ trợ: {self.current_tool}")
-                
+                tried.append(tool)
+        
+        print("❌ Tất cả công cụ chuyển đổi đều thất bại!" if len(tried) > 1 else
+              f"❌ Không chuyển đổi được: {os.path.basename(word_file)}")
+        return None
+    
+    def _tool_order(self):
+        """Thứ tự thử công cụ: công cụ đang chọn, rồi các công cụ khác (đã đo thì nhanh trước,
+        chưa đo thì theo độ ưu tiên)"""
+        tools = self.available_tools
+        current = self.current_tool
+        others = [tool for tool, info in tools.items() if info['available'] and tool != current]
+        others.sort(key=lambda tool: (self.health.latency(tool) is None, self.health.latency(tool) or 0,
+                                      tools[tool]['priority']))
+        if current in tools:
+            return [current] + others
+        print(f"❌ Công cụ không được hỗ trợ: {current}")
+        return others
+    
+    def _try_convert(self, tool, word_file, tried):
+        """Một lần thử với tool (tried: các công cụ đã thử trước đó cho file này)"""
+        if tried:
+            print(f"🔄 Thử fallback sang {tool}...")
+        try:
+            result = self._timed_convert(tool, word_file, fallback=tool != self.current_tool)
         except Exception as e:
-            print(f"❌ Lỗi với {self.current_tool}: {e}")
-            # Thử fallback sang công cụ khác
-            return self._fallback_convert(word_file)
+            print(f"❌ Lỗi với {tool}: {e}")
+            return None
+        if result and tried:
+            print(f"✅ Fallback thành công với {tool}")
+        elif not result:
+            print(f"⚠️ {tool} thất bại")
+        return result
+    
+    def _timed_convert(self, tool, word_file, fallback=False):
+        """_convert_with kèm ghi nhận thời gian, kết quả vào metrics và tình trạng công cụ"""
+        started = time.perf_counter()
+        result = None
+        try:
+            result = self._convert_with(tool, word_file)
+            if result:
+                self._producers[result] = tool
+            return result
+        finally:
+            elapsed = time.perf_counter() - started
+            self._record_health(tool, bool(result), elapsed)
+            if self.metrics is not None:
+                self.metrics.conversion(tool, elapsed, [result], fallback)
+    
+    def _record_health(self, tool, ok, seconds):
+        change = self.health.record(tool, ok, seconds)
+        if change == "tripped":
+            print(f"⛔ {tool} lỗi {self.health.failure_threshold} lần liên tiếp: tạm ngưng "
+                  f"{self.health.cooldown:.0f}s, chuyển các file tiếp theo sang công cụ khác")
+        elif change == "recovered":
+            print(f"✅ {tool} hoạt động lại")
+    
+    def _convert_with(self, tool, word_file):
+        """Gọi backend chuyển đổi tương ứng với tên công cụ"""
+        if tool == 'docx2pdf':
+            return self._convert_with_docx2pdf(word_file)
+        elif tool == 'libreoffice_server':
+            return self._convert_with_libreoffice_server(word_file)
+        elif tool == 'libreoffice':
+            return self._convert_with_libreoffice(word_file)
+        raise Exception(f"Công cụ không được hỗ trợ: {tool}")
     
     def _convert_with_docx2pdf(self, word_file):
         """Chuyển đổi sử dụng python-docx2pdf (CÔNG CỤ TỐT NHẤT)"""
@@ -141,63 +776,130 @@ class PDFConverter:
             return None
     
     def _convert_with_libreoffice(self, word_file):
-        """Chuyển đổi sử dụng LibreOffice (fallback)"""
+        """Chuyển đổi sử dụng LibreOffice (fallback), qua một slot profile riêng"""
         try:
-            libreoffice_path = self.available_tools['libreoffice']['path']
-            
-            result = subprocess.run([
-                libreoffice_path,
-                "--headless", "--convert-to", "pdf",
-                word_file, "--outdir", os.path.dirname(word_file)
-            ], check=True, capture_output=True, timeout=60)
-            
-            pdf_file = os.path.splitext(word_file)[0] + ".pdf"
-            
-            if os.path.exists(pdf_file):
-                return pdf_file
-            else:
-                # Thử tìm file trong thư mục con
-                subfolder = os.path.join(os.path.dirname(word_file), "In_PDF")
-                if os.path.exists(subfolder):
-                    subfolder_pdf = os.path.join(subfolder, os.path.basename(pdf_file))
-                    if os.path.exists(subfolder_pdf):
-                        return subfolder_pdf
-                
-                return None
-                
-        except subprocess.TimeoutExpired:
-            print(f"Timeout LibreOffice: {word_file}")
-            return None
+            return self._libreoffice_pool().convert([word_file], self.deadline, self.log)[0]
         except Exception as e:
             print(f"Lỗi LibreOffice: {e}")
             return None
     
-    def _fallback_convert(self, word_file):
-        """Fallback sang công cụ khác nếu công cụ chính lỗi"""
-        available_tools = [tool for tool, info in self.available_tools.items() 
-                          if info['available'] and tool != self.current_tool]
+    def _libreoffice_pool(self):
+        """Pool soffice song song (lo_parallel slot, mỗi slot một profile), dùng lại giữa các job"""
+        slots = int(self.config.get('lo_parallel', 0) or 0) or (os.cpu_count() or 1)
+        profile_folder = (self.config.get('lo_profile_folder')
+                          or os.path.join(tempfile.gettempdir(), "autoprice_lo_profiles"))
+        return get_libreoffice_profile_pool(self.available_tools['libreoffice']['path'], slots, profile_folder,
+                                            timeout=self.config.get('conversion_timeout', 60))
+    
+    def _convert_with_libreoffice_server(self, word_file):
+        """Chuyển đổi qua LibreOffice chạy nền (khởi động một lần cho cả job)"""
+        if self._lo_server_pool is None:
+            self._lo_server_pool = LibreOfficeServerPool(
+                self.available_tools['libreoffice_server']['path'],
+                instances=self.config.get('lo_server_instances', 1),
+                timeout=self.config.get('conversion_timeout', 60))
+        return self._lo_server_pool.convert(word_file)
+    
+    def close(self):
+        """Dừng các LibreOffice server đang chạy nền (gọi khi kết thúc job)"""
+        if self._lo_server_pool is not None:
+            self._lo_server_pool.shutdown()
+            self._lo_server_pool = None
+    
+    def convert_batch(self, word_files, timings=None):
+        """Chuyển đổi một nhóm file Word trong một lần gọi công cụ.
+
+        Trả về danh sách cùng thứ tự với word_files (None nếu file đó lỗi).
+        Các file lỗi trong batch được thử lại từng file một (kèm fallback).
+        timings: list tùy chọn, nhận thời gian (giây) của lần gọi cả batch, chưa tính thử lại từng file.
+        """
+        if not word_files:
+            return []
+        # Công cụ đầu tiên còn hoạt động (công cụ đang chọn bị ngắt thì cả batch đi thẳng sang công cụ khác)
+        tool = next((tool for tool in self._tool_order() if self.health.allow(tool)), self.current_tool)
+        started = time.perf_counter()
+        try:
+            if tool == 'libreoffice':
+                results = self._convert_batch_with_libreoffice(word_files)
+            elif tool == 'docx2pdf':
+                results = self._convert_batch_with_docx2pdf(word_files)
+            else:
+                # libreoffice_server đã giữ ấm sẵn, không cần gộp lệnh
+                results = [self._convert_with(tool, f) for f in word_files]
+        except Exception as e:
+            print(f"❌ Lỗi batch với {tool}: {e}")
+            results = [None] * len(word_files)
+        elapsed = time.perf_counter() - started
+        if timings is not None:
+            timings.append(elapsed)
+        # Cả batch lỗi mới tính là công cụ lỗi (một file hỏng không làm ngắt công cụ)
+        self._record_health(tool, any(results), elapsed / len(word_files))
+        if self.metrics is not None:
+            self.metrics.conversion(tool, elapsed, results, fallback=tool != self.current_tool)
+        for pdf_file in results:
+            if pdf_file:
+                self._producers[pdf_file] = tool
         
-        # Sắp xếp theo độ ưu tiên (docx2pdf trước)
-        available_tools.sort(key=lambda x: self.available_tools[x]['priority'])
+        failed = [i for i, pdf in enumerate(results) if not pdf]
+        if failed and len(failed) < len(word_files):
+            print(f"⚠️ {len(failed)}/{len(word_files)} file lỗi trong batch, thử lại từng file...")
+        for i in failed:
+            results[i] = self.convert_to_pdf(word_files[i])
+        return results
+    
+    def _convert_batch_with_libreoffice(self, word_files):
+        """Chia batch cho các lệnh soffice chạy song song, mỗi lệnh một profile riêng"""
+        return self._libreoffice_pool().convert(word_files, self.deadline, self.log)
+    
+    def _convert_batch_with_docx2pdf(self, word_files):
+        """docx2pdf chuyển đổi cả thư mục trong một phiên Word duy nhất"""
+        import docx2pdf
+        results = [None] * len(word_files)
+        batch_dir = tempfile.mkdtemp(prefix="batch_", dir=os.path.dirname(word_files[0]) or None)
+        moved = []
+        try:
+            for f in word_files:
+                target = os.path.join(batch_dir, os.path.basename(f))
+                shutil.move(f, target)
+                moved.append((f, target))
+            docx2pdf.convert(batch_dir, batch_dir)
+        except Exception as e:
+            print(f"❌ Lỗi docx2pdf (batch): {e}")
+        finally:
+            # Trả file Word và PDF về vị trí cũ
+            for i, (original, target) in enumerate(moved):
+                shutil.move(target, original)
+                batch_pdf = os.path.splitext(target)[0] + ".pdf"
+                if os.path.exists(batch_pdf):
+                    pdf_file = os.path.splitext(original)[0] + ".pdf"
+                    shutil.move(batch_pdf, pdf_file)
+                    results[i] = pdf_file
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        return results
+    
+    def producer_of(self, pdf_file):
+        """Công cụ đã tạo ra pdf_file (chỉ hỏi một lần cho mỗi file)"""
+        return self._producers.pop(pdf_file, None) or self.current_tool
+    
+    def tool_signature(self, tool=None):
+        """Tên + phiên bản công cụ (mặc định: công cụ hiện tại), dùng trong khóa cache trang.
         
-        for tool in available_tools:
+        Khi lưu cache phải dùng công cụ đã thật sự tạo ra file (producer_of), để trang do
+        công cụ fallback tạo không bị lấy ra dưới khóa của công cụ chính.
+        """
+        tool = tool or self.current_tool
+        path = self.available_tools.get(tool, {}).get('path')
+        if path:
             try:
-                print(f"🔄 Thử fallback sang {tool}...")
-                if tool == 'docx2pdf':
-                    result = self._convert_with_docx2pdf(word_file)
-                elif tool == 'libreoffice':
-                    result = self._convert_with_libreoffice(word_file)
-                
-                if result:
-                    print(f"✅ Fallback thành công với {tool}")
-                    return result
-                    
-            except Exception as e:
-                print(f"❌ Fallback {tool} thất bại: {e}")
-                continue
-        
-        print("❌ Tất cả công cụ fallback đều thất bại!")
-        return None
+                stat = os.stat(path)
+                return f"{tool}:{os.path.abspath(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+            except OSError:
+                pass
+        try:
+            from importlib.metadata import version
+            return f"{tool}:{version(tool)}"
+        except Exception:
+            return str(tool)
     
     def get_tool_info(self):
         """Lấy thông tin về công cụ hiện tại"""
@@ -207,58 +909,2640 @@ class PDFConverter:
         """Lấy thông tin về tất cả công cụ"""
         return self.available_tools
 
-class ConfigManager:
-    def __init__(self, config_file="config.json"):
-        self.config_file = config_file
-        self.default_config = {
-            "a4_excel_file": "A4-Auto.xlsx",
-            "a4_word_template": "A4-Auto.docx",
-            "a5_excel_file": "A5-AUTO.xlsx",
-            "a5_word_template": "A5-AUTO.docx",
-            "output_folder": "In_PDF",
-            "libreoffice_path": r"C:\\Program Files\\LibreOffice\\program\\soffice.exe",
-            "batch_size": 10,
-            "default_format": "A5",  # A4 hoặc A5
-            "preferred_tool": ""  # ''=auto; 'docx2pdf' hoặc 'libreoffice'
-        }
-        self.config = self.load_config()
+PRICE_FIELDS = ["NganhHang", "Hang", "SAP", "Model", "GiaNiemYet", "GiaKM", "G", "Qua", "ThoiGian"]
+
+def _format_number_column(series, strip, pattern):
+    """Định dạng số theo cột; giá trị không parse được giữ nguyên dạng chuỗi như bản cũ"""
+    valid = series.notna()
+    numbers = pd.to_numeric(series.astype(str).str.replace(strip, '', regex=False), errors='coerce')
+    result = pd.Series("", index=series.index, dtype=object)
+    parsed = valid & numbers.notna()
+    result[parsed] = [pattern.format(x) for x in numbers[parsed]]
+    for idx in series.index[valid & ~parsed]:
+        # Trường hợp hiếm (vd. có khoảng trắng): dùng đúng logic float() của bản tuần tự
+        value = series[idx]
+        try:
+            result[idx] = pattern.format(float(str(value).replace(strip, '')))
+        except (ValueError, TypeError):
+            result[idx] = str(value)
+    return result
+
+def _limit_string_column(series, max_length):
+    text = series.astype(str)
+    text = text.where(text.str.len() <= max_length, text.str[:max_length - 3] + "...")
+    return text.where(series.notna(), "")
+
+def _blank_na_column(series):
+    return series.astype(object).where(series.notna(), "")
+
+def prepare_price_table(df, name_limit, promo_column="GiaKM"):
+    """Tính toàn bộ cột đã định dạng một lần theo cột (thay cho iterrows + định dạng từng ô).
     
-    def load_config(self):
+    Trả về DataFrame với các cột PRICE_FIELDS, NaN đã thành "", dùng chung cho mọi định dạng.
+    """
+    missing = [c for c in ["NganhHang", "Hang", "SAP", "Model", "GiaNiemYet", promo_column, "G", "Qua", "ThoiGian"]
+               if c not in df.columns]
+    if missing:
+        raise KeyError(f"File Excel thiếu cột: {', '.join(missing)}")
+    return pd.DataFrame({
+        "NganhHang": _limit_string_column(df["NganhHang"], name_limit),
+        "Hang": _blank_na_column(df["Hang"]),
+        "SAP": _blank_na_column(df["SAP"]),
+        "Model": _blank_na_column(df["Model"]),
+        "GiaNiemYet": _format_number_column(df["GiaNiemYet"], ',', "{:,.0f}đ"),
+        "GiaKM": _format_number_column(df[promo_column], ',', "{:,.0f}đ"),
+        "G": _format_number_column(df["G"], '%', "{:.0f}%"),
+        "Qua": _blank_na_column(df["Qua"]),
+        "ThoiGian": _blank_na_column(df["ThoiGian"]),
+    }, index=df.index)
+
+def prepare_a4_contexts(df):
+    """Danh sách context A4 (một dict mỗi dòng)"""
+    return prepare_price_table(df, 29, "GiaKM").to_dict("records")
+
+def prepare_a5_contexts(df):
+    """Danh sách context A5 (một dict cho mỗi cặp dòng, dòng thứ hai có hậu tố '1')"""
+    records = prepare_price_table(df, 31, "GiaKm").to_dict("records")
+    blank = {f"{key}1": "" for key in PRICE_FIELDS}
+    contexts = []
+    for i in range(0, len(records), 2):
+        context = dict(records[i])
+        if i + 1 < len(records):
+            context.update({f"{key}1": value for key, value in records[i + 1].items()})
+        else:
+            context.update(blank)
+        contexts.append(context)
+    return contexts
+
+class ExcelChunkReader:
+    """Đọc file Excel theo từng khối dòng (openpyxl read-only), chỉ giữ các cột template dùng.
+    
+    Mỗi khối là một DataFrame dtype object, index là vị trí dòng tuyệt đối (0 = dòng dữ liệu
+    đầu tiên) để tên file temp_output_N không trùng giữa các khối. Bộ nhớ không tăng theo
+    kích thước sheet. File .xls (openpyxl không đọc được) được đọc một lần bằng pandas.
+    """
+    
+    def __init__(self, path, columns, chunk_rows=1000, streaming=True):
+        self.path = path
+        self.columns = list(columns)
+        self.chunk_rows = max(2, int(chunk_rows))
+        self.chunk_rows += self.chunk_rows % 2  # Số chẵn để cặp dòng A5 không bị cắt đôi
+        self.streaming = streaming and os.path.splitext(path)[1].lower() in ('.xlsx', '.xlsm')
+        self.estimated_rows = self._estimate_rows()
+    
+    def _estimate_rows(self):
+        if not self.streaming:
+            return None
+        from openpyxl import load_workbook
+        wb = load_workbook(self.path, read_only=True)
         try:
-            if os.path.exists(self.config_file):
-                with open(self.config_file, 'r', encoding='utf-8') as f:
-                    return {**self.default_config, **json.load(f)}
-            else:
-                self.save_config(self.default_config)
-                return self.default_config
+            # Sheet đầu tiên như pd.read_excel, không phụ thuộc sheet đang được chọn khi lưu
+            max_row = wb.worksheets[0].max_row
+            return max_row - 1 if max_row else None
+        finally:
+            wb.close()
+    
+    def __iter__(self):
+        if not self.streaming:
+            df = pd.read_excel(self.path)
+            yield df[[c for c in self.columns if c in df.columns]]
+            return
+        
+        from openpyxl import load_workbook
+        wb = load_workbook(self.path, read_only=True, data_only=True)
+        try:
+            rows = wb.worksheets[0].iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                return
+            positions = {}
+            for idx, name in enumerate(header):
+                if name in self.columns and name not in positions:
+                    positions[name] = idx
+            names = list(positions)
+            indexes = [positions[name] for name in names]
+            
+            chunk, blank_rows, start = [], [], 0
+            for row in rows:
+                values = [row[i] if i < len(row) else None for i in indexes]
+                if all(v is None for v in values):
+                    # Dòng trống ở cuối sheet bị bỏ qua như pandas; dòng trống ở giữa được giữ lại
+                    blank_rows.append(values)
+                    continue
+                chunk.extend(blank_rows)
+                blank_rows = []
+                chunk.append(values)
+                if len(chunk) >= self.chunk_rows:
+                    yield self._frame(chunk[:self.chunk_rows], names, start)
+                    start += self.chunk_rows
+                    chunk = chunk[self.chunk_rows:]
+            if chunk:
+                yield self._frame(chunk, names, start)
+        finally:
+            wb.close()
+    
+    @staticmethod
+    def _frame(values, names, start):
+        return pd.DataFrame(values, columns=names, dtype=object, index=range(start, start + len(values)))
+
+@functools.lru_cache(maxsize=None)
+def _template_classes():
+    """Tạo các lớp template khi cần (docxtpl/jinja2 chỉ được nạp lúc render lần đầu)"""
+    from docxtpl import DocxTemplate
+    from jinja2 import Environment
+    
+    class _CachingJinjaEnvironment(Environment):
+        """Jinja Environment giữ lại template đã biên dịch theo nội dung XML nguồn"""
+        
+        max_compiled = 64
+        
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._compiled = {}
+        
+        def from_string(self, source, globals=None, template_class=None):
+            if globals is not None or template_class is not None:
+                return super().from_string(source, globals, template_class)
+            template = self._compiled.get(source)
+            if template is None:
+                template = super().from_string(source)
+                if len(self._compiled) < self.max_compiled:
+                    self._compiled[source] = template
+            return template
+    
+    class _CachedDocxTemplate(DocxTemplate):
+        """DocxTemplate trên bản sao của document đã parse sẵn, dùng lại XML đã patch của template gốc"""
+        
+        def __init__(self, cached):
+            super().__init__(cached.path)
+            self._cached = cached
+            self.docx = cached.clone_document()  # init_docx() không mở lại file khi đã có docx
+        
+        def patch_xml(self, src_xml):
+            patched = self._cached.patched_xml.get(src_xml)
+            if patched is None:
+                patched = super().patch_xml(src_xml)
+                self._cached.patched_xml[src_xml] = patched
+            return patched
+        
+    return _CachingJinjaEnvironment, _CachedDocxTemplate
+
+class CachedTemplate:
+    """Template Word đã nạp sẵn: bytes của file, document đã parse, XML đã patch và Jinja đã biên dịch"""
+    
+    # Part chỉ được render ghi đè lên bản sao (document, thuộc tính, header/footer/footnote); các part
+    # khác (styles, theme, numbering...) không bị sửa nên mọi bản sao dùng chung cây XML
+    _RENDERED_PARTS = ('/word/document.xml', '/docProps/core.xml', '/word/header', '/word/footer',
+                       '/word/footnotes')
+    
+    def __init__(self, path, data, digest):
+        self.path = path
+        self.data = data
+        self.digest = digest
+        self.patched_xml = {}
+        self.jinja_env = _template_classes()[0]()
+        self._prototype = None
+        self._shared = None
+    
+    def clone_document(self):
+        """Bản sao document python-docx để render một dòng, không mở zip và parse lại XML"""
+        if self._prototype is None:
+            from docx import Document
+            from docx.opc.part import XmlPart
+            prototype = Document(io.BytesIO(self.data))
+            self._shared = {id(part._element): part._element for part in prototype.part.package.iter_parts()
+                            if isinstance(part, XmlPart)
+                            and not str(part.partname).startswith(self._RENDERED_PARTS)}
+            self._prototype = prototype
+        return copy.deepcopy(self._prototype, dict(self._shared))
+    
+    def new_document(self):
+        """Bản sao rẻ để render một dòng (không đọc lại file, không biên dịch lại Jinja)"""
+        return _template_classes()[1](self)
+    
+    def render_to(self, context, output_path):
+        doc = self.new_document()
+        doc.render(context, self.jinja_env)
+        doc.save(output_path)
+        return output_path
+
+class TemplateCache:
+    """Cache template Word theo đường dẫn + mtime + hash, dùng lại giữa các lần chạy"""
+    
+    def __init__(self):
+        self._by_path = {}
+        self._by_digest = {}
+        self._lock = threading.Lock()
+    
+    def get(self, path):
+        abspath = os.path.abspath(path)
+        stat = os.stat(abspath)
+        key = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            entry = self._by_path.get(abspath)
+            if entry and entry[0] == key:
+                return entry[1]
+            with open(abspath, 'rb') as f:
+                data = f.read()
+            digest = hashlib.sha256(data).hexdigest()
+            # File được lưu lại nhưng nội dung không đổi thì vẫn dùng bản đã biên dịch
+            cached = self._by_digest.get(digest)
+            if cached is None:
+                cached = CachedTemplate(abspath, data, digest)
+                self._by_digest[digest] = cached
+            self._by_path[abspath] = (key, cached)
+            return cached
+    
+    def clear(self):
+        with self._lock:
+            self._by_path.clear()
+            self._by_digest.clear()
+
+TEMPLATE_CACHE = TemplateCache()
+
+def render_word_file(template_path, context, output_path):
+    """Render một file Word từ template (hàm cấp module để chạy được trong process pool)"""
+    return TEMPLATE_CACHE.get(template_path).render_to(context, output_path)
+
+def _end_record_section(body, final_sect_pr):
+    """Kết thúc bản ghi trước bằng section break (giống mail merge) để bản ghi sau sang trang mới"""
+    from docx.oxml.ns import qn
+    last = final_sect_pr.getprevious()
+    if last is None or last.tag != qn('w:p') or (last.pPr is not None and last.pPr.sectPr is not None):
+        last = body.makeelement(qn('w:p'), {})
+        final_sect_pr.addprevious(last)
+    placeholder = last.get_or_add_pPr().get_or_add_sectPr()
+    placeholder.getparent().replace(placeholder, copy.deepcopy(final_sect_pr))
+
+def render_combined_word_file(template_path, contexts, output_path):
+    """Render nhiều bản ghi vào một file Word nhiều trang, mỗi bản ghi một section.
+    
+    Mọi bản ghi render từ cùng một template nên style, ảnh và relationship trùng
+    nhau; chỉ cần chép phần body. Header/footer lấy theo bản ghi đầu tiên.
+    Bản ghi lỗi được bỏ qua; trả về danh sách (vị trí, lỗi) của chúng. Lỗi hết thì raise.
+    """
+    from docx.oxml.ns import qn
+    cached = TEMPLATE_CACHE.get(template_path)
+    master = None
+    failures = []
+    for index, context in enumerate(contexts):
+        try:
+            doc = cached.new_document()
+            doc.render(context, cached.jinja_env)
         except Exception as e:
-            print(f"Lỗi khi đọc config: {e}")
-            return self.default_config
+            failures.append((index, str(e)))
+            continue
+        if master is None:
+            master = doc
+            body = master.docx.element.body
+            final_sect_pr = body.sectPr
+            continue
+        _end_record_section(body, final_sect_pr)
+        for child in list(doc.docx.element.body):
+            if child.tag != qn('w:sectPr'):
+                final_sect_pr.addprevious(child)
+    
+    if master is None:
+        raise Exception(failures[0][1] if failures else "Không có bản ghi nào")
+    # Đánh lại id cho các hình (docPr) bị trùng sau khi ghép
+    for new_id, doc_pr in enumerate(body.iter(qn('wp:docPr')), start=1):
+        doc_pr.set('id', str(new_id))
+    master.save(output_path)
+    return failures
+
+def _a5_slot_boxes():
+    """Các ô của một bảng giá A5 (nửa trang A4), tọa độ mm tính từ góc trên-trái của ô"""
+    return [
+        {"x": 4, "y": 4, "width": 202, "height": 140.5, "border": 0.8},
+        {"field": "NganhHang", "x": 8, "y": 8, "width": 194, "height": 15, "font": "bold", "size": 30},
+        {"field": "Hang", "x": 8, "y": 25, "width": 194, "height": 10, "font": "bold", "size": 20},
+        {"field": "Model", "x": 8, "y": 36, "width": 194, "height": 9, "size": 16},
+        {"text": "Giá niêm yết:", "x": 12, "y": 50, "width": 70, "height": 9, "size": 15, "align": "left",
+         "requires": "GiaNiemYet"},
+        {"field": "GiaNiemYet", "x": 82, "y": 50, "width": 116, "height": 9, "size": 20, "align": "right",
+         "strike": True},
+        {"text": "GIÁ KHUYẾN MÃI", "x": 8, "y": 62, "width": 194, "height": 9, "font": "bold", "size": 17},
+        {"field": "GiaKM", "x": 8, "y": 72, "width": 194, "height": 28, "font": "bold", "size": 64,
+         "color": "#D00000"},
+        {"field": "G", "x": 8, "y": 101, "width": 194, "height": 10, "font": "bold", "size": 22,
+         "format": "Giảm {}"},
+        {"field": "Qua", "x": 12, "y": 112, "width": 186, "height": 16, "size": 13, "wrap": True,
+         "format": "Quà tặng: {}"},
+        {"field": "ThoiGian", "x": 8, "y": 129, "width": 194, "height": 7, "size": 11,
+         "format": "Thời gian áp dụng: {}"},
+        {"field": "SAP", "x": 12, "y": 137, "width": 100, "height": 5, "size": 8, "align": "left",
+         "format": "SAP: {}"},
+    ]
+
+# Layout mặc định cho bộ vẽ trực tiếp (render_engine = 'native'); có thể thay bằng file JSON.
+# Tọa độ và kích thước theo mm từ góc trên-trái trang; cỡ chữ theo point.
+NATIVE_LAYOUTS = {
+    "A4": {
+        "page_size": [210, 297],
+        "fonts": {"regular": "", "bold": ""},
+        "slots": [{"suffix": "", "offset": [0, 0]}],
+        "boxes": [
+            {"x": 5, "y": 5, "width": 200, "height": 287, "border": 1},
+            {"field": "NganhHang", "x": 10, "y": 12, "width": 190, "height": 22, "font": "bold", "size": 40},
+            {"field": "Hang", "x": 10, "y": 38, "width": 190, "height": 14, "font": "bold", "size": 26},
+            {"field": "Model", "x": 10, "y": 54, "width": 190, "height": 12, "size": 22},
+            {"text": "Giá niêm yết:", "x": 15, "y": 80, "width": 80, "height": 12, "size": 20, "align": "left",
+             "requires": "GiaNiemYet"},
+            {"field": "GiaNiemYet", "x": 95, "y": 80, "width": 100, "height": 12, "size": 26, "align": "right",
+             "strike": True},
+            {"text": "GIÁ KHUYẾN MÃI", "x": 10, "y": 100, "width": 190, "height": 14, "font": "bold", "size": 24},
+            {"field": "GiaKM", "x": 10, "y": 116, "width": 190, "height": 40, "font": "bold", "size": 90,
+             "color": "#D00000"},
+            {"field": "G", "x": 10, "y": 160, "width": 190, "height": 20, "font": "bold", "size": 40,
+             "format": "Giảm {}"},
+            {"field": "Qua", "x": 15, "y": 185, "width": 180, "height": 40, "size": 20, "wrap": True,
+             "format": "Quà tặng: {}"},
+            {"field": "ThoiGian", "x": 10, "y": 235, "width": 190, "height": 12, "size": 16,
+             "format": "Thời gian áp dụng: {}"},
+            {"field": "SAP", "x": 15, "y": 275, "width": 100, "height": 8, "size": 12, "align": "left",
+             "format": "SAP: {}"},
+        ],
+    },
+    "A5": {
+        # Hai bảng giá A5 trên một trang A4 dọc, bản ghi thứ hai dùng các khóa có hậu tố '1'
+        "page_size": [210, 297],
+        "fonts": {"regular": "", "bold": ""},
+        "slots": [{"suffix": "", "offset": [0, 0]}, {"suffix": "1", "offset": [0, 148.5]}],
+        "boxes": _a5_slot_boxes(),
+    },
+}
+
+class NativePriceRenderer:
+    """Vẽ bảng giá thẳng ra PDF bằng reportlab theo layout khai báo, không cần Word/LibreOffice.
+    
+    Nhận đúng các context của prepare_a4_contexts/prepare_a5_contexts. Mỗi ô (box) lấy giá trị
+    từ 'field' (hoặc chữ cố định 'text'), tự thu nhỏ chữ cho vừa chiều rộng hoặc xuống dòng ('wrap').
+    """
+    
+    # Font TTF có dấu tiếng Việt thường có sẵn, dùng khi layout không khai báo
+    FONT_CANDIDATES = {
+        "regular": [r"C:\Windows\Fonts\arial.ttf", "/Library/Fonts/Arial.ttf",
+                    "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf",
+                    "/usr/share/fonts/truetype/liberation/LiberationSans-Regular.ttf"],
+        "bold": [r"C:\Windows\Fonts\arialbd.ttf", "/Library/Fonts/Arial Bold.ttf",
+                 "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+                 "/usr/share/fonts/truetype/liberation/LiberationSans-Bold.ttf"],
+    }
+    
+    def __init__(self, layout):
+        self.layout = layout
+        self.fonts = self._register_fonts(layout.get("fonts", {}))
+    
+    @staticmethod
+    def load_layout(path, format_name):
+        """Layout từ file JSON, hoặc layout mặc định của định dạng nếu path rỗng"""
+        if not path:
+            return copy.deepcopy(NATIVE_LAYOUTS[format_name])
+        with open(path, encoding='utf-8') as f:
+            layout = json.load(f)
+        # File chỉ cần khai báo phần khác với mặc định
+        return {**copy.deepcopy(NATIVE_LAYOUTS[format_name]), **layout}
+    
+    def _register_fonts(self, fonts):
+        from reportlab.pdfbase import pdfmetrics
+        from reportlab.pdfbase.ttfonts import TTFont
+        registered = {}
+        for style in set(self.FONT_CANDIDATES) | set(fonts):
+            candidates = [fonts.get(style)] + self.FONT_CANDIDATES.get(style, [])
+            path = next((p for p in candidates if p and os.path.exists(p)), None)
+            if path is None:
+                raise Exception(f"Không tìm thấy font '{style}' có dấu tiếng Việt; "
+                                f"khai báo đường dẫn file .ttf trong 'fonts' của layout")
+            name = f"AutoPrice-{style}-{hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:8]}"
+            if name not in pdfmetrics.getRegisteredFontNames():
+                pdfmetrics.registerFont(TTFont(name, path))
+            registered[style] = name
+        return registered
+    
+    def render(self, contexts, output_path, on_page=None):
+        """Vẽ mỗi context thành một trang; trả về số trang. on_page(context, lỗi) sau mỗi trang"""
+        from reportlab.lib.units import mm
+        from reportlab.pdfgen.canvas import Canvas
+        width, height = self.layout["page_size"]
+        temp_path = output_path + ".part"
+        canvas = Canvas(temp_path, pagesize=(width * mm, height * mm), pageCompression=1)
+        pages = 0
+        try:
+            for context in contexts:
+                try:
+                    ops = self._layout_page(context)
+                except Exception as e:
+                    if on_page:
+                        on_page(context, e)
+                    continue
+                self._draw(canvas, ops, height * mm)
+                canvas.showPage()
+                pages += 1
+                if on_page:
+                    on_page(context, None)
+            if pages:
+                canvas.save()
+                os.replace(temp_path, output_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return pages
+    
+    def _layout_page(self, context):
+        """Tính trước nội dung từng ô (lỗi dữ liệu được phát hiện trước khi vẽ lên trang)"""
+        ops = []
+        for slot in self.layout["slots"]:
+            suffix = slot.get("suffix", "")
+            if not any(context.get(f"{field}{suffix}") for field in PRICE_FIELDS):
+                continue  # Ô trống (vd. dòng lẻ cuối cùng của A5)
+            dx, dy = slot.get("offset", [0, 0])
+            for box in self.layout["boxes"]:
+                box = {**box, "x": box["x"] + dx, "y": box["y"] + dy}
+                if "field" in box or "text" in box:
+                    if box.get("requires") and not context.get(box["requires"] + suffix):
+                        continue
+                    text = box["text"] if "text" in box else str(context.get(box["field"] + suffix, "") or "")
+                    if not text:
+                        continue
+                    if "format" in box:
+                        text = box["format"].format(text)
+                    ops.append((box, text))
+                else:
+                    ops.append((box, None))
+        return ops
+    
+    def _draw(self, canvas, ops, page_height):
+        from reportlab.lib.colors import HexColor
+        from reportlab.lib.units import mm
+        from reportlab.lib.utils import simpleSplit
+        from reportlab.pdfbase.pdfmetrics import stringWidth
+        for box, text in ops:
+            x, width = box["x"] * mm, box["width"] * mm
+            top, box_height = page_height - box["y"] * mm, box["height"] * mm
+            if text is None:
+                # Khung viền
+                canvas.setLineWidth(box.get("border", 1))
+                canvas.setStrokeColor(HexColor(box.get("color", "#000000")))
+                canvas.rect(x, top - box_height, width, box_height)
+                continue
+            
+            font = self.fonts[box.get("font", "regular")]
+            size = float(box.get("size", 12))
+            min_size = float(box.get("min_size", size / 2))
+            if box.get("wrap"):
+                max_lines = max(1, int(box_height // (size * 1.15)))
+                lines = simpleSplit(text, font, size, width)
+                while len(lines) > max_lines and size > min_size:
+                    size -= 0.5
+                    max_lines = max(1, int(box_height // (size * 1.15)))
+                    lines = simpleSplit(text, font, size, width)
+                lines = lines[:max_lines]
+            else:
+                while size > min_size and stringWidth(text, font, size) > width:
+                    size -= 0.5
+                lines = [text]
+            
+            canvas.setFont(font, size)
+            canvas.setFillColor(HexColor(box.get("color", "#000000")))
+            leading = size * 1.15
+            # Căn giữa khối chữ theo chiều dọc của ô
+            y = top - (box_height - leading * len(lines)) / 2 - size
+            align = box.get("align", "center")
+            for line in lines:
+                if align == "left":
+                    start = x
+                    canvas.drawString(x, y, line)
+                elif align == "right":
+                    start = x + width - stringWidth(line, font, size)
+                    canvas.drawRightString(x + width, y, line)
+                else:
+                    start = x + (width - stringWidth(line, font, size)) / 2
+                    canvas.drawCentredString(x + width / 2, y, line)
+                if box.get("strike"):
+                    canvas.setStrokeColor(HexColor(box.get("color", "#000000")))
+                    canvas.setLineWidth(max(0.5, size / 18))
+                    canvas.line(start, y + size * 0.3, start + stringWidth(line, font, size), y + size * 0.3)
+                y -= leading
+
+class StreamingPdfMerger:
+    """Gộp PDF ghi dần ra đĩa với bộ nhớ giới hạn.
+    
+    Mỗi file nguồn được đọc, chép các object của trang (đánh số lại) thẳng xuống file đích
+    rồi giải phóng ngay. Trong bộ nhớ chỉ còn số hiệu trang và offset xref, nên bộ nhớ
+    không tăng theo nội dung trang. Cây trang, catalog và xref được ghi khi close().
+    
+    optimize: object (font, hình, XObject...) giống hệt object đã ghi từ file nguồn trước chỉ
+    được ghi một lần và dùng chung (so theo hash nội dung); stream chưa nén được nén Flate.
+    linearize: sau khi ghi xong, chạy qpdf --linearize để trang đầu hiện nhanh (bỏ qua nếu thiếu qpdf).
+    """
+    
+    _INHERITABLE = ('/Resources', '/MediaBox', '/CropBox', '/Rotate')
+    
+    def __init__(self, output_path, optimize=True, linearize=False, qpdf_path="", log=print):
+        self.output_path = output_path
+        self.optimize = optimize
+        self.linearize = linearize
+        self.qpdf_path = qpdf_path
+        self.log = log  # Nhận cảnh báo của qpdf (nhật ký của job)
+        self._shared = {}  # hash nội dung -> số hiệu object đã ghi
+        self.shared_objects = 0  # số object trùng lặp không phải ghi lại
+        self.compressed_streams = 0
+        self.temp_path = output_path + ".part"
+        self.stream = open(self.temp_path, 'wb')
+        self.stream.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        # Object 1 = Catalog, 2 = Pages (ghi cuối cùng)
+        self.offsets = [None, None, None]
+        self.page_ids = []
+        self._prefix_id = None
+        self._kept = {}  # số hiệu trang -> dict trang, cho các trang sẽ được lặp lại (repeat)
+    
+    @classmethod
+    def from_config(cls, output_path, config, log=print):
+        """Merger với các tùy chọn tối ưu file PDF theo cấu hình"""
+        return cls(output_path, optimize=bool(config.get('pdf_optimize', True)),
+                   linearize=bool(config.get('pdf_linearize', False)),
+                   qpdf_path=config.get('qpdf_path', ''), log=log)
+    
+    @property
+    def page_count(self):
+        return len(self.page_ids)
+    
+    def _alloc(self):
+        self.offsets.append(None)
+        return len(self.offsets) - 1
+    
+    def _write(self, obj_id, obj):
+        self.offsets[obj_id] = self.stream.tell()
+        self.stream.write(f"{obj_id} 0 obj\n".encode())
+        obj.write_to_stream(self.stream)
+        self.stream.write(b"\nendobj\n")
+    
+    @classmethod
+    def _inherited(cls, page, key):
+        node = page.get('/Parent')
+        while node is not None:
+            node = node.get_object()
+            if key in node:
+                return node[key]
+            node = node.get('/Parent')
+        return None
+    
+    @staticmethod
+    def _digest(obj, memo, visiting):
+        """Hash nội dung của object, kể cả các object nó tham chiếu tới.
+        
+        None nếu object không dùng chung được (trỏ tới trang, tham chiếu vòng hoặc stream không đọc được).
+        memo/visiting theo số hiệu object nguồn, chỉ dùng trong một lần chép.
+        """
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            if key in memo:
+                return memo[key]
+            if key in visiting:
+                return None
+            visiting.add(key)
+            target = obj.get_object()
+            if isinstance(target, DictionaryObject) and target.get('/Type') in ('/Page', '/Pages'):
+                digest = None
+            else:
+                digest = StreamingPdfMerger._digest(target, memo, visiting)
+            visiting.discard(key)
+            memo[key] = digest
+            return digest
+        
+        h = hashlib.sha256()
+        if isinstance(obj, DictionaryObject):
+            h.update(b"S" if isinstance(obj, StreamObject) else b"D")
+            for key in sorted(obj):
+                if key == '/Length':
+                    continue  # Độ dài được ghi lại theo dữ liệu
+                digest = StreamingPdfMerger._digest(obj.raw_get(key), memo, visiting)
+                if digest is None:
+                    return None
+                h.update(key.encode('utf-8', 'replace') + b"\0" + digest)
+            if isinstance(obj, StreamObject):
+                try:
+                    data = obj.get_data()  # Dữ liệu đã giải nén (/Filter đã nằm trong hash ở trên)
+                except Exception:
+                    return None  # Bộ lọc pypdf không giải được: không dùng chung
+                h.update(b"\0" + data)
+        elif isinstance(obj, ArrayObject):
+            h.update(b"A")
+            for value in obj:
+                digest = StreamingPdfMerger._digest(value, memo, visiting)
+                if digest is None:
+                    return None
+                h.update(digest)
+        else:
+            data = io.BytesIO()
+            obj.write_to_stream(data)
+            h.update(type(obj).__name__.encode() + b"\0" + data.getvalue())
+        return h.digest()
+    
+    def _remapper(self, mapping, pending):
+        """Hàm chép object nguồn sang số hiệu mới trong file đích (object con được ghi sau qua pending)"""
+        from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NullObject
+        memo = {}
+        
+        def remap(obj):
+            if isinstance(obj, IndirectObject):
+                # Khóa gồm cả reader nguồn: số hiệu object của các file khác nhau có thể trùng
+                key = (id(obj.pdf), obj.idnum, obj.generation)
+                new_id = mapping.get(key)
+                if new_id is None:
+                    target = obj.get_object()
+                    if isinstance(target, DictionaryObject) and target.get('/Type') in ('/Page', '/Pages'):
+                        # Trang không được chọn (vd. đích của link) - bỏ, không kéo theo cả cây trang
+                        return NullObject()
+                    digest = self._digest(obj, memo, set()) if self.optimize else None
+                    new_id = self._shared.get(digest) if digest is not None else None
+                    if new_id is not None:
+                        # Giống hệt object đã ghi (font, logo, nền... của file nguồn trước): dùng chung
+                        self.shared_objects += 1
+                        mapping[key] = new_id
+                        return IndirectObject(new_id, 0, None)
+                    new_id = self._alloc()
+                    mapping[key] = new_id
+                    if digest is not None:
+                        self._shared[digest] = new_id
+                    pending.append((obj, new_id))
+                return IndirectObject(new_id, 0, None)
+            if isinstance(obj, DictionaryObject):
+                clone = copy.copy(obj)  # Stream giữ nguyên dữ liệu đã nén
+                for key, value in obj.items():
+                    clone[key] = remap(value)
+                if self.optimize and isinstance(clone, DecodedStreamObject) and '/Filter' not in clone:
+                    clone = clone.flate_encode()
+                    self.compressed_streams += 1
+                return clone
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(remap(value) for value in obj)
+            return obj
+        return remap
+    
+    def _flush(self, pending, remap):
+        while pending:
+            src_ref, new_id = pending.pop()
+            self._write(new_id, remap(src_ref.get_object()))
+    
+    def add_background(self, source, page_number=0, mapping=None):
+        """Ghi một trang của source thành Form XObject dùng chung, trả về số hiệu object.
+        
+        Truyền số này vào append(background=...) để vẽ trang nền dưới mỗi trang: nội dung,
+        font và hình của trang nền chỉ được ghi một lần cho cả file.
+        mapping: dict dùng chung giữa các lần gọi với cùng một reader để font/hình chỉ chép một lần.
+        """
+        from pypdf import PdfReader
+        from pypdf.generic import ArrayObject, DecodedStreamObject, NameObject
+        reader = source if isinstance(source, PdfReader) else PdfReader(source)
+        page = reader.pages[page_number]
+        form = DecodedStreamObject()
+        form.set_data(page.get_contents().get_data() if page.get_contents() is not None else b"")
+        form[NameObject('/Type')] = NameObject('/XObject')
+        form[NameObject('/Subtype')] = NameObject('/Form')
+        form[NameObject('/BBox')] = ArrayObject(list(page.mediabox))
+        resources = page.get('/Resources') or self._inherited(page, '/Resources')
+        if resources is not None:
+            form[NameObject('/Resources')] = resources
+        form = form.flate_encode()
+        
+        mapping = {} if mapping is None else mapping
+        pending = []
+        remap = self._remapper(mapping, pending)
+        form_id = self._alloc()
+        self._write(form_id, remap(form))
+        self._flush(pending, remap)
+        return form_id
+    
+    def _background_prefix(self):
+        """Stream "vẽ trang nền" dùng chung cho mọi trang"""
+        if self._prefix_id is None:
+            from pypdf.generic import DecodedStreamObject
+            prefix = DecodedStreamObject()
+            prefix.set_data(b"q /APBackground Do Q\n")
+            self._prefix_id = self._alloc()
+            self._write(self._prefix_id, prefix)
+        return self._prefix_id
+    
+    def append(self, source, pages=None, background=None, keep=False):
+        """Chép các trang (mặc định: tất cả) của source (đường dẫn, stream hoặc PdfReader) vào file đích.
+        
+        background: số hiệu Form XObject từ add_background(), vẽ bên dưới nội dung mỗi trang.
+        keep: giữ dict các trang vừa chép để lặp lại sau bằng repeat().
+        """
+        from pypdf import PdfReader
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+        reader = source if isinstance(source, PdfReader) else PdfReader(source)
+        if reader.is_encrypted:
+            raise Exception("Không hỗ trợ gộp PDF có mật khẩu")
+        page_numbers = range(len(reader.pages)) if pages is None else pages
+        selected = [reader.pages[i] for i in page_numbers]
+        
+        mapping = {}
+        for page in selected:
+            ref = page.indirect_reference
+            mapping[(id(ref.pdf), ref.idnum, ref.generation)] = self._alloc()
+        pending = []
+        remap = self._remapper(mapping, pending)
+        
+        for page in selected:
+            ref = page.indirect_reference
+            page_dict = DictionaryObject()
+            for key, value in page.items():
+                if key != '/Parent' and not (background is not None and key == '/Resources'):
+                    page_dict[NameObject(key)] = remap(value)
+            for key in self._INHERITABLE:
+                if key not in page and not (background is not None and key == '/Resources'):
+                    inherited = self._inherited(page, key)
+                    if inherited is not None:
+                        page_dict[NameObject(key)] = remap(inherited)
+            if background is not None:
+                self._add_background_to(page, page_dict, background, remap)
+            page_dict[NameObject('/Parent')] = IndirectObject(2, 0, None)
+            new_id = mapping[(id(ref.pdf), ref.idnum, ref.generation)]
+            self._write(new_id, page_dict)
+            self.page_ids.append(new_id)
+            if keep:
+                self._kept[new_id] = page_dict
+            self._flush(pending, remap)
+        return len(selected)
+    
+    def repeat(self, page_ids):
+        """Thêm lại các trang đã chép (append(keep=True)) mà không chép nội dung lần nữa.
+        
+        Mỗi bản lặp là một dict trang mới dùng chung /Contents và /Resources với trang gốc,
+        nên chỉ tốn vài chục byte. Annotation không được dùng chung giữa các trang nên bị bỏ.
+        """
+        from pypdf.generic import DictionaryObject, NameObject
+        for page_id in page_ids:
+            page_dict = DictionaryObject({NameObject(key): value for key, value in self._kept[page_id].items()
+                                          if key != '/Annots'})
+            new_id = self._alloc()
+            self._write(new_id, page_dict)
+            self.page_ids.append(new_id)
+        return len(page_ids)
+    
+    def add_page(self, width, height, content, xobjects=None):
+        """Thêm một trang mới kích thước width x height (pt) với nội dung vẽ các Form XObject.
+        
+        xobjects: {tên: số hiệu object} dùng trong content (vd. {"/P0": form_id}).
+        """
+        from pypdf.generic import (ArrayObject, DecodedStreamObject, DictionaryObject, FloatObject,
+                                   IndirectObject, NameObject)
+        stream = DecodedStreamObject()
+        stream.set_data(content)
+        stream = stream.flate_encode()
+        content_id = self._alloc()
+        self._write(content_id, stream)
+        
+        page_dict = DictionaryObject({
+            NameObject('/Type'): NameObject('/Page'),
+            NameObject('/Parent'): IndirectObject(2, 0, None),
+            NameObject('/MediaBox'): ArrayObject([FloatObject(0), FloatObject(0),
+                                                  FloatObject(width), FloatObject(height)]),
+            NameObject('/Resources'): DictionaryObject({
+                NameObject('/XObject'): DictionaryObject({
+                    NameObject(name): IndirectObject(obj_id, 0, None)
+                    for name, obj_id in (xobjects or {}).items()
+                }),
+            }),
+            NameObject('/Contents'): IndirectObject(content_id, 0, None),
+        })
+        page_id = self._alloc()
+        self._write(page_id, page_dict)
+        self.page_ids.append(page_id)
+        return page_id
+    
+    def _add_background_to(self, page, page_dict, background, remap):
+        """Thêm Form XObject nền vào Resources của trang và vẽ nó trước nội dung gốc"""
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject
+        resources = page.get('/Resources') or self._inherited(page, '/Resources')
+        resources = DictionaryObject(resources.get_object()) if resources is not None else DictionaryObject()
+        xobjects = resources.get('/XObject')
+        xobjects = DictionaryObject(xobjects.get_object()) if xobjects is not None else DictionaryObject()
+        # Bản sao trực tiếp (không dùng chung object Resources của trang nguồn) rồi mới gắn nền
+        resources[NameObject('/XObject')] = xobjects
+        resources = remap(resources)
+        resources['/XObject'][NameObject('/APBackground')] = IndirectObject(background, 0, None)
+        page_dict[NameObject('/Resources')] = resources
+        
+        contents = page_dict.get('/Contents')
+        if contents is None:
+            contents = ArrayObject()
+        elif not isinstance(contents, ArrayObject):
+            contents = ArrayObject([contents])
+        page_dict[NameObject('/Contents')] = ArrayObject(
+            [IndirectObject(self._background_prefix(), 0, None), *contents])
+    
+    def close(self):
+        """Ghi cây trang, catalog, xref và đổi tên file tạm thành file đích"""
+        from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject
+        pages = DictionaryObject({
+            NameObject('/Type'): NameObject('/Pages'),
+            NameObject('/Kids'): ArrayObject(IndirectObject(i, 0, None) for i in self.page_ids),
+            NameObject('/Count'): NumberObject(len(self.page_ids)),
+        })
+        self._write(2, pages)
+        self._write(1, DictionaryObject({
+            NameObject('/Type'): NameObject('/Catalog'),
+            NameObject('/Pages'): IndirectObject(2, 0, None),
+        }))
+        
+        xref_offset = self.stream.tell()
+        self.stream.write(f"xref\n0 {len(self.offsets)}\n".encode())
+        self.stream.write(b"0000000000 65535 f\r\n")
+        for offset in self.offsets[1:]:
+            if offset is None:
+                self.stream.write(b"0000000000 65535 f\r\n")
+            else:
+                self.stream.write(f"{offset:010d} 00000 n\r\n".encode())
+        self.stream.write(f"trailer\n<< /Size {len(self.offsets)} /Root 1 0 R >>\n"
+                          f"startxref\n{xref_offset}\n%%EOF\n".encode())
+        self.stream.close()
+        if not (self.linearize and self._linearize()):
+            os.replace(self.temp_path, self.output_path)
+        return self.output_path
+    
+    def _linearize(self):
+        """Ghi file đích đã linearize (và gom object vào object stream) bằng qpdf; False nếu không được"""
+        qpdf = self.qpdf_path or shutil.which('qpdf')
+        if not qpdf:
+            self.log("⚠️ Không tìm thấy qpdf, bỏ qua linearize")
+            return False
+        try:
+            result = subprocess.run([qpdf, '--linearize', '--object-streams=generate',
+                                     self.temp_path, self.output_path],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            self.log(f"⚠️ Không chạy được qpdf: {e}")
+            return False
+        # Mã 3 = thành công nhưng có cảnh báo
+        if result.returncode not in (0, 3):
+            self.log(f"⚠️ qpdf lỗi, giữ file chưa linearize: {result.stderr.decode(errors='replace').strip()}")
+            return False
+        os.remove(self.temp_path)
+        return True
+    
+    def abort(self):
+        """Hủy file đang ghi dở"""
+        self.stream.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class PageImposer:
+    """Xếp N trang một bản ghi lên một tờ in (2, 4, 8-up...) ở mức PDF, kèm dấu cắt.
+    
+    Mỗi trang nguồn thành một Form XObject, được thu nhỏ vừa ô lưới và canh giữa. Chiều tờ
+    (dọc/ngang) được chọn tự động sao cho trang nguồn lớn nhất. Font và hình dùng chung của
+    file nguồn chỉ được chép một lần.
+    """
+    
+    PRESETS = {"2up": (2, 1), "4up": (2, 2), "8up": (4, 2)}
+    SHEET_SIZES = {"A3": (297, 420), "A4": (210, 297), "A5": (148, 210)}
+    MM = 72 / 25.4
+    
+    def __init__(self, columns, rows, sheet_size=(210, 297), margin_mm=5, gap_mm=0,
+                 cut_marks=True, mark_length_mm=4, merge_config=None):
+        if columns < 1 or rows < 1:
+            raise ValueError(f"Lưới xếp trang không hợp lệ: {columns}x{rows}")
+        self.columns = columns
+        self.rows = rows
+        self.sheet_size = sheet_size
+        self.margin = margin_mm * self.MM
+        self.gap = gap_mm * self.MM
+        self.cut_marks = cut_marks
+        self.mark_length = mark_length_mm * self.MM
+        self.merge_config = merge_config or {}  # Tùy chọn tối ưu file PDF (pdf_optimize, pdf_linearize...)
+    
+    @property
+    def per_sheet(self):
+        return self.columns * self.rows
+    
+    @classmethod
+    def parse_grid(cls, value):
+        """'2up' / '4up' / '8up' hoặc 'CỘTxHÀNG' (vd. '3x3') -> (cột, hàng); '' -> None"""
+        value = str(value or "").strip().lower()
+        if not value:
+            return None
+        if value in cls.PRESETS:
+            return cls.PRESETS[value]
+        try:
+            columns, rows = (int(part) for part in value.split("x"))
+        except ValueError:
+            raise ValueError(f"Kiểu xếp trang không hợp lệ: {value} (dùng 2up/4up/8up hoặc CỘTxHÀNG)")
+        return columns, rows
+    
+    @classmethod
+    def from_config(cls, config):
+        """Tạo imposer theo cấu hình, None nếu không bật xếp trang"""
+        grid = cls.parse_grid(config.get('imposition', ''))
+        if grid is None:
+            return None
+        sheet = config.get('imposition_sheet', 'A4')
+        sheet_size = cls.SHEET_SIZES.get(str(sheet).upper()) if isinstance(sheet, str) else tuple(sheet)
+        if sheet_size is None:
+            raise ValueError(f"Khổ giấy không hỗ trợ: {sheet} ({', '.join(cls.SHEET_SIZES)})")
+        return cls(grid[0], grid[1], sheet_size,
+                   margin_mm=float(config.get('imposition_margin_mm', 5)),
+                   gap_mm=float(config.get('imposition_gap_mm', 0)),
+                   cut_marks=bool(config.get('imposition_cut_marks', True)),
+                   merge_config=config)
+    
+    def _cell_size(self, sheet_width, sheet_height):
+        cell_width = (sheet_width - 2 * self.margin - (self.columns - 1) * self.gap) / self.columns
+        cell_height = (sheet_height - 2 * self.margin - (self.rows - 1) * self.gap) / self.rows
+        if cell_width <= 0 or cell_height <= 0:
+            raise ValueError("Lề/khoảng cách quá lớn so với khổ giấy")
+        return cell_width, cell_height
+    
+    def plan(self, page_width, page_height):
+        """Chọn chiều tờ cho trang nguồn lớn nhất: trả về (rộng tờ, cao tờ, ô rộng, ô cao, tỉ lệ)"""
+        short, long = sorted(size * self.MM for size in self.sheet_size)
+        best = None
+        for sheet_width, sheet_height in ((short, long), (long, short)):
+            cell_width, cell_height = self._cell_size(sheet_width, sheet_height)
+            scale = min(cell_width / page_width, cell_height / page_height)
+            if best is None or scale > best[4]:
+                best = (sheet_width, sheet_height, cell_width, cell_height, scale)
+        return best
+    
+    def _cell_origin(self, index, sheet_height, cell_width, cell_height):
+        """Góc dưới-trái của ô thứ index (xếp từ trên-trái, theo hàng)"""
+        row, column = divmod(index, self.columns)
+        x = self.margin + column * (cell_width + self.gap)
+        y = sheet_height - self.margin - (row + 1) * cell_height - row * self.gap
+        return x, y
+    
+    def _cut_mark_content(self, plan, page_width, page_height):
+        """Dấu cắt ở lề tờ, thẳng hàng với mép các trang đã thu nhỏ"""
+        sheet_width, sheet_height, cell_width, cell_height, scale = plan
+        offset = min(2 * self.MM, self.margin / 3)
+        length = min(self.mark_length, self.margin - offset)
+        if not self.cut_marks or length <= 0:
+            return b""
+        width, height = page_width * scale, page_height * scale
+        xs, ys = set(), set()
+        for index in range(self.per_sheet):
+            x, y = self._cell_origin(index, sheet_height, cell_width, cell_height)
+            left = x + (cell_width - width) / 2
+            bottom = y + (cell_height - height) / 2
+            xs.update((round(left, 2), round(left + width, 2)))
+            ys.update((round(bottom, 2), round(bottom + height, 2)))
+        top_edge, bottom_edge = sheet_height - self.margin, self.margin
+        right_edge = sheet_width - self.margin
+        lines = ["q 0.25 w 0 G"]
+        for x in sorted(xs):
+            lines.append(f"{x:.2f} {top_edge + offset:.2f} m {x:.2f} {top_edge + offset + length:.2f} l S")
+            lines.append(f"{x:.2f} {bottom_edge - offset:.2f} m {x:.2f} {bottom_edge - offset - length:.2f} l S")
+        for y in sorted(ys):
+            lines.append(f"{self.margin - offset:.2f} {y:.2f} m {self.margin - offset - length:.2f} {y:.2f} l S")
+            lines.append(f"{right_edge + offset:.2f} {y:.2f} m {right_edge + offset + length:.2f} {y:.2f} l S")
+        lines.append("Q")
+        return ("\n".join(lines) + "\n").encode()
+    
+    def impose(self, source_path, output_path, log=print):
+        """Xếp các trang của source_path lên tờ in, ghi ra output_path; trả về số tờ"""
+        from pypdf import PdfReader
+        reader = PdfReader(source_path)
+        if reader.is_encrypted:
+            raise Exception("Không hỗ trợ xếp trang PDF có mật khẩu")
+        if not reader.pages:
+            raise Exception("File PDF nguồn không có trang nào")
+        first = reader.pages[0].mediabox
+        plan = self.plan(float(first.width), float(first.height))
+        sheet_width, sheet_height, cell_width, cell_height, _ = plan
+        marks = self._cut_mark_content(plan, float(first.width), float(first.height))
+        
+        merger = StreamingPdfMerger.from_config(output_path, self.merge_config, log)
+        try:
+            shared = {}
+            sheets = 0
+            for start in range(0, len(reader.pages), self.per_sheet):
+                content, xobjects = [], {}
+                for index in range(min(self.per_sheet, len(reader.pages) - start)):
+                    box = reader.pages[start + index].mediabox
+                    width, height = float(box.width), float(box.height)
+                    scale = min(cell_width / width, cell_height / height)
+                    x, y = self._cell_origin(index, sheet_height, cell_width, cell_height)
+                    x += (cell_width - width * scale) / 2 - float(box.left) * scale
+                    y += (cell_height - height * scale) / 2 - float(box.bottom) * scale
+                    name = f"/P{index}"
+                    xobjects[name] = merger.add_background(reader, start + index, mapping=shared)
+                    content.append(f"q {scale:.5f} 0 0 {scale:.5f} {x:.2f} {y:.2f} cm {name} Do Q")
+                merger.add_page(sheet_width, sheet_height, ("\n".join(content) + "\n").encode() + marks,
+                                xobjects)
+                sheets += 1
+            merger.close()
+            return sheets
+        except Exception:
+            merger.abort()
+            raise
+
+class PageCache:
+    """Cache trang PDF theo nội dung, giữ lại giữa các lần chạy.
+    
+    Khóa = hash(template, context đã định dạng, công cụ chuyển đổi + phiên bản), nên dòng
+    không đổi giá ở lần in sau được lấy thẳng từ cache, không cần render và chuyển đổi lại.
+    Dung lượng bị giới hạn bởi max_bytes, xóa file ít dùng nhất (LRU theo mtime) khi vượt;
+    file vừa lấy ra bằng get() được giữ lại cho tới khi release() (đã gộp xong).
+    """
+    
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._size = None
+        self._pinned = set()  # File đã lấy ra, còn chờ gộp: không bị xóa khi dọn cache
+        self._evict_above = max_bytes  # Chỉ dọn lại khi vượt mức này (file đang giữ có thể làm vượt max)
+        os.makedirs(folder, exist_ok=True)
+    
+    @staticmethod
+    def make_key(template_digest, context, tool_signature):
+        payload = json.dumps({"template": template_digest, "context": context, "tool": tool_signature},
+                             sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.folder, key[:2], key + ".pdf")
+    
+    def _files(self):
+        for root, _, names in os.walk(self.folder):
+            for name in names:
+                if name.endswith(".pdf"):
+                    yield os.path.join(root, name)
+    
+    def get(self, key):
+        """Đường dẫn PDF trong cache hoặc None"""
+        path = self._path(key)
+        try:
+            os.utime(path, None)  # Đánh dấu vừa dùng (LRU)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+            self._pinned.add(path)
+        return path
+    
+    def release(self, path):
+        """Báo file lấy từ get() đã được gộp xong, có thể bị xóa khi dọn cache"""
+        with self._lock:
+            self._pinned.discard(path)
+    
+    def put(self, key, pdf_file):
+        """Chép PDF vào cache (ghi file tạm rồi đổi tên để không bao giờ có file dở dang)"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            old_size = os.path.getsize(path)  # Ghi đè khóa đã có: không cộng dung lượng hai lần
+        except OSError:
+            old_size = 0
+        temp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            shutil.copyfile(pdf_file, temp_path)
+            os.replace(temp_path, path)
+        except OSError:
+            # Đầy đĩa / bị khóa: không để lại file tạm dở dang trong cache
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._size is None:
+                self._size = sum(os.path.getsize(f) for f in self._files())
+            else:
+                self._size += os.path.getsize(path) - old_size
+            if self._size > self._evict_above:
+                self._evict()
+        return path
+    
+    def _evict(self):
+        files = []
+        for f in self._files():
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        files.sort()
+        self._size = sum(size for _, size, _ in files)
+        for mtime, size, f in files:
+            if self._size <= self.max_bytes * 0.9:
+                break
+            if f in self._pinned:
+                continue
+            try:
+                os.remove(f)
+                self._size -= size
+            except OSError:
+                pass
+        # Còn vượt vì file đang giữ: đợi tăng thêm 10% mới quét lại, không quét sau mỗi put()
+        self._evict_above = max(self.max_bytes, self._size + self.max_bytes * 0.1)
+    
+    def stats(self):
+        files = list(self._files())
+        return {
+            "folder": os.path.abspath(self.folder),
+            "entries": len(files),
+            "bytes": sum(os.path.getsize(f) for f in files),
+            "max_bytes": self.max_bytes,
+        }
+    
+    def clear(self):
+        with self._lock:
+            for f in list(self._files()):
+                try:
+                    os.remove(f)
+                except OSError:
+                    pass
+            self._size = 0
+
+class RepeatedJob:
+    """Nguồn trang của job trùng nội dung với một job trước đó: dùng lại trang đã gộp của job gốc"""
+    
+    __slots__ = ("index",)
+    
+    def __init__(self, index):
+        self.index = index  # Vị trí job gốc (trong danh sách gộp, hoặc số thứ tự trong pipeline)
+
+def _context_records(context):
+    """Các bản ghi (mã SAP, dict trường) trong một context (A4, cặp A5 hoặc danh sách single_document)"""
+    contexts = context if isinstance(context, list) else [context]
+    records = []
+    for c in contexts:
+        for suffix in ("", "1"):
+            if c.get("SAP" + suffix):
+                records.append((c["SAP" + suffix], {key: c.get(key + suffix, "") for key in PRICE_FIELDS}))
+    return records
+
+class RunManifest:
+    """Manifest của file tổng: mỗi job gồm khóa nội dung, mã SAP, hash từng mã và vị trí trang.
+    
+    Lần chạy sau đọc manifest cũ để chép thẳng các trang không đổi từ file tổng cũ (cùng khóa
+    nội dung: với A5 là cùng hai bản ghi theo cùng thứ tự), chỉ render lại các trang khác.
+    Thay đổi được tính theo hash của từng mã SAP, nên chèn một dòng không làm mọi mã sau đó
+    bị coi là thay đổi; file thay đổi chỉ gồm các trang có mã thay đổi hoặc thêm mới.
+    """
+    
+    VERSION = 2
+    
+    def __init__(self, output_path, work_dir=None, signature=""):
+        self.output_path = output_path
+        self.work_dir = work_dir
+        self.signature = signature  # vd. hash template: đổi template thì mọi mã đều thay đổi
+        self.path = os.path.splitext(output_path)[0] + ".manifest.json"
+        self.records = []
+        self.previous = {}  # khóa -> (trang đầu, số trang) trong file tổng cũ
+        self.previous_sap = {}  # mã SAP -> hash bản ghi
+        self.loaded = False
+        self._copy_path = None
+        self._stream = None
+        self._reader = None
+    
+    def load(self):
+        """Đọc manifest cũ; bỏ qua nếu file tổng cũ không còn khớp (đã bị sửa hoặc xóa)"""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            stat = os.stat(self.output_path)
+            if (data.get('version') != self.VERSION or data.get('size') != stat.st_size
+                    or data.get('mtime') != int(stat.st_mtime)):
+                return False
+            records = data['records']
+        except (OSError, ValueError, KeyError):
+            return False
+        
+        # Chép file tổng cũ ra file tạm: file đích sẽ bị ghi đè khi gộp xong
+        folder, name = os.path.split(self.output_path)
+        self._copy_path = os.path.join(self.work_dir or folder, f"temp_previous_{name}")
+        shutil.copyfile(self.output_path, self._copy_path)
+        from pypdf import PdfReader
+        self._stream = open(self._copy_path, 'rb')
+        self._reader = PdfReader(self._stream)
+        for record in records:
+            self.previous[record['key']] = (record['page'], record['pages'])
+            self.previous_sap.update(zip(record['sap'], record['hashes']))
+        self.loaded = True
+        return True
+    
+    def reuse(self, key):
+        """(PdfReader file tổng cũ, [số trang]) nếu nội dung đã có ở lần chạy trước, ngược lại None"""
+        hit = self.previous.get(key)
+        if hit is None:
+            return None
+        page, pages = hit
+        return (self._reader, list(range(page, page + pages)))
+    
+    def record_hash(self, fields):
+        """Hash nội dung một bản ghi (các trường của riêng nó, kèm signature)"""
+        payload = json.dumps({"signature": self.signature, "fields": fields},
+                             sort_keys=True, default=str, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def record(self, key, context, pages):
+        """Ghi nhận một job vừa được gộp (theo đúng thứ tự trang)"""
+        page = self.records[-1]['page'] + self.records[-1]['pages'] if self.records else 0
+        records = _context_records(context)
+        self.records.append({"key": key, "sap": [sap for sap, _ in records],
+                             "hashes": [self.record_hash(fields) for _, fields in records],
+                             "page": page, "pages": pages})
+    
+    def _is_changed(self, sap, digest):
+        return self.previous_sap.get(sap) != digest
+    
+    def diff(self):
+        """Số mã SAP (thay đổi, thêm mới, bị xóa) so với lần chạy trước"""
+        current = {}
+        for record in self.records:
+            current.update(zip(record['sap'], record['hashes']))
+        changed = sum(1 for sap, digest in current.items()
+                      if sap in self.previous_sap and self.previous_sap[sap] != digest)
+        added = sum(1 for sap in current if sap not in self.previous_sap)
+        removed = sum(1 for sap in self.previous_sap if sap not in current)
+        return changed, added, removed
+    
+    def changed_pages(self):
+        """Số trang (trong file tổng mới) có mã SAP thay đổi hoặc thêm mới so với lần chạy trước"""
+        return [page for record in self.records
+                if any(self._is_changed(sap, digest) for sap, digest in zip(record['sap'], record['hashes']))
+                for page in range(record['page'], record['page'] + record['pages'])]
+    
+    def save(self):
+        """Ghi manifest cho file tổng vừa tạo (ghi file tạm rồi đổi tên)"""
+        stat = os.stat(self.output_path)
+        data = {"version": self.VERSION, "size": stat.st_size, "mtime": int(stat.st_mtime),
+                "records": self.records}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+    
+    def close(self):
+        """Đóng và xóa bản sao file tổng cũ"""
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+            self._reader = None
+        if self._copy_path and os.path.exists(self._copy_path):
+            os.remove(self._copy_path)
+
+def _com_initialize():
+    """Khởi tạo COM cho thread hiện tại (docx2pdf dùng Word qua COM trên Windows)"""
+    try:
+        import pythoncom
+        pythoncom.CoInitialize()
+    except ImportError:
+        pass
+
+def render_job(template_path, context, output_path):
+    """Render một job: context là dict (một bản ghi) hoặc list (nhiều bản ghi một file).
+    
+    Trả về danh sách (vị trí, lỗi) các bản ghi bị bỏ qua trong job nhiều bản ghi.
+    """
+    if isinstance(context, list):
+        return render_combined_word_file(template_path, context, output_path)
+    render_word_file(template_path, context, output_path)
+    return []
+
+def timed_render_job(template_path, context, output_path):
+    """render_job, trả về (thời gian render (giây) - đo ngay trong process render, bản ghi lỗi)"""
+    started = time.perf_counter()
+    failures = render_job(template_path, context, output_path)
+    return time.perf_counter() - started, failures
+
+def profiled(target, profilers):
+    """Bọc target để chạy dưới cProfile riêng của thread gọi; profile được thêm vào profilers.
+    
+    cProfile trước Python 3.12 chỉ đo thread đã bật nó, nên các thread của pipeline cần profile riêng.
+    Từ 3.12 profiler của process chính đã đo mọi thread và không cho bật thêm profiler thứ hai.
+    """
+    import cProfile
+    
+    def run(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return target(*args, **kwargs)
+        try:
+            return target(*args, **kwargs)
+        finally:
+            profiler.disable()
+            profilers.append(profiler)
+    return run
+
+def drop_failed_records(job, failures, row_labels=None):
+    """Bỏ các bản ghi render lỗi khỏi job nhiều bản ghi (sửa ngay list context của job).
+    
+    row_labels: dict file Word -> mô tả từng dòng (group_jobs_into_documents).
+    Trả về thông báo lỗi cho từng dòng bị bỏ.
+    """
+    labels = (row_labels or {}).get(job[0])
+    messages = []
+    for index, error in sorted(failures, reverse=True):
+        label = labels[index] if labels else f"bản ghi {index + 1} của {job[2]}"
+        messages.append(f"Lỗi khi xử lý {label}: {error}")
+        del job[1][index]
+        if labels:
+            del labels[index]
+    return messages[::-1]
+
+class StagedPipeline:
+    """Pipeline render → chuyển đổi → gộp chạy chồng lấp, nối bằng các hàng đợi có giới hạn.
+    
+    - Render: job được gửi vào executor, tối đa render_queue_depth job đang chạy.
+    - Chuyển đổi: convert_workers thread lấy file Word từ hàng đợi convert_queue_depth
+      (gom tối đa batch_size file đang chờ vào một lần gọi công cụ).
+    - Gộp: thêm trang theo đúng thứ tự job, chỉ giữ lại các kết quả về sớm hơn lượt.
+    File tạm của mỗi job được xóa ngay sau khi trang đã được gộp.
+    Job trùng nội dung với job trước (dedup_records) không được render mà dùng lại trang đã gộp.
+    """
+    
+    _DONE = object()
+    DEDUP_MAX_RECORDS = 10000  # Số nội dung khác nhau tối đa được giữ trang để dùng lại
+    
+    def __init__(self, converter, executor, template_path, config, log=print, on_progress=None,
+                 render_func=timed_render_job, page_cache=None, cache_key=None, manifest=None, metrics=None,
+                 row_labels=None, profilers=None):
+        self.converter = converter
+        self.metrics = metrics
+        self.page_cache = page_cache
+        self.manifest = manifest
+        self.cache_key = cache_key
+        self.executor = executor
+        self.template_path = template_path
+        self.render_func = render_func
+        self.row_labels = row_labels  # file Word nhiều bản ghi -> mô tả từng dòng
+        self.profilers = profilers  # list nhận cProfile của từng thread (None = không profile)
+        self.log = log
+        self.on_progress = on_progress
+        self.config = config
+        self.convert_workers = max(1, int(config.get('convert_workers', 1) or 1))
+        self.batch_size = max(1, int(config.get('batch_size', 1) or 1))
+        self.render_queue = queue.Queue(maxsize=max(1, int(config.get('render_queue_depth', 16))))
+        self.convert_queue = queue.Queue(maxsize=max(1, int(config.get('convert_queue_depth', 16))))
+        self.merge_queue = queue.Queue()
+        # merged_records: số bản ghi đã gộp (một file ở chế độ single_document chứa nhiều bản ghi)
+        self.counts = {'rendered': 0, 'converted': 0, 'cached': 0, 'duplicates': 0,
+                       'merged': 0, 'merged_records': 0}
+        self.dedup = bool(config.get('dedup_records', True)) and cache_key is not None
+        self.first_seq = {}  # nội dung -> số thứ tự job gốc
+        self.produced_keys = {}  # số thứ tự job -> khóa theo công cụ đã tạo PDF
+        self.kept_seqs = set()  # job gốc cần giữ trang để dùng lại
+        self.errors = []
+        self.lock = threading.Lock()
+    
+    def _error(self, message):
+        with self.lock:
+            self.errors.append(message)
+        self.log(f"Lỗi: {message}")
+    
+    def _count(self, key, records=1):
+        with self.lock:
+            self.counts[key] += 1
+            if key == 'merged':
+                self.counts['merged_records'] += records
+            counts = dict(self.counts)
+        if self.on_progress:
+            self.on_progress(counts)
+    
+    def run(self, jobs, output_path):
+        """Chạy pipeline cho dãy job (temp_word_file, context, mô tả); trả về file PDF đã gộp"""
+        self.output_path = output_path
+        self.merged_path = None
+        self.aborted = False
+        stages = [self._collect_renders] + [self._convert_worker] * self.convert_workers + [self._merge]
+        if self.profilers is not None:
+            stages = [profiled(stage, self.profilers) for stage in stages]
+        threads = [threading.Thread(target=stage, daemon=True) for stage in stages]
+        for thread in threads:
+            thread.start()
+        
+        try:
+            for seq, job in enumerate(jobs):
+                temp_word_file, context, _ = job
+                key = self.cache_key(job) if self.dedup else None
+                if key is not None:
+                    first = self.first_seq.get(key)
+                    if first is not None:
+                        # Trùng nội dung với job trước: lặp lại trang của job gốc khi gộp
+                        self._count('duplicates')
+                        self.merge_queue.put((seq, RepeatedJob(first), job, True))
+                        continue
+                    if len(self.first_seq) < self.DEDUP_MAX_RECORDS:
+                        self.first_seq[key] = seq
+                        self.kept_seqs.add(seq)
+                cached = self.lookup(job, key)
+                if cached:
+                    # Trang không đổi: lấy thẳng từ file tổng cũ/cache, bỏ qua render và chuyển đổi
+                    self._count('cached')
+                    self.merge_queue.put((seq, cached, job, True))
+                    continue
+                future = self.executor.submit(self.render_func, self.template_path, context, temp_word_file)
+                # Hàng đợi đầy thì dừng gửi thêm job (giới hạn số file đang render)
+                self.render_queue.put((seq, job, future))
+        except BaseException:
+            # Lỗi khi đọc dữ liệu: dừng lại, không ghi file gộp dở dang
+            self.aborted = True
+            raise
+        finally:
+            self.render_queue.put(self._DONE)
+            for thread in threads:
+                thread.join()
+        return self.merged_path
+    
+    def _collect_renders(self):
+        """Nhận kết quả render theo thứ tự gửi và chuyển sang hàng đợi chuyển đổi"""
+        while True:
+            item = self.render_queue.get()
+            if item is self._DONE:
+                for _ in range(self.convert_workers):
+                    self.convert_queue.put(self._DONE)
+                return
+            seq, job, future = item
+            temp_word_file, _, row_label = job
+            try:
+                elapsed, failures = future.result()
+                if not os.path.exists(temp_word_file):
+                    raise Exception(f"Không thể tạo file Word: {temp_word_file}")
+                # Bản ghi lỗi trong file nhiều bản ghi: báo riêng từng dòng, vẫn giữ các bản ghi còn lại
+                for message in drop_failed_records(job, failures, self.row_labels):
+                    self._error(message)
+                if self.metrics is not None:
+                    self.metrics.add("render", elapsed, row_label)
+                self._count('rendered')
+                self.convert_queue.put((seq, job))
+            except Exception as e:
+                self._error(f"Lỗi khi xử lý {row_label}: {e}")
+                self.merge_queue.put((seq, None, job, False))
+    
+    def _convert_worker(self):
+        _com_initialize()
+        finished = False
+        while not finished:
+            item = self.convert_queue.get()
+            if item is self._DONE:
+                break
+            items = [item]
+            # Gom thêm các file đang chờ sẵn để chuyển đổi theo batch
+            while len(items) < self.batch_size:
+                try:
+                    extra = self.convert_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if extra is self._DONE:
+                    finished = True
+                    break
+                items.append(extra)
+            
+            word_files = [job[0] for _, job in items]
+            started = time.perf_counter()
+            try:
+                if len(word_files) == 1:
+                    results = [self.converter.convert_to_pdf(word_files[0])]
+                else:
+                    results = self.converter.convert_batch(word_files)
+            except Exception as e:
+                self.log(f"Lỗi chuyển đổi: {e}")
+                results = [None] * len(word_files)
+            if self.metrics is not None:
+                self.metrics.add("convert", time.perf_counter() - started, os.path.basename(word_files[0]))
+            for (seq, job), pdf_file in zip(items, results):
+                if pdf_file:
+                    self._count('converted')
+                    key = self.produced_keys[seq] = self.cache_key(job, self.converter.producer_of(pdf_file))
+                    if self.page_cache is not None:
+                        try:
+                            self.page_cache.put(key, pdf_file)
+                        except Exception as e:
+                            self.log(f"Không lưu được cache trang: {e}")
+                else:
+                    self._error(f"Lỗi chuyển đổi: {os.path.basename(job[0])}")
+                self.merge_queue.put((seq, pdf_file, job, False))
+        self.merge_queue.put(self._DONE)
+    
+    def lookup(self, job, key=None):
+        """Nguồn trang có sẵn cho job: trang trong file tổng cũ (manifest), file trong cache, hoặc None"""
+        if self.manifest is None and self.page_cache is None:
+            return None
+        key = key or self.cache_key(job)
+        cached = self.manifest.reuse(key) if self.manifest is not None else None
+        if cached is None and self.page_cache is not None:
+            cached = self.page_cache.get(key)
+        return cached
+    
+    def _merge(self):
+        """Gộp trang theo đúng thứ tự job khi chúng về tới (ghi dần ra đĩa)"""
+        merger = self.merger = StreamingPdfMerger.from_config(self.output_path, self.config, self.log)
+        try:
+            self._merge_pages(merger)
+        except BaseException as e:
+            # Thread gộp dừng bất thường: không để lại file .part dở dang
+            self.aborted = True
+            self._error(f"Lỗi khi gộp PDF: {e}")
+            merger.abort()
+            return
+        if self.counts['merged'] and not self.aborted:
+            self.merged_path = merger.close()
+        else:
+            merger.abort()
+    
+    def _merge_pages(self, merger):
+        """Vòng lặp nhận kết quả từ merge_queue và thêm trang vào merger theo thứ tự job"""
+        spans = {}  # số thứ tự job gốc -> (số hiệu các trang đã gộp, khóa nội dung)
+        pending = {}
+        next_seq = 0
+        finished_workers = 0
+        while finished_workers < self.convert_workers:
+            item = self.merge_queue.get()
+            if item is self._DONE:
+                finished_workers += 1
+                continue
+            seq, pdf_file, job, from_cache = item
+            pending[seq] = (pdf_file, job, from_cache)
+            while next_seq in pending:
+                seq = next_seq
+                pdf_file, job, from_cache = pending.pop(seq)
+                next_seq += 1
+                if isinstance(pdf_file, RepeatedJob) and pdf_file.index not in spans:
+                    self._error(f"Lỗi (trùng với bản ghi lỗi): {job[2]}")
+                elif pdf_file:
+                    try:
+                        started = time.perf_counter()
+                        keep = seq in self.kept_seqs
+                        start = merger.page_count
+                        # Khóa theo công cụ đã tạo trang (trang từ cache/file tổng cũ: khóa tra cứu)
+                        key = self.produced_keys.pop(seq, None)
+                        if isinstance(pdf_file, RepeatedJob):
+                            page_ids, key = spans[pdf_file.index]
+                            pages = merger.repeat(page_ids)
+                        else:
+                            if key is None and (keep or self.manifest is not None):
+                                key = self.cache_key(job)
+                            if isinstance(pdf_file, tuple):
+                                # (reader, [trang]) = trang chép từ file tổng cũ
+                                pages = merger.append(*pdf_file, keep=keep)
+                            else:
+                                pages = merger.append(pdf_file, keep=keep)
+                        if keep:
+                            spans[seq] = (merger.page_ids[start:], key)
+                        if self.metrics is not None:
+                            self.metrics.add("merge", time.perf_counter() - started, job[2])
+                        self._count('merged', len(job[1]) if isinstance(job[1], list) else 1)
+                        if self.manifest is not None:
+                            self.manifest.record(key, job[1], pages)
+                    except Exception as e:
+                        self._error(f"Lỗi khi gộp {job[2]}: {e}")
+                if from_cache and isinstance(pdf_file, str) and self.page_cache is not None:
+                    self.page_cache.release(pdf_file)
+                for path in (job[0], None if from_cache else pdf_file):
+                    try:
+                        if isinstance(path, str) and os.path.exists(path):
+                            os.remove(path)
+                    except Exception as e:
+                        # vd. file còn bị Word khóa trên Windows: bỏ qua, thư mục tạm được xóa cuối job
+                        self.log(f"Lỗi khi xóa {path}: {e}")
+
+class BatchSizeTuner:
+    """Tự điều chỉnh kích thước batch theo thời gian chuyển đổi trung bình mỗi file"""
+    
+    def __init__(self, initial=10, minimum=1, maximum=50, enabled=True):
+        self.minimum = max(1, int(minimum))
+        self.maximum = max(self.minimum, int(maximum))
+        self.batch_size = min(self.maximum, max(self.minimum, int(initial)))
+        self.enabled = enabled
+        self.direction = 1
+        self.history = {}  # kích thước batch -> giây/file
+    
+    def record(self, size, elapsed):
+        """Ghi nhận thời gian của một batch và chọn kích thước cho batch kế tiếp"""
+        per_file = elapsed / max(size, 1)
+        previous = self.history.get(size)
+        self.history[size] = per_file if previous is None else (previous + per_file) / 2
+        if not self.enabled:
+            return
+        
+        best_size = min(self.history, key=self.history.get)
+        best = self.history[best_size]
+        if size == best_size:
+            # Đang là kích thước tốt nhất: thử tiếp theo hướng hiện tại
+            candidate = size * 2 if self.direction > 0 else size // 2
+        else:
+            # Chậm hơn: đổi hướng và quay lại kích thước tốt nhất
+            self.direction = -self.direction
+            candidate = best_size
+        candidate = min(self.maximum, max(self.minimum, candidate))
+        # Không thử lại kích thước đã đo là chậm hơn rõ rệt (>10%)
+        if candidate in self.history and self.history[candidate] > best * 1.1:
+            candidate = best_size
+        self.batch_size = candidate
+
+class RunMetrics:
+    """Thời gian từng giai đoạn và từng lần gọi công cụ chuyển đổi của một lần chạy.
+    
+    Mỗi giai đoạn giữ số lần, tổng/lớn nhất và histogram theo ms; giữ thêm các bản ghi chậm
+    nhất. Dùng được từ nhiều thread (pipeline), kết quả ghi ra file JSON cạnh file PDF tổng.
+    """
+    
+    BUCKETS_MS = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+    
+    def __init__(self, slowest=10):
+        self.started = time.time()
+        self.elapsed = None
+        self.status = None
+        self.stages = {}
+        self.conversions = {}
+        self.tool_health = None  # ToolHealth.snapshot() của công cụ chuyển đổi khi kết thúc
+        self.slowest = []
+        self.max_slowest = slowest
+        self.lock = threading.Lock()
+    
+    def add(self, name, seconds, label=None):
+        """Ghi nhận một lần của giai đoạn name (label: bản ghi/file, dùng cho danh sách chậm nhất)"""
+        ms = seconds * 1000
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                stage = self.stages[name] = {"count": 0, "seconds": 0.0, "max_ms": 0.0,
+                                             "histogram": [0] * (len(self.BUCKETS_MS) + 1)}
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max_ms"] = max(stage["max_ms"], ms)
+            stage["histogram"][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            if label is not None:
+                heapq.heappush(self.slowest, (ms, name, str(label)))
+                if len(self.slowest) > self.max_slowest:
+                    heapq.heappop(self.slowest)
+    
+    @contextlib.contextmanager
+    def stage(self, name, label=None):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started, label)
+    
+    def timed_iter(self, name, iterable):
+        """Bọc iterable, ghi thời gian của mỗi lần lấy phần tử (vd. đọc từng khối Excel)"""
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add(name, time.perf_counter() - started)
+            yield item
+    
+    def conversion(self, tool, seconds, results, fallback=False):
+        """Ghi nhận một lần gọi công cụ chuyển đổi (results: kết quả của từng file, None = lỗi)"""
+        produced = 0
+        for result in results:
+            try:
+                if result:
+                    produced += os.path.getsize(result)
+            except OSError:
+                pass
+        with self.lock:
+            stats = self.conversions.setdefault(tool, {"calls": 0, "files": 0, "failed": 0, "fallback_calls": 0,
+                                                       "seconds": 0.0, "bytes": 0})
+            stats["calls"] += 1
+            stats["files"] += len(results)
+            stats["failed"] += sum(1 for result in results if not result)
+            stats["fallback_calls"] += 1 if fallback else 0
+            stats["seconds"] += seconds
+            stats["bytes"] += produced
+    
+    def finish(self, status):
+        self.elapsed = time.time() - self.started
+        self.status = status
+    
+    def to_dict(self):
+        labels = [f"<={bucket}ms" for bucket in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        with self.lock:
+            stages = {
+                name: {"count": stage["count"], "seconds": round(stage["seconds"], 3),
+                       "mean_ms": round(stage["seconds"] * 1000 / stage["count"], 2),
+                       "max_ms": round(stage["max_ms"], 2),
+                       "histogram": {label: n for label, n in zip(labels, stage["histogram"]) if n}}
+                for name, stage in self.stages.items()
+            }
+            conversions = {tool: dict(stats, seconds=round(stats["seconds"], 3))
+                           for tool, stats in self.conversions.items()}
+            slowest = [{"stage": name, "record": label, "ms": round(ms, 2)}
+                       for ms, name, label in sorted(self.slowest, reverse=True)]
+        return {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "elapsed_seconds": round(self.elapsed if self.elapsed is not None else time.time() - self.started, 3),
+            "status": self.status,
+            "stages": stages,
+            "conversions": conversions,
+            "tool_health": self.tool_health,
+            "slowest": slowest,
+        }
+    
+    def summary_lines(self):
+        """Các dòng tóm tắt cho log"""
+        data = self.to_dict()
+        lines = [f"⏱ Tổng thời gian: {data['elapsed_seconds']:.1f}s"]
+        for name, stage in sorted(data["stages"].items(), key=lambda item: -item[1]["seconds"]):
+            lines.append(f"⏱ {name}: {stage['count']} lần, {stage['seconds']:.2f}s "
+                         f"(TB {stage['mean_ms']:.0f}ms, max {stage['max_ms']:.0f}ms)")
+        for tool, stats in data["conversions"].items():
+            lines.append(f"⏱ {tool}: {stats['calls']} lần gọi, {stats['files']} file, {stats['failed']} lỗi, "
+                         f"{stats['fallback_calls']} lần fallback, {stats['seconds']:.2f}s, "
+                         f"{stats['bytes'] / 1024:.0f} KB")
+        for tool, health in (data["tool_health"] or {}).items():
+            if health["open"]:
+                lines.append(f"⛔ {tool} đang bị tạm ngưng sau {health['failures']} lần lỗi")
+        if data["slowest"]:
+            top = data["slowest"][0]
+            lines.append(f"⏱ Chậm nhất: {top['stage']} {top['record']} ({top['ms']:.0f}ms)")
+        return lines
+    
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, ensure_ascii=False)
+        return path
+
+class ConfigManager:
+    def __init__(self, config_file="config.json"):
+        self.config_file = config_file
+        self.default_config = {
+            "a4_excel_file": "A4-Auto.xlsx",
+            "a4_word_template": "A4-Auto.docx",
+            "a5_excel_file": "A5-AUTO.xlsx",
+            "a5_word_template": "A5-AUTO.docx",
+            "output_folder": "In_PDF",
+            "libreoffice_path": r"C:\\Program Files\\LibreOffice\\program\\soffice.exe",
+            "batch_size": 10,
+            "default_format": "A5",  # A4 hoặc A5
+            "preferred_tool": "",  # ''=auto; 'docx2pdf', 'libreoffice_server' hoặc 'libreoffice'
+            "lo_server_instances": 1,  # Số LibreOffice chạy nền cho 'libreoffice_server'
+            "render_workers": 1,  # Số process render Word; 1 = tuần tự (mặc định), 0 = số nhân CPU
+            "excel_streaming": True,  # Đọc Excel theo khối (openpyxl read-only) thay vì cả file
+            "excel_chunk_rows": 1000,
+            "pipeline": False,  # Chạy render / chuyển đổi / gộp chồng lấp thay vì từng giai đoạn
+            "render_queue_depth": 16,  # Số file đang render tối đa trong pipeline
+            "convert_queue_depth": 16,  # Số file Word chờ chuyển đổi tối đa trong pipeline
+            "convert_workers": 1,  # Số thread chuyển đổi PDF trong pipeline
+            "scratch_folder": "",  # Thư mục file tạm; '' = thư mục tạm của hệ thống (vd. /dev/shm, RAM disk)
+            "page_cache": True,  # Dùng lại trang PDF đã tạo ở lần chạy trước nếu dữ liệu không đổi
+            "page_cache_folder": "",  # '' = thư mục cache của người dùng; đường dẫn tương đối tính từ thư mục đó
+            "page_cache_max_mb": 500,
+            "delta_mode": False,  # Chép trang không đổi từ file tổng lần trước (theo manifest)
+            "delta_changes_pdf": False,  # Xuất thêm file *-Thay-Doi.pdf chỉ gồm trang thay đổi (cần delta_mode)
+            "dedup_records": True,  # Dòng trùng nội dung chỉ render một lần, dùng lại trang trong file tổng
+            "pdf_optimize": True,  # Font/hình/XObject giống nhau giữa các trang chỉ ghi một lần; nén stream chưa nén
+            "pdf_linearize": False,  # Linearize file PDF xuất ra bằng qpdf (trang đầu hiện nhanh)
+            "qpdf_path": "",  # Đường dẫn qpdf; '' = tìm trong PATH
+            "imposition": "",  # Xếp trang lên tờ in: "" (tắt), "2up", "4up", "8up" hoặc "CỘTxHÀNG"
+            "imposition_sheet": "A4",  # Khổ tờ in: A3, A4, A5
+            "imposition_margin_mm": 5,
+            "imposition_gap_mm": 0,
+            "imposition_cut_marks": True,
+            "metrics_file": False,  # Ghi *.metrics.json (thời gian từng giai đoạn) cạnh file PDF tổng
+            "profile": False,  # Bật cProfile cho cả lần chạy, ghi *.prof cạnh file PDF tổng
+            "log_max_lines": 2000,  # Số dòng log giữ trong cửa sổ (dòng cũ hơn bị bỏ)
+            "log_file": "",  # Ghi toàn bộ log ra file này; '' = không ghi
+            "breaker_failures": 3,  # Số lần lỗi liên tiếp trước khi tạm ngưng một công cụ chuyển đổi
+            "breaker_cooldown": 60,  # Giây tạm ngưng trước khi cho công cụ đó thử lại một file
+            "render_engine": "word",  # 'word', 'overlay' (template làm nền + vẽ chữ) hoặc 'native' (vẽ thẳng ra PDF)
+            "native_layout_a4": "",  # File layout JSON cho 'native'; '' = layout mặc định
+            "native_layout_a5": "",
+            "render_mode": "per_record",  # 'per_record' hoặc 'single_document' (nhiều trang/file)
+            "single_document_chunk": 200,  # Số trang tối đa mỗi file Word ở chế độ single_document
+            "auto_batch_size": True,  # Tự điều chỉnh batch_size theo thời gian đo được
+            "max_batch_size": 50,
+            "conversion_timeout": 60,  # Giây tối đa cho mỗi file trước khi coi là treo
+            "conversion_job_timeout": 0,  # Giây tối đa cho toàn bộ bước chuyển đổi của một job; 0 = không giới hạn
+            "lo_parallel": 0,  # Số lệnh soffice chạy song song cho 'libreoffice'; 0 = số nhân CPU
+            "lo_profile_folder": ""  # Thư mục profile LibreOffice của từng slot; '' = thư mục tạm hệ thống
+        }
+        self.config = self.load_config()
+    
+    def load_config(self):
+        try:
+            if os.path.exists(self.config_file):
+                with open(self.config_file, 'r', encoding='utf-8') as f:
+                    return {**self.default_config, **json.load(f)}
+            else:
+                self.save_config(self.default_config)
+                return self.default_config
+        except Exception as e:
+            print(f"Lỗi khi đọc config: {e}")
+            return self.default_config
+    
+    def save_config(self, config):
+        try:
+            with open(self.config_file, 'w', encoding='utf-8') as f:
+                json.dump(config, f, indent=2, ensure_ascii=False)
+        except Exception as e:
+            print(f"Lỗi khi lưu config: {e}")
+    
+    def update_config(self, key, value):
+        self.config[key] = value
+        self.save_config(self.config)
+
+class ProgressTracker:
+    def __init__(self, total_steps):
+        self.total_steps = total_steps
+        self.current_step = 0
+    
+    def update(self, step=1):
+        self.current_step += step
+    
+    def get_progress(self):
+        return (self.current_step / self.total_steps) * 100 if self.total_steps > 0 else 0
+
+class StatusValue:
+    """Giá trị tiến trình/trạng thái khi chạy không có GUI (cùng giao diện .set/.get với biến tkinter)"""
+    
+    def __init__(self, value=None):
+        self.value = value
+    
+    def set(self, value):
+        self.value = value
+    
+    def get(self):
+        return self.value
+
+class PriceJobRunner:
+    """Chạy một job bảng giá (đọc Excel → Word → PDF → gộp), không phụ thuộc GUI.
+    
+    GUI và chế độ dòng lệnh dùng chung lớp này. Tiến trình báo qua progress_var/status_var
+    (biến tkinter hoặc StatusValue) và hàm log.
+    """
+    
+    FORMATS = {
+        "A4": {"excel": "a4_excel_file", "template": "a4_word_template", "layout": "native_layout_a4",
+               "promo_column": "GiaKM",
+               "output_name": "A4-Auto-Tong.pdf", "records_per_page": 1,
+               "description": "một sản phẩm/trang"},
+        "A5": {"excel": "a5_excel_file", "template": "a5_word_template", "layout": "native_layout_a5",
+               "promo_column": "GiaKm",
+               "output_name": "A5-Auto-Tong.pdf", "records_per_page": 2,
+               "description": "hai sản phẩm/trang"},
+    }
+    
+    def __init__(self, converter, log=print, progress_var=None, status_var=None):
+        self.converter = converter
+        self.log = log
+        self.progress_var = progress_var if progress_var is not None else StatusValue(0)
+        self.status_var = status_var if status_var is not None else StatusValue("")
+        self.render_executor = None
+        self.errors = []
+        self.reused_pages = 0
+        self.imposed_pdf = None
+        self.metrics = RunMetrics()
+        self.metrics_file = None
+        self.work_dir = None  # Thư mục tạm của job (None = dùng thư mục xuất)
+        self.document_rows = {}  # File Word nhiều bản ghi (single_document) -> mô tả từng dòng
+        self.profilers = None  # cProfile của các thread pipeline khi bật profile
+    
+    def run_format(self, format_name, config):
+        """Xử lý định dạng A4 hoặc A5, trả về đường dẫn file PDF tổng.
+        
+        Đo thời gian từng giai đoạn (RunMetrics) và ghi ra *.metrics.json cạnh file tổng;
+        config 'profile' bật cProfile cho cả lần chạy (process chính, kể cả các thread của pipeline).
+        """
+        self.metrics = RunMetrics()
+        if self.converter is not None:
+            self.converter.metrics = self.metrics
+            self.converter.log = self.log
+            job_timeout = float(config.get('conversion_job_timeout', 0) or 0)
+            self.converter.deadline = time.monotonic() + job_timeout if job_timeout > 0 else None
+        profiler = None
+        self.profilers = None
+        if config.get('profile'):
+            import cProfile
+            profiler = cProfile.Profile()
+            self.profilers = []
+            profiler.enable()
+        status = "error"
+        try:
+            merged_pdf = self._run_format(format_name, config)
+            status = "partial" if self.errors else "ok"
+            return merged_pdf
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            self.metrics.finish(status)
+            self.report_metrics(config, self.FORMATS[format_name]['output_name'], profiler)
+    
+    def report_metrics(self, config, output_name, profiler=None):
+        """Tóm tắt thời gian vào log, ghi *.metrics.json (và *.prof nếu bật profile) cạnh file tổng"""
+        try:
+            health = getattr(self.converter, 'health', None)
+            if health is not None:
+                self.metrics.tool_health = health.snapshot()
+            for line in self.metrics.summary_lines():
+                self.log(line)
+            if not os.path.isdir(config['output_folder']):
+                return
+            stem = os.path.join(config['output_folder'], os.path.splitext(output_name)[0])
+            if config.get('metrics_file', False):
+                self.metrics_file = self.metrics.save(stem + ".metrics.json")
+                self.log(f"Đã lưu số liệu thời gian: {self.metrics_file}")
+            if profiler is not None:
+                import pstats
+                report = io.StringIO()
+                # Gộp profile của thread chính với profile của các thread pipeline
+                stats = pstats.Stats(profiler, *(self.profilers or []), stream=report)
+                stats.dump_stats(stem + ".prof")
+                stats.sort_stats("cumulative").print_stats(20)
+                self.log(f"Đã lưu profile: {stem}.prof (xem bằng snakeviz hoặc python -m pstats)")
+                self.log(report.getvalue())
+        except Exception as e:
+            self.log(f"Không ghi được số liệu thời gian: {e}")
+    
+    def _run_format(self, format_name, config):
+        spec = self.FORMATS[format_name]
+        excel_file = config[spec['excel']]
+        template_path = config[spec['template']]
+        engine = config.get('render_engine', 'word')
+        native = engine == 'native'
+        try:
+            self.log(f"Đang xử lý định dạng {format_name}...")
+            self.log(f"File Excel: {excel_file}")
+            if native:
+                self.log(f"Layout: {config.get(spec['layout']) or 'mặc định'} (vẽ trực tiếp ra PDF)")
+            else:
+                self.log(f"Template: {template_path}")
+            self.log(f"Thư mục xuất: {config['output_folder']}")
+            
+            # Kiểm tra file tồn tại
+            if not os.path.exists(excel_file):
+                raise FileNotFoundError(f"Không tìm thấy file Excel {format_name}: {excel_file}")
+            if not native and not os.path.exists(template_path):
+                raise FileNotFoundError(f"Không tìm thấy template {format_name}: {template_path}")
+            
+            # Tạo thư mục xuất
+            os.makedirs(config['output_folder'], exist_ok=True)
+            
+            # Đọc Excel theo từng khối, render ngay khi có khối đầu tiên
+            self.log(f"Đang đọc file Excel {format_name}...")
+            reader = self.open_excel(excel_file, config, spec['promo_column'])
+            estimated_rows = reader.estimated_rows or 0
+            reader = self.metrics.timed_iter("excel_read", reader)
+            
+            # Tính toán tổng số bước
+            total_steps = estimated_rows // spec['records_per_page'] + 2  # Word + PDF + Merge
+            self.progress_tracker = ProgressTracker(total_steps)
+            
+            build_jobs = self.build_a4_jobs if format_name == "A4" else self.build_a5_jobs
+            if native:
+                merged_pdf = self.run_native(reader, build_jobs, format_name, config, spec['output_name'])
+                self.impose_output(merged_pdf, config)
+                self.log("Hoàn thành! File PDF đã được tạo thành công!")
+                self.status_var.set("Hoàn thành")
+                self.progress_var.set(100)
+                return merged_pdf
+            
+            self.work_dir = self.create_work_dir(config)
+            self.document_rows = {}
+            try:
+                if engine == 'overlay':
+                    # Chuyển đổi template một lần làm nền, chỉ vẽ chữ cho từng bản ghi
+                    merged_pdf = self.run_overlay(reader, build_jobs, template_path, format_name, config,
+                                                  spec['output_name'])
+                elif config.get('pipeline'):
+                    # Render, chuyển đổi và gộp chạy chồng lấp qua các hàng đợi có giới hạn
+                    merged_pdf = self.run_pipeline(reader, build_jobs, template_path, config, spec['output_name'])
+                else:
+                    merged_pdf = self.run_phases(reader, build_jobs, template_path, config,
+                                                 spec['output_name'], format_name)
+            finally:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                self.work_dir = None
+            
+            self.impose_output(merged_pdf, config)
+            self.log("Hoàn thành! File PDF đã được gộp thành công!")
+            self.status_var.set("Hoàn thành")
+            self.progress_var.set(100)
+            return merged_pdf
+            
+        except Exception as e:
+            self.log(f"Lỗi xử lý {format_name}: {str(e)}")
+            raise
+    
+    def impose_output(self, merged_pdf, config):
+        """Xếp các trang của file tổng lên tờ in theo cấu hình imposition (vd. A4-Auto-Tong-2x1.pdf)"""
+        self.imposed_pdf = None
+        imposer = PageImposer.from_config(config)
+        if imposer is None:
+            return None
+        self.status_var.set("Đang xếp trang lên tờ in...")
+        imposed_pdf = os.path.splitext(merged_pdf)[0] + f"-{imposer.columns}x{imposer.rows}.pdf"
+        with self.metrics.stage("imposition"):
+            sheets = imposer.impose(merged_pdf, imposed_pdf, self.log)
+        self.log(f"Đã xếp {imposer.per_sheet} trang/tờ: {sheets} tờ → {imposed_pdf}")
+        self.imposed_pdf = imposed_pdf
+        return imposed_pdf
+    
+    def run_native(self, reader, build_jobs, format_name, config, output_name, layout=None):
+        """Vẽ mọi trang thẳng vào file PDF tổng (NativePriceRenderer): không Word, không chuyển đổi, không gộp"""
+        if layout is None:
+            layout = NativePriceRenderer.load_layout(config.get(self.FORMATS[format_name]['layout']), format_name)
+        renderer = NativePriceRenderer(layout)
+        output_path = os.path.join(config['output_folder'], output_name)
+        labels = {}
+        done = 0
+        last_page = time.perf_counter()
+        
+        def contexts():
+            for df in reader:
+                with self.metrics.stage("context_build"):
+                    jobs = build_jobs(df, config)
+                for _, context, row_label in jobs:
+                    labels[id(context)] = row_label
+                    yield context
+        
+        def on_page(context, exc):
+            nonlocal done, last_page
+            row_label = labels.pop(id(context), "")
+            now = time.perf_counter()
+            self.metrics.add("native_render", now - last_page, row_label)
+            last_page = now
+            if exc is not None:
+                error_msg = f"Lỗi khi xử lý {row_label}: {exc}"
+                self.errors.append(error_msg)
+                self.log(f"Lỗi: {error_msg}")
+                return
+            done += 1
+            self.progress_tracker.update()
+            if done % 50 == 0:
+                self.progress_var.set(self.progress_tracker.get_progress())
+                self.status_var.set(f"Đang vẽ trang PDF... {done}")
+        
+        self.log(f"Đang vẽ trang PDF {format_name}...")
+        pages = renderer.render(contexts(), output_path, on_page)
+        if not pages:
+            raise Exception("Không tạo được trang PDF nào")
+        self.log(f"Đã tạo {pages} trang PDF: {output_path}")
+        return output_path
+    
+    def run_overlay(self, reader, build_jobs, template_path, format_name, config, output_name):
+        """Template Word → một trang PDF nền (một lần chuyển đổi); mỗi bản ghi chỉ vẽ chữ theo layout
+        rồi đặt lên trang nền dùng chung (Form XObject: font, logo của nền chỉ ghi một lần)"""
+        from pypdf import PdfReader
+        with self.metrics.stage("background"):
+            background = self.prepare_background(template_path, format_name, config)
+        background_page = PdfReader(background).pages[0]
+        
+        # Chỉ vẽ các ô dữ liệu; khung và chữ cố định đã có trong template
+        layout = NativePriceRenderer.load_layout(config.get(self.FORMATS[format_name]['layout']), format_name)
+        layout["boxes"] = [box for box in layout["boxes"] if "field" in box]
+        layout["page_size"] = [float(background_page.mediabox.width) / 72 * 25.4,
+                               float(background_page.mediabox.height) / 72 * 25.4]
+        text_config = {**config, 'output_folder': self.work_dir}
+        text_pdf = self.run_native(reader, build_jobs, format_name, text_config, "text-" + output_name, layout)
+        
+        self.log("Đang đặt chữ lên trang nền...")
+        output_path = os.path.join(config['output_folder'], output_name)
+        merger = StreamingPdfMerger.from_config(output_path, config, self.log)
+        try:
+            with self.metrics.stage("overlay_merge"):
+                form_id = merger.add_background(background)
+                merger.append(text_pdf, background=form_id)
+        except Exception:
+            merger.abort()
+            raise
+        merger.close()
+        self.log(f"Đã tạo {merger.page_count} trang PDF: {output_path}")
+        return output_path
+    
+    def prepare_background(self, template_path, format_name, config):
+        """PDF nền: template render với mọi trường để trống, chuyển đổi một lần (có dùng cache trang)"""
+        blank = {key: "" for key in PRICE_FIELDS}
+        if self.FORMATS[format_name]['records_per_page'] == 2:
+            blank.update({f"{key}1": "" for key in PRICE_FIELDS})
+        page_cache = self.get_page_cache(config)
+        job = (os.path.join(self.work_dir, "temp_background.docx"), blank, "trang nền")
+        key = self.page_cache_key(job, template_path) if page_cache else None
+        cached = page_cache.get(key) if page_cache else None
+        if cached:
+            self.log("Dùng trang nền từ cache")
+            return cached
+        
+        self.log("Đang chuyển đổi template thành trang nền...")
+        render_word_file(template_path, blank, job[0])
+        background = self.converter.convert_to_pdf(job[0])
+        if not background:
+            raise Exception(f"Không chuyển đổi được template thành PDF: {template_path}")
+        if page_cache:
+            try:
+                page_cache.put(self.page_cache_key(job, template_path, self.converter.producer_of(background)),
+                               background)
+            except Exception as e:
+                self.log(f"Không lưu được cache trang: {e}")
+        return background
+    
+    def create_work_dir(self, config):
+        """Thư mục tạm cho file Word/PDF trung gian, tách khỏi thư mục xuất (có thể nằm trên ổ mạng).
+        
+        scratch_folder rỗng = thư mục tạm của hệ thống; có thể trỏ tới RAM disk (vd. /dev/shm).
+        """
+        scratch_folder = config.get('scratch_folder') or None
+        if scratch_folder:
+            os.makedirs(scratch_folder, exist_ok=True)
+        work_dir = tempfile.mkdtemp(prefix="autoprice_", dir=scratch_folder)
+        self.log(f"Thư mục tạm: {work_dir}")
+        return work_dir
+    
+    def open_excel(self, path, config, promo_column):
+        """Mở file Excel để đọc theo khối, chỉ lấy các cột template sử dụng"""
+        columns = [promo_column if c == "GiaKM" else c for c in PRICE_FIELDS]
+        reader = ExcelChunkReader(path, columns,
+                                  chunk_rows=config.get('excel_chunk_rows', 1000),
+                                  streaming=config.get('excel_streaming', True))
+        if reader.estimated_rows:
+            self.log(f"Sheet có khoảng {reader.estimated_rows} dòng dữ liệu")
+        return reader
+    
+    def run_phases(self, reader, build_jobs, template_path, config, output_name, label):
+        """Chạy tuần tự từng giai đoạn: render tất cả, chuyển đổi tất cả, rồi gộp"""
+        page_cache = self.get_page_cache(config)
+        manifest = self.open_manifest(config, output_name, template_path)
+        try:
+            return self._run_phases(reader, build_jobs, template_path, config, output_name, label,
+                                    page_cache, manifest)
+        finally:
+            if manifest:
+                manifest.close()
+    
+    def _run_phases(self, reader, build_jobs, template_path, config, output_name, label, page_cache, manifest):
+        # Xử lý tạo file Word (trang có sẵn trong file tổng cũ/cache thì bỏ qua)
+        self.log(f"Đang tạo file Word {label}...")
+        entries = []  # [job, PDF lấy từ cache / RepeatedJob hoặc None] theo đúng thứ tự trang
+        word_files = []
+        total_rows = 0
+        first_entry = {} if config.get('dedup_records', True) else None  # nội dung -> vị trí job gốc
+        for df in reader:
+            total_rows += len(df)
+            to_render = []
+            for job in self.build_render_jobs(build_jobs, df, config):
+                cached = None
+                if first_entry is not None or page_cache or manifest:
+                    key = self.page_cache_key(job, template_path)
+                if first_entry is not None:
+                    if key in first_entry:
+                        # Trùng nội dung với một job trước: không render, dùng lại trang của job gốc
+                        entries.append((job, RepeatedJob(first_entry[key])))
+                        self.progress_tracker.update(len(job[1]) if isinstance(job[1], list) else 1)
+                        continue
+                    first_entry[key] = len(entries)
+                if page_cache or manifest:
+                    cached = manifest.reuse(key) if manifest else None
+                    if cached is None and page_cache:
+                        cached = page_cache.get(key)
+                entries.append((job, cached))
+                if cached is None:
+                    to_render.append(job)
+                else:
+                    self.progress_tracker.update(len(job[1]) if isinstance(job[1], list) else 1)
+            word_files.extend(self.render_word_files(to_render, template_path, config, label, self.errors))
+        self.log(f"Đã đọc {total_rows} dòng dữ liệu")
+        
+        repeated_count = sum(1 for _, cached in entries if isinstance(cached, RepeatedJob))
+        cached_count = sum(1 for _, cached in entries if cached) - repeated_count
+        self.reused_pages += cached_count
+        if not word_files and not cached_count:
+            raise Exception("Không tạo được file Word nào")
+        
+        self.log(f"Đã tạo {len(word_files)} file Word")
+        if page_cache or manifest:
+            self.log(f"Dùng lại {cached_count} trang không đổi")
+        if repeated_count:
+            self.log(f"Bỏ qua {repeated_count} bản ghi trùng nội dung (dùng lại trang đã tạo)")
+        
+        # Chuyển đổi PDF
+        self.log("Đang chuyển đổi sang PDF...")
+        converted = {}
+        self.convert_to_pdf_batched(word_files, config, converted)
+        self.errors.extend(f"Lỗi chuyển đổi: {os.path.basename(f)}" for f in word_files if f not in converted)
+        
+        pdf_files = []
+        merged_jobs = []  # (job, khóa nội dung theo công cụ đã tạo trang)
+        positions = {}  # vị trí trong entries -> vị trí trong pdf_files
+        for index, (job, cached) in enumerate(entries):
+            if isinstance(cached, RepeatedJob):
+                if cached.index in positions:
+                    pdf_files.append(RepeatedJob(positions[cached.index]))
+                    merged_jobs.append((job, merged_jobs[positions[cached.index]][1]))
+                else:
+                    self.errors.append(f"Lỗi (trùng với bản ghi lỗi): {job[2]}")
+                continue
+            pdf_file = cached or converted.get(job[0])
+            if not pdf_file:
+                continue
+            if cached:
+                key = self.page_cache_key(job, template_path)
+            else:
+                key = self.page_cache_key(job, template_path, self.converter.producer_of(pdf_file))
+                if page_cache:
+                    try:
+                        page_cache.put(key, pdf_file)
+                    except Exception as e:
+                        self.log(f"Không lưu được cache trang: {e}")
+            positions[index] = len(pdf_files)
+            pdf_files.append(pdf_file)
+            merged_jobs.append((job, key))
+        
+        if not pdf_files:
+            raise Exception("Không chuyển đổi được file PDF nào")
+        
+        self.log(f"Đã chuyển đổi {len(converted)} file PDF")
+        
+        # Gộp PDF
+        self.log("Đang gộp file PDF...")
+        page_counts = []
+        merged_pdf = self.merge_pdfs(pdf_files, config['output_folder'], output_name, page_counts, config)
+        if manifest:
+            for (job, key), pages in zip(merged_jobs, page_counts):
+                manifest.record(key, job[1], pages)
+            self.finish_manifest(manifest, config, output_name)
+        
+        # Dọn dẹp (không xóa file trong cache, chỉ cho phép cache dọn các trang đã gộp)
+        if page_cache:
+            for _, cached in entries:
+                if isinstance(cached, str):
+                    page_cache.release(cached)
+        self.cleanup_files(word_files + list(converted.values()))
+        return merged_pdf
+    
+    @staticmethod
+    def get_page_cache(config):
+        """PageCache theo config, hoặc None nếu tắt"""
+        if not config.get('page_cache', True):
+            return None
+        return PageCache(PriceJobRunner.page_cache_folder(config),
+                         int(config.get('page_cache_max_mb', 500)) * 1024 * 1024)
+    
+    @staticmethod
+    def page_cache_folder(config):
+        """Thư mục cache trang; đường dẫn tương đối nằm trong thư mục cache của người dùng
+        (%LOCALAPPDATA% hoặc thư mục tạm), không theo thư mục đang chạy - exe có thể được mở từ ổ mạng"""
+        base = os.path.join(os.environ.get('LOCALAPPDATA') or tempfile.gettempdir(), "AUTO-PRICE")
+        return os.path.join(base, config.get('page_cache_folder') or "page_cache")
+    
+    def open_manifest(self, config, output_name, template_path):
+        """RunManifest cho file tổng (đã đọc manifest lần trước nếu còn khớp), hoặc None nếu tắt delta_mode"""
+        if not config.get('delta_mode', False):
+            return None
+        manifest = RunManifest(os.path.join(config['output_folder'], output_name), self.work_dir,
+                               TEMPLATE_CACHE.get(template_path).digest)
+        if manifest.load():
+            self.log(f"Chế độ delta: dùng lại trang không đổi từ {output_name} lần trước")
+        return manifest
+    
+    def finish_manifest(self, manifest, config, output_name):
+        """Ghi manifest mới, báo thay đổi so với lần trước và xuất file chỉ gồm trang thay đổi"""
+        manifest.save()
+        if not manifest.loaded:
+            return
+        changed, added, removed = manifest.diff()
+        self.log(f"So với lần trước: {changed} mã thay đổi, {added} mã thêm mới, {removed} mã bị xóa")
+        
+        changes_pdf = os.path.join(config['output_folder'],
+                                   os.path.splitext(output_name)[0] + "-Thay-Doi.pdf")
+        if os.path.exists(changes_pdf):
+            os.remove(changes_pdf)
+        pages = manifest.changed_pages()
+        if not config.get('delta_changes_pdf', False) or not pages:
+            return
+        merger = StreamingPdfMerger.from_config(changes_pdf, config, self.log)
+        try:
+            merger.append(manifest.output_path, pages)
+        except Exception:
+            merger.abort()
+            raise
+        merger.close()
+        self.log(f"Đã lưu {len(pages)} trang thay đổi: {changes_pdf}")
+    
+    def page_cache_key(self, job, template_path, tool=None):
+        """Khóa nội dung của job; tool = công cụ đã tạo PDF (mặc định công cụ hiện tại, dùng khi tra cứu)"""
+        return PageCache.make_key(TEMPLATE_CACHE.get(template_path).digest, job[1],
+                                  self.converter.tool_signature(tool))
+    
+    def run_pipeline(self, reader, build_jobs, template_path, config, output_name):
+        """Chạy render → chuyển đổi → gộp chồng lấp nhau (StagedPipeline)"""
+        workers = int(config.get('render_workers', 1)) or (os.cpu_count() or 1)
+        own_executor = None
+        if workers > 1:
+            executor = self.get_render_executor(workers)
+        else:
+            # Render trên một thread riêng để vẫn chạy song song với bước chuyển đổi
+            executor = own_executor = ThreadPoolExecutor(max_workers=1)
+        with self.metrics.stage("template_load"):
+            TEMPLATE_CACHE.get(template_path)
+        
+        def jobs():
+            for df in reader:
+                yield from self.build_render_jobs(build_jobs, df, config)
+        
+        page_cache = self.get_page_cache(config)
+        manifest = self.open_manifest(config, output_name, template_path)
+        render_func = timed_render_job
+        if self.profilers is not None and own_executor is not None:
+            # Render trên thread riêng: profile từng lần render (process pool con không được profile)
+            render_func = profiled(timed_render_job, self.profilers)
+        pipeline = StagedPipeline(self.converter, executor, template_path, config,
+                                  log=self.log, on_progress=self.on_pipeline_progress,
+                                  render_func=render_func, page_cache=page_cache,
+                                  cache_key=lambda job, tool=None: self.page_cache_key(job, template_path, tool),
+                                  manifest=manifest, metrics=self.metrics, row_labels=self.document_rows,
+                                  profilers=self.profilers)
+        try:
+            merged_pdf = pipeline.run(jobs(), os.path.join(config['output_folder'], output_name))
+            
+            self.errors.extend(pipeline.errors)
+            self.reused_pages += pipeline.counts['cached']
+            if pipeline.errors:
+                self.log(f"Có {len(pipeline.errors)} lỗi xảy ra")
+            if page_cache or manifest:
+                self.log(f"Dùng lại {pipeline.counts['cached']} trang không đổi")
+            if pipeline.counts['duplicates']:
+                self.log(f"Bỏ qua {pipeline.counts['duplicates']} bản ghi trùng nội dung (dùng lại trang đã tạo)")
+            if not merged_pdf:
+                raise Exception("Không tạo được trang PDF nào")
+            self.log(f"Đã gộp {pipeline.counts['merged']} file PDF thành: {merged_pdf}")
+            self.log_merge_savings(pipeline.merger)
+            if manifest:
+                self.finish_manifest(manifest, config, output_name)
+        finally:
+            if own_executor is not None:
+                own_executor.shutdown()
+            if manifest:
+                manifest.close()
+        return merged_pdf
+    
+    def on_pipeline_progress(self, counts):
+        """Cập nhật tiến trình từ StagedPipeline"""
+        total = max(self.progress_tracker.total_steps, counts['rendered'], 1)
+        self.progress_var.set(min(100, counts['merged_records'] * 100 / total))
+        self.status_var.set(f"Render {counts['rendered']} | PDF {counts['converted']} | Đã gộp {counts['merged']}")
+    
+    def build_a4_jobs(self, df, config):
+        """Danh sách job A4 (temp_word_file, context, mô tả dòng) cho một khối dữ liệu"""
+        # Context được tính sẵn theo cột cho cả khối
+        contexts = prepare_a4_contexts(df)
+        return [
+            (os.path.join(self.work_dir or config['output_folder'], f"temp_output_{i + 1}.docx"), context,
+             f"dòng {i+1}")
+            for i, context in zip(df.index, contexts)
+        ]
+    
+    def build_a5_jobs(self, df, config):
+        """Danh sách job A5 cho một khối dữ liệu, mỗi context là một cặp 2 dòng"""
+        contexts = prepare_a5_contexts(df)
+        return [
+            (os.path.join(self.work_dir or config['output_folder'], f"temp_output_{i//2 + 1}.docx"), context,
+             f"cặp dòng {i+1} và {i+2}")
+            for i, context in zip(df.index[::2], contexts)
+        ]
+    
+    def build_render_jobs(self, build_jobs, df, config):
+        """Job cho một khối dữ liệu, đã gộp thành tài liệu nhiều trang nếu ở chế độ single_document"""
+        with self.metrics.stage("context_build"):
+            jobs = build_jobs(df, config)
+        if config.get('render_mode') == 'single_document' and jobs:
+            jobs = self.group_jobs_into_documents(jobs, config)
+        return jobs
+    
+    def render_word_files(self, jobs, template_path, config, label, errors=None):
+        """Render các file Word từ danh sách (temp_word_file, context, mô tả dòng).
+        
+        Chạy tuần tự hoặc trên process pool (render_workers), kết quả luôn giữ
+        đúng thứ tự temp_output_N. Lỗi của từng dòng được gom vào errors.
+        """
+        errors = errors if errors is not None else []
+        # Nạp template một lần trước khi render (process render con tự nạp bản riêng ở lần render đầu)
+        with self.metrics.stage("template_load"):
+            TEMPLATE_CACHE.get(template_path)
+        # Job có context là danh sách = nhiều bản ghi trong một file (single_document)
+        weights = [len(context) if isinstance(context, list) else 1 for _, context, _ in jobs]
+        workers = int(config.get('render_workers', 1)) or (os.cpu_count() or 1)
+        results = [None] * len(jobs)
+        done = 0
+        
+        def on_done(index, exc, result=None):
+            nonlocal done
+            temp_word_file, _, row_label = jobs[index]
+            if result is not None:
+                elapsed, failures = result
+                self.metrics.add("render", elapsed, row_label)
+                # Bản ghi lỗi trong file nhiều bản ghi: báo riêng từng dòng, vẫn giữ các bản ghi còn lại
+                for error_msg in drop_failed_records(jobs[index], failures, self.document_rows):
+                    errors.append(error_msg)
+                    self.log(f"Lỗi: {error_msg}")
+            if exc is not None:
+                error_msg = f"Lỗi khi xử lý {row_label}: {exc}"
+                errors.append(error_msg)
+                self.log(f"Lỗi: {error_msg}")
+            elif os.path.exists(temp_word_file):
+                results[index] = temp_word_file
+                done += 1
+                self.log(f"Đã tạo: {os.path.basename(temp_word_file)}")
+            else:
+                error_msg = f"Không thể tạo file Word: {temp_word_file}"
+                errors.append(error_msg)
+                self.log(f"Lỗi: {error_msg}")
+            
+            # Cập nhật progress
+            self.progress_tracker.update(weights[index])
+            progress = self.progress_tracker.get_progress()
+            self.progress_var.set(progress)
+            self.status_var.set(f"Đang tạo Word {label}... {done}/{len(jobs)}")
+        
+        if workers <= 1 or len(jobs) <= 1:
+            for index, (temp_word_file, context, _) in enumerate(jobs):
+                try:
+                    on_done(index, None, timed_render_job(template_path, context, temp_word_file))
+                except Exception as e:
+                    on_done(index, e)
+        else:
+            executor = self.get_render_executor(workers)
+            futures = {
+                executor.submit(timed_render_job, template_path, context, temp_word_file): index
+                for index, (temp_word_file, context, _) in enumerate(jobs)
+            }
+            for future in as_completed(futures):
+                exc = future.exception()
+                on_done(futures[future], exc, None if exc is not None else future.result())
+        
+        if errors:
+            self.log(f"Có {len(errors)} lỗi xảy ra")
+        
+        return [f for f in results if f]
+    
+    def get_render_executor(self, workers):
+        """Process pool render dùng chung cho mọi khối dữ liệu trong một job"""
+        if getattr(self, 'render_executor', None) is None:
+            self.log(f"Render song song với {workers} process...")
+            self.render_executor = ProcessPoolExecutor(max_workers=workers)
+        return self.render_executor
+    
+    def shutdown_render_executor(self):
+        if getattr(self, 'render_executor', None) is not None:
+            self.render_executor.shutdown()
+            self.render_executor = None
+    
+    def group_jobs_into_documents(self, jobs, config):
+        """Gộp các job một trang thành job nhiều trang (single_document_chunk trang mỗi file)"""
+        chunk = max(1, int(config.get('single_document_chunk', 200) or 200))
+        grouped = []
+        for start in range(0, len(jobs), chunk):
+            part = jobs[start:start + chunk]
+            temp_word_file = part[0][0].replace("temp_output_", "temp_document_")
+            row_label = part[0][2] if len(part) == 1 else f"{part[0][2]} → {part[-1][2]}"
+            grouped.append((temp_word_file, [context for _, context, _ in part], row_label))
+            self.document_rows[temp_word_file] = [label for _, _, label in part]
+        self.log(f"Chế độ một tài liệu: {len(jobs)} trang trong {len(grouped)} file Word")
+        return grouped
+    
+    def convert_to_pdf_sequential(self, word_files, config, converted=None):
+        """Chuyển đổi PDF tuần tự (converted: dict tùy chọn, ghi lại file Word -> file PDF)"""
+        pdf_files = []
+        
+        for word_file in word_files:
+            try:
+                with self.metrics.stage("convert", os.path.basename(word_file)):
+                    pdf_file = self.converter.convert_to_pdf(word_file)
+                if pdf_file:
+                    pdf_files.append(pdf_file)
+                    if converted is not None:
+                        converted[word_file] = pdf_file
+                    self.log(f"Đã chuyển đổi: {os.path.basename(pdf_file)}")
+                else:
+                    self.log(f"Lỗi chuyển đổi: {os.path.basename(word_file)}")
+                
+                # Cập nhật progress
+                self.progress_tracker.update()
+                progress = self.progress_tracker.get_progress()
+                self.progress_var.set(progress)
+                self.status_var.set(f"Đang chuyển đổi PDF... {len(pdf_files)}/{len(word_files)}")
+                
+            except Exception as e:
+                self.log(f"Lỗi chuyển đổi {word_file}: {e}")
+        
+        return pdf_files
+    
+    def convert_to_pdf_batched(self, word_files, config, converted=None):
+        """Chuyển đổi PDF theo batch (batch_size file mỗi lần gọi công cụ), giữ nguyên thứ tự"""
+        batch_size = int(config.get('batch_size', 1) or 1)
+        if batch_size <= 1:
+            return self.convert_to_pdf_sequential(word_files, config, converted)
+        
+        tuner = BatchSizeTuner(batch_size,
+                               maximum=config.get('max_batch_size', 50),
+                               enabled=config.get('auto_batch_size', True))
+        pdf_files = []
+        position = 0
+        while position < len(word_files):
+            batch = word_files[position:position + tuner.batch_size]
+            position += len(batch)
+            try:
+                started = time.time()
+                timings = []
+                results = self.converter.convert_batch(batch, timings)
+                # Chỉnh batch theo riêng lần gọi batch: thời gian thử lại từng file không phụ thuộc kích thước batch
+                tuner.record(len(batch), timings[0] if timings else time.time() - started)
+                self.metrics.add("convert", time.time() - started, os.path.basename(batch[0]))
+                
+                for word_file, pdf_file in zip(batch, results):
+                    if pdf_file:
+                        pdf_files.append(pdf_file)
+                        if converted is not None:
+                            converted[word_file] = pdf_file
+                        self.log(f"Đã chuyển đổi: {os.path.basename(pdf_file)}")
+                    else:
+                        self.log(f"Lỗi chuyển đổi: {os.path.basename(word_file)}")
+                
+            except Exception as e:
+                self.log(f"Lỗi chuyển đổi batch {os.path.basename(batch[0])}...: {e}")
+            
+            # Cập nhật progress
+            self.progress_tracker.update(len(batch))
+            progress = self.progress_tracker.get_progress()
+            self.progress_var.set(progress)
+            self.status_var.set(f"Đang chuyển đổi PDF... {len(pdf_files)}/{len(word_files)} (batch {tuner.batch_size})")
+        
+        return pdf_files
     
-    def save_config(self, config):
+    def merge_pdfs(self, pdf_files, output_folder, output_name, page_counts=None, config=None):
+        """Gộp các file PDF (phần tử là đường dẫn hoặc (PdfReader, [trang]));
+        page_counts: list tùy chọn, nhận số trang đã gộp của từng phần tử;
+        config: tùy chọn tối ưu file PDF (pdf_optimize, pdf_linearize, qpdf_path)"""
+        page_counts = page_counts if page_counts is not None else []
+        config = config or {}
         try:
-            with open(self.config_file, 'w', encoding='utf-8') as f:
-                json.dump(config, f, indent=2, ensure_ascii=False)
+            merged_pdf = os.path.join(output_folder, output_name)
+            if (len(pdf_files) == 1 and isinstance(pdf_files[0], str) and not config.get('pdf_linearize')
+                    and not config.get('pdf_optimize', True)):
+                # Chỉ có một file (vd. chế độ single_document) và không tối ưu: chép nguyên file
+                with self.metrics.stage("merge"):
+                    shutil.copyfile(pdf_files[0], merged_pdf)
+                from pypdf import PdfReader
+                page_counts.append(len(PdfReader(merged_pdf).pages))
+                self.log(f"Đã lưu PDF: {merged_pdf}")
+                return merged_pdf
+            
+            # Ghi dần ra đĩa, mỗi file nguồn được giải phóng ngay sau khi chép
+            merger = StreamingPdfMerger.from_config(merged_pdf, config, self.log)
+            repeated = {pdf.index for pdf in pdf_files if isinstance(pdf, RepeatedJob)}
+            spans = {}  # vị trí nguồn được lặp lại -> số hiệu các trang đã gộp
+            try:
+                for index, pdf in enumerate(pdf_files):
+                    if isinstance(pdf, RepeatedJob):
+                        page_counts.append(merger.repeat(spans[pdf.index]))
+                        continue
+                    start = merger.page_count
+                    keep = index in repeated
+                    with self.metrics.stage("merge", pdf if isinstance(pdf, str) else None):
+                        page_counts.append(merger.append(*pdf, keep=keep) if isinstance(pdf, tuple)
+                                           else merger.append(pdf, keep=keep))
+                    if keep:
+                        spans[index] = merger.page_ids[start:]
+            except Exception:
+                merger.abort()
+                raise
+            merger.close()
+            
+            self.log(f"Đã gộp {len(pdf_files)} file PDF thành: {merged_pdf}")
+            self.log_merge_savings(merger)
+            return merged_pdf
+            
         except Exception as e:
-            print(f"Lỗi khi lưu config: {e}")
-    
-    def update_config(self, key, value):
-        self.config[key] = value
-        self.save_config(self.config)
-
-class ProgressTracker:
-    def __init__(self, total_steps):
-        self.total_steps = total_steps
-        self.current_step = 0
+            self.log(f"Lỗi khi gộp PDF: {e}")
+            raise
     
-    def update(self, step=1):
-        self.current_step += step
+    def log_merge_savings(self, merger):
+        """Báo số object dùng chung / stream được nén khi gộp (pdf_optimize)"""
+        if merger.shared_objects or merger.compressed_streams:
+            self.log(f"Tối ưu PDF: dùng chung {merger.shared_objects} object trùng lặp, "
+                     f"nén {merger.compressed_streams} stream")
     
-    def get_progress(self):
-        return (self.current_step / self.total_steps) * 100 if self.total_steps > 0 else 0
+    def cleanup_files(self, files):
+        """Dọn dẹp file tạm"""
+        for file_path in files:
+            try:
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+                    self.log(f"Đã xóa: {os.path.basename(file_path)}")
+            except Exception as e:
+                self.log(f"Lỗi khi xóa {file_path}: {e}")
 
 class AutoPriceGUI:
+    UI_REFRESH_MS = 100  # Chu kỳ áp log / tiến trình đang chờ lên giao diện
+    
     def __init__(self):
+        _load_tkinter()
         self.root = tk.Tk()
         self.root.title("AUTO-PRICE - Tự động hóa bảng giá A4 & A5")
         self.root.geometry("900x800")
@@ -266,8 +3550,19 @@ class AutoPriceGUI:
         
         self.config = ConfigManager()
         self.converter = PDFConverter(self.config.config)
+        self.processing = False
+        # Thread nền không chạm vào Tk: log và lệnh cập nhật giao diện đi qua hàng đợi,
+        # tiến trình / trạng thái chỉ giữ giá trị mới nhất; thread Tk áp chúng theo lô
+        self.ui_events = queue.SimpleQueue()
+        self.job_progress = StatusValue(0)
+        self.job_status = StatusValue("Sẵn sàng")
+        self.shown_progress = None
+        self.shown_status = None
+        self.log_file = self.config.config.get("log_file") or None
         self.setup_ui()
-        self.refresh_tools()
+        self.root.after(self.UI_REFRESH_MS, self.drain_ui_events)
+        # Dò công cụ ở thread nền sau khi cửa sổ đã hiện
+        self.root.after(100, self.refresh_tools)
         
     def setup_ui(self):
         # Frame chính
@@ -352,7 +3647,7 @@ class AutoPriceGUI:
         self.tool_combo = ttk.Combobox(config_frame, textvariable=self.tool_var, width=25, state="readonly")
         self.tool_combo.grid(row=0, column=1, padx=(10, 5), sticky=tk.W)
         self.tool_combo.bind("<<ComboboxSelected>>", self.on_tool_change)
-        ttk.Button(config_frame, text="Làm mới", command=self.refresh_tools).grid(row=0, column=2)
+        ttk.Button(config_frame, text="Làm mới", command=lambda: self.refresh_tools(force=True)).grid(row=0, column=2)
         
         # Tool info
         self.tool_info_var = tk.StringVar(value="Đang kiểm tra công cụ...")
@@ -365,6 +3660,12 @@ class AutoPriceGUI:
         libreoffice_entry.grid(row=2, column=1, padx=(10, 5), pady=(10, 0))
         ttk.Button(config_frame, text="Chọn", command=self.browse_libreoffice).grid(row=2, column=2, pady=(10, 0))
         
+        # Cách tạo trang: qua Word hoặc vẽ thẳng ra PDF
+        ttk.Label(config_frame, text="Cách tạo trang:").grid(row=3, column=0, sticky=tk.W, pady=(10, 0))
+        self.engine_var = tk.StringVar(value=self.config.config.get("render_engine", "word"))
+        ttk.Combobox(config_frame, textvariable=self.engine_var, values=["word", "overlay", "native"], width=25,
+                     state="readonly").grid(row=3, column=1, padx=(10, 5), pady=(10, 0), sticky=tk.W)
+        
         # Progress bar
         progress_frame = ttk.LabelFrame(main_frame, text="Tiến trình xử lý", padding="10")
         progress_frame.grid(row=6, column=0, columnspan=3, sticky=(tk.W, tk.E), pady=(0, 10))
@@ -394,8 +3695,9 @@ class AutoPriceGUI:
         self.start_button.grid(row=0, column=0, padx=(0, 10))
         
         ttk.Button(button_frame, text="Thông tin công cụ", command=self.show_tools_info).grid(row=0, column=1, padx=(0, 10))
-        ttk.Button(button_frame, text="Lưu cấu hình", command=self.save_config).grid(row=0, column=2, padx=(0, 10))
-        ttk.Button(button_frame, text="Thoát", command=self.root.quit).grid(row=0, column=3)
+        ttk.Button(button_frame, text="Cache trang", command=self.show_page_cache).grid(row=0, column=2, padx=(0, 10))
+        ttk.Button(button_frame, text="Lưu cấu hình", command=self.save_config).grid(row=0, column=3, padx=(0, 10))
+        ttk.Button(button_frame, text="Thoát", command=self.root.quit).grid(row=0, column=4)
         
         # Configure grid weights
         self.root.columnconfigure(0, weight=1)
@@ -426,11 +3728,61 @@ class AutoPriceGUI:
             self.a5_frame.configure(text="Cấu hình A5 (Đang sử dụng)")
     
     def log(self, message):
-        """Ghi log vào text widget"""
+        """Ghi log (gọi được từ mọi thread; dòng log được hiển thị ở lần drain_ui_events kế tiếp)"""
         timestamp = time.strftime("%H:%M:%S")
-        self.log_text.insert(tk.END, f"[{timestamp}] {message}\n")
+        self.ui_events.put(f"[{timestamp}] {message}\n")
+    
+    def call_in_ui(self, func):
+        """Chạy func trên thread Tk (vd. messagebox, bật lại nút) thay vì từ thread nền"""
+        self.ui_events.put(func)
+    
+    def drain_ui_events(self):
+        """Áp log / lệnh / tiến trình đang chờ lên giao diện theo lô, chạy định kỳ trên thread Tk"""
+        try:
+            lines = []
+            while True:
+                try:
+                    event = self.ui_events.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(event, str):
+                    lines.append(event)
+                else:
+                    # Hiện các dòng log trước đó rồi mới chạy lệnh (vd. messagebox)
+                    self.append_log_lines(lines)
+                    lines = []
+                    event()
+            self.append_log_lines(lines)
+            
+            progress, status = self.job_progress.get(), self.job_status.get()
+            if progress != self.shown_progress:
+                self.progress_var.set(progress)
+                self.shown_progress = progress
+            if status != self.shown_status:
+                self.status_var.set(status)
+                self.shown_status = status
+        except Exception as e:
+            print(f"Lỗi cập nhật giao diện: {e}")
+        finally:
+            self.root.after(self.UI_REFRESH_MS, self.drain_ui_events)
+    
+    def append_log_lines(self, lines):
+        """Thêm một lô dòng log vào text widget, chỉ giữ log_max_lines dòng cuối (ghi đủ ra log_file nếu có)"""
+        if not lines:
+            return
+        if self.log_file:
+            try:
+                with open(self.log_file, 'a', encoding='utf-8') as f:
+                    f.writelines(lines)
+            except OSError as e:
+                print(f"Không ghi được file log {self.log_file}: {e}")
+                self.log_file = None
+        max_lines = max(100, int(self.config.config.get("log_max_lines", 2000) or 2000))
+        self.log_text.insert(tk.END, "".join(lines[-max_lines:]))
+        line_count = int(self.log_text.index("end-1c").split(".")[0])
+        if line_count > max_lines:
+            self.log_text.delete("1.0", f"{line_count - max_lines}.0")
         self.log_text.see(tk.END)
-        self.root.update_idletasks()
     
     def browse_a4_excel(self):
         filename = filedialog.askopenfilename(
@@ -511,14 +3863,32 @@ class AutoPriceGUI:
         except Exception as e:
             messagebox.showerror("Lỗi", f"Không thể mở thư mục xuất: {e}")
     
-    def refresh_tools(self):
-        """Làm mới danh sách công cụ chuyển đổi"""
+    def refresh_tools(self, force=False):
+        """Làm mới danh sách công cụ chuyển đổi (dò ở thread nền, kết quả được cache theo đường dẫn)"""
+        config = {
+            **self.config.config,
+            "libreoffice_path": self.libreoffice_var.get()
+        }
+        self.tool_info_var.set("🔍 Đang kiểm tra công cụ chuyển đổi...")
+        
+        def probe():
+            try:
+                PDFConverter.probe_tools(config, force=force)
+            except Exception:
+                pass  # Lỗi được báo lại khi cập nhật giao diện
+            self.call_in_ui(lambda: self.apply_tools(config))
+        
+        threading.Thread(target=probe, daemon=True).start()
+    
+    def apply_tools(self, config):
+        """Cập nhật converter và combobox từ kết quả dò công cụ (chạy trên thread GUI)"""
+        if self.processing:
+            # Không đổi công cụ khi job đang chạy
+            self.root.after(500, lambda: self.apply_tools(config))
+            return
         try:
-            # Cập nhật converter với config mới
-            config = {
-                "libreoffice_path": self.libreoffice_var.get()
-            }
-            self.converter = PDFConverter(config)
+            # Cập nhật converter hiện có (không tạo mới: giữ tình trạng công cụ và server đang chạy)
+            self.converter.update_tools(config)
             
             # Lấy thông tin công cụ
             all_tools = self.converter.get_all_tools_info()
@@ -583,6 +3953,7 @@ class AutoPriceGUI:
     def save_config(self):
         """Lưu cấu hình hiện tại"""
         config = {
+            **self.config.config,
             "a4_excel_file": self.a4_excel_var.get(),
             "a4_word_template": self.a4_template_var.get(),
             "a5_excel_file": self.a5_excel_var.get(),
@@ -591,402 +3962,67 @@ class AutoPriceGUI:
             "libreoffice_path": self.libreoffice_var.get(),
             "batch_size": self.config.config["batch_size"],
             "default_format": self.format_var.get(),
-            "preferred_tool": self.tool_var.get() or self.converter.current_tool
+            "preferred_tool": self.tool_var.get() or self.config.config.get("preferred_tool", ""),
+            "render_engine": self.engine_var.get()
         }
         self.config.save_config(config)
         messagebox.showinfo("Thông báo", "Đã lưu cấu hình thành công!")
     
     def start_processing(self):
         """Bắt đầu xử lý trong thread riêng"""
+        self.processing = True
         self.start_button.config(state='disabled')
-        self.progress_var.set(0)
-        self.status_var.set("Đang xử lý...")
+        self.job_progress.set(0)
+        self.job_status.set("Đang xử lý...")
         self.log_text.delete(1.0, tk.END)
+        self.log_file = self.config.config.get("log_file") or None
+        
+        # Đọc các biến Tk ở đây (thread GUI), thread xử lý chỉ nhận bản sao config
+        config = {
+            **self.config.config,
+            "a4_excel_file": self.a4_excel_var.get(),
+            "a4_word_template": self.a4_template_var.get(),
+            "a5_excel_file": self.a5_excel_var.get(),
+            "a5_word_template": self.a5_template_var.get(),
+            "output_folder": self.output_var.get(),
+            "libreoffice_path": self.libreoffice_var.get(),
+            "batch_size": self.config.config["batch_size"],
+            "default_format": self.format_var.get(),
+            "preferred_tool": self.tool_var.get(), # Lấy công cụ được chọn từ config
+            "render_engine": self.engine_var.get()
+        }
         
         # Chạy xử lý trong thread riêng để không block GUI
-        thread = threading.Thread(target=self.process_data)
+        thread = threading.Thread(target=self.process_data, args=(config, self.format_var.get()))
         thread.daemon = True
         thread.start()
     
-    def process_data(self):
-        """Xử lý dữ liệu chính"""
+    def process_data(self, config, current_format):
+        """Xử lý dữ liệu chính (thread nền: không gọi Tk trực tiếp)"""
         try:
-            # Cập nhật config
-            config = {
-                "a4_excel_file": self.a4_excel_var.get(),
-                "a4_word_template": self.a4_template_var.get(),
-                "a5_excel_file": self.a5_excel_var.get(),
-                "a5_word_template": self.a5_template_var.get(),
-                "output_folder": self.output_var.get(),
-                "libreoffice_path": self.libreoffice_var.get(),
-                "batch_size": self.config.config["batch_size"],
-                "default_format": self.format_var.get(),
-                "preferred_tool": self.tool_var.get() # Lấy công cụ được chọn từ config
-            }
-            
             # Cập nhật converter với config mới
             self.converter.config = config
             
-            current_format = self.format_var.get()
             self.log(f"Bắt đầu xử lý định dạng {current_format}...")
             
-            if current_format == "A4":
-                self.process_a4_format(config)
-            else:
-                self.process_a5_format(config)
+            self.runner = PriceJobRunner(self.converter, log=self.log,
+                                         progress_var=self.job_progress, status_var=self.job_status)
+            merged_pdf = self.runner.run_format(current_format, config)
+            self.call_in_ui(lambda: messagebox.showinfo("Thành công", f"Đã xử lý xong! File PDF: {merged_pdf}"))
             
         except Exception as e:
             self.log(f"Lỗi: {str(e)}")
-            self.status_var.set("Lỗi")
-            messagebox.showerror("Lỗi", f"Có lỗi xảy ra: {str(e)}")
+            self.job_status.set("Lỗi")
+            message = f"Có lỗi xảy ra: {str(e)}"
+            self.call_in_ui(lambda: messagebox.showerror("Lỗi", message))
         
         finally:
-            self.start_button.config(state='normal')
-    
-    def process_a4_format(self, config):
-        """Xử lý định dạng A4 - một sản phẩm/trang"""
-        try:
-            self.log(f"Đang xử lý định dạng A4...")
-            self.log(f"File Excel: {config['a4_excel_file']}")
-            self.log(f"Template: {config['a4_word_template']}")
-            self.log(f"Thư mục xuất: {config['output_folder']}")
-            
-            # Kiểm tra file tồn tại
-            if not os.path.exists(config['a4_excel_file']):
-                raise FileNotFoundError(f"Không tìm thấy file Excel A4: {config['a4_excel_file']}")
-            if not os.path.exists(config['a4_word_template']):
-                raise FileNotFoundError(f"Không tìm thấy template A4: {config['a4_word_template']}")
-            
-            # Tạo thư mục xuất
-            os.makedirs(config['output_folder'], exist_ok=True)
-            
-            # Đọc Excel
-            self.log("Đang đọc file Excel A4...")
-            df = pd.read_excel(config['a4_excel_file'])
-            self.log(f"Đã đọc {len(df)} dòng dữ liệu")
-            
-            # Tính toán tổng số bước
-            total_steps = len(df) + 2  # Word + PDF + Merge
-            self.progress_tracker = ProgressTracker(total_steps)
-            
-            # Xử lý tạo file Word
-            self.log("Đang tạo file Word A4...")
-            word_files = self.process_a4_word_files(df, config)
-            
-            if not word_files:
-                raise Exception("Không tạo được file Word nào")
-            
-            self.log(f"Đã tạo {len(word_files)} file Word")
-            
-            # Chuyển đổi PDF
-            self.log("Đang chuyển đổi sang PDF...")
-            pdf_files = self.convert_to_pdf_sequential(word_files, config)
-            
-            if not pdf_files:
-                raise Exception("Không chuyển đổi được file PDF nào")
-            
-            self.log(f"Đã chuyển đổi {len(pdf_files)} file PDF")
-            
-            # Gộp PDF
-            self.log("Đang gộp file PDF...")
-            merged_pdf = self.merge_pdfs(pdf_files, config['output_folder'], "A4-Auto-Tong.pdf")
-            
-            # Dọn dẹp
-            self.cleanup_files(word_files + pdf_files)
-            
-            self.log("Hoàn thành! File PDF đã được gộp thành công!")
-            self.status_var.set("Hoàn thành")
-            self.progress_var.set(100)
-            
-            messagebox.showinfo("Thành công", f"Đã xử lý xong! File PDF: {merged_pdf}")
-            
-        except Exception as e:
-            self.log(f"Lỗi xử lý A4: {str(e)}")
-            raise
-    
-    def process_a5_format(self, config):
-        """Xử lý định dạng A5 - hai sản phẩm/trang"""
-        try:
-            self.log(f"Đang xử lý định dạng A5...")
-            self.log(f"File Excel: {config['a5_excel_file']}")
-            self.log(f"Template: {config['a5_word_template']}")
-            self.log(f"Thư mục xuất: {config['output_folder']}")
-            
-            # Kiểm tra file tồn tại
-            if not os.path.exists(config['a5_excel_file']):
-                raise FileNotFoundError(f"Không tìm thấy file Excel A5: {config['a5_excel_file']}")
-            if not os.path.exists(config['a5_word_template']):
-                raise FileNotFoundError(f"Không tìm thấy template A5: {config['a5_word_template']}")
-            
-            # Tạo thư mục xuất
-            os.makedirs(config['output_folder'], exist_ok=True)
-            
-            # Đọc Excel
-            self.log("Đang đọc file Excel A5...")
-            df = pd.read_excel(config['a5_excel_file'])
-            self.log(f"Đã đọc {len(df)} dòng dữ liệu")
-            
-            # Tính toán tổng số bước
-            total_steps = len(df) // 2 + 2  # Word + PDF + Merge
-            self.progress_tracker = ProgressTracker(total_steps)
-            
-            # Xử lý tuần tự tạo file Word
-            self.log("Đang tạo file Word A5...")
-            word_files = self.process_a5_word_files_sequential(df, config)
-            
-            if not word_files:
-                raise Exception("Không tạo được file Word nào")
-            
-            self.log(f"Đã tạo {len(word_files)} file Word")
-            
-            # Chuyển đổi PDF tuần tự
-            self.log("Đang chuyển đổi sang PDF...")
-            pdf_files = self.convert_to_pdf_sequential(word_files, config)
-            
-            if not pdf_files:
-                raise Exception("Không chuyển đổi được file PDF nào")
-            
-            self.log(f"Đã chuyển đổi {len(pdf_files)} file PDF")
-            
-            # Gộp PDF
-            self.log("Đang gộp file PDF...")
-            merged_pdf = self.merge_pdfs(pdf_files, config['output_folder'], "A5-Auto-Tong.pdf")
-            
-            # Dọn dẹp
-            self.cleanup_files(word_files + pdf_files)
-            
-            self.log("Hoàn thành! File PDF đã được gộp thành công!")
-            self.status_var.set("Hoàn thành")
-            self.progress_var.set(100)
-            
-            messagebox.showinfo("Thành công", f"Đã xử lý xong! File PDF: {merged_pdf}")
-            
-        except Exception as e:
-            self.log(f"Lỗi xử lý A5: {str(e)}")
-            raise
-    
-    def process_a4_word_files(self, df, config):
-        """Xử lý file Word A4 - một sản phẩm/trang"""
-        word_files = []
-        errors = []
-        
-        # Xử lý từng dòng tuần tự
-        for i, row in df.iterrows():
-            try:
-                # Load template
-                doc = DocxTemplate(config['a4_word_template'])
-                
-                # Tạo context
-                context = self.create_a4_context(row)
-                
-                # Render template
-                doc.render(context)
-                
-                # Lưu file Word
-                temp_word_file = os.path.join(config['output_folder'], f"temp_output_{i + 1}.docx")
-                doc.save(temp_word_file)
-                
-                if os.path.exists(temp_word_file):
-                    word_files.append(temp_word_file)
-                    self.log(f"Đã tạo: {os.path.basename(temp_word_file)}")
-                else:
-                    error_msg = f"Không thể tạo file Word: {temp_word_file}"
-                    errors.append(error_msg)
-                    self.log(f"Lỗi: {error_msg}")
-                
-                # Cập nhật progress
-                self.progress_tracker.update()
-                progress = self.progress_tracker.get_progress()
-                self.progress_var.set(progress)
-                self.status_var.set(f"Đang tạo Word A4... {len(word_files)}/{len(df)}")
-                
-            except Exception as e:
-                error_msg = f"Lỗi khi xử lý dòng {i+1}: {e}"
-                errors.append(error_msg)
-                self.log(f"Lỗi: {error_msg}")
-        
-        if errors:
-            self.log(f"Có {len(errors)} lỗi xảy ra")
-        
-        return word_files
-    
-    def process_a5_word_files_sequential(self, df, config):
-        """Xử lý file Word A5 tuần tự - hai sản phẩm/trang"""
-        word_files = []
-        errors = []
-        
-        # Xử lý từng cặp 2 dòng tuần tự
-        for i in range(0, len(df), 2):
-            try:
-                # Load template
-                doc = DocxTemplate(config['a5_word_template'])
-                
-                # Lấy dữ liệu
-                row_1 = df.iloc[i]
-                row_2 = df.iloc[i + 1] if i + 1 < len(df) else None
-                
-                # Tạo context
-                context = self.create_a5_context(row_1, row_2)
-                
-                # Render template
-                doc.render(context)
-                
-                # Lưu file Word
-                temp_word_file = os.path.join(config['output_folder'], f"temp_output_{i//2 + 1}.docx")
-                doc.save(temp_word_file)
-                
-                if os.path.exists(temp_word_file):
-                    word_files.append(temp_word_file)
-                    self.log(f"Đã tạo: {os.path.basename(temp_word_file)}")
-                else:
-                    error_msg = f"Không thể tạo file Word: {temp_word_file}"
-                    errors.append(error_msg)
-                    self.log(f"Lỗi: {error_msg}")
-                
-                # Cập nhật progress
-                self.progress_tracker.update()
-                progress = self.progress_tracker.get_progress()
-                self.progress_var.set(progress)
-                self.status_var.set(f"Đang tạo Word A5... {len(word_files)}/{len(df)//2}")
-                
-            except Exception as e:
-                error_msg = f"Lỗi khi xử lý cặp dòng {i+1} và {i+2}: {e}"
-                errors.append(error_msg)
-                self.log(f"Lỗi: {error_msg}")
-        
-        if errors:
-            self.log(f"Có {len(errors)} lỗi xảy ra")
-        
-        return word_files
-    
-    def create_a4_context(self, row):
-        """Tạo context cho template A4"""
-        return {
-            "NganhHang": self.limit_string(row['NganhHang'], max_length=29),
-            "Hang": row['Hang'] if pd.notnull(row['Hang']) else "",
-            "SAP": row['SAP'] if pd.notnull(row['SAP']) else "",
-            "Model": row['Model'] if pd.notnull(row['Model']) else "",
-            "GiaNiemYet": self.format_currency(row['GiaNiemYet']),
-            "GiaKM": self.format_currency(row['GiaKM']),
-            "G": self.format_percentage(row['G']),
-            "Qua": row['Qua'] if pd.notnull(row['Qua']) else "",
-            "ThoiGian": row['ThoiGian']
-        }
-    
-    def create_a5_context(self, row_1, row_2):
-        """Tạo context cho template A5"""
-        context = {}
-        
-        # Dòng 1
-        context.update({
-            "NganhHang": self.limit_string(row_1['NganhHang'], max_length=31),
-            "Hang": row_1['Hang'] if pd.notnull(row_1['Hang']) else "",
-            "SAP": row_1['SAP'] if pd.notnull(row_1['SAP']) else "",
-            "Model": row_1['Model'] if pd.notnull(row_1['Model']) else "",
-            "GiaNiemYet": self.format_currency(row_1['GiaNiemYet']),
-            "GiaKM": self.format_currency(row_1['GiaKm']),
-            "G": self.format_percentage(row_1['G']),
-            "Qua": row_1['Qua'] if pd.notnull(row_1['Qua']) else "",
-            "ThoiGian": row_1['ThoiGian']
-        })
-        
-        # Dòng 2 (nếu có)
-        if row_2 is not None:
-            context.update({
-                "NganhHang1": self.limit_string(row_2['NganhHang'], max_length=31),
-                "Hang1": row_2['Hang'] if pd.notnull(row_2['Hang']) else "",
-                "SAP1": row_2['SAP'] if pd.notnull(row_2['SAP']) else "",
-                "Model1": row_2['Model'] if pd.notnull(row_2['Model']) else "",
-                "GiaNiemYet1": self.format_currency(row_2['GiaNiemYet']),
-                "GiaKM1": self.format_currency(row_2['GiaKm']),
-                "G1": self.format_percentage(row_2['G']),
-                "Qua1": row_2['Qua'] if pd.notnull(row_2['Qua']) else "",
-                "ThoiGian1": row_2['ThoiGian']
-            })
-        else:
-            context.update({
-                "NganhHang1": "", "Hang1": "", "SAP1": "", "Model1": "",
-                "GiaNiemYet1": "", "GiaKM1": "", "G1": "", "Qua1": "", "ThoiGian1": ""
-            })
-        
-        return context
-    
-    def format_currency(self, value):
-        """Format currency"""
-        if pd.isna(value):
-            return ""
-        try:
-            return "{:,.0f}đ".format(float(str(value).replace(',', '')))
-        except (ValueError, TypeError):
-            return str(value)
-    
-    def format_percentage(self, value):
-        """Format percentage"""
-        if pd.isna(value):
-            return ""
-        try:
-            return "{:.0f}%".format(float(str(value).replace('%', '')))
-        except (ValueError, TypeError):
-            return str(value)
-    
-    def limit_string(self, text, max_length=33):
-        """Limit string"""
-        if pd.isna(text):
-            return ""
-        text = str(text)
-        return text[:max_length-3] + "..." if len(text) > max_length else text
-    
-    def convert_to_pdf_sequential(self, word_files, config):
-        """Chuyển đổi PDF tuần tự"""
-        pdf_files = []
-        
-        for word_file in word_files:
-            try:
-                pdf_file = self.converter.convert_to_pdf(word_file)
-                if pdf_file:
-                    pdf_files.append(pdf_file)
-                    self.log(f"Đã chuyển đổi: {os.path.basename(pdf_file)}")
-                else:
-                    self.log(f"Lỗi chuyển đổi: {os.path.basename(word_file)}")
-                
-                # Cập nhật progress
-                self.progress_tracker.update()
-                progress = self.progress_tracker.get_progress()
-                self.progress_var.set(progress)
-                self.status_var.set(f"Đang chuyển đổi PDF... {len(pdf_files)}/{len(word_files)}")
-                
-            except Exception as e:
-                self.log(f"Lỗi chuyển đổi {word_file}: {e}")
-        
-        return pdf_files
-    
-    def merge_pdfs(self, pdf_files, output_folder, output_name):
-        """Gộp các file PDF"""
-        try:
-            merger = PdfWriter()
-            for pdf in pdf_files:
-                merger.append(pdf)
-            
-            merged_pdf = os.path.join(output_folder, output_name)
-            merger.write(merged_pdf)
-            merger.close()
-            
-            self.log(f"Đã gộp {len(pdf_files)} file PDF thành: {merged_pdf}")
-            return merged_pdf
-            
-        except Exception as e:
-            self.log(f"Lỗi khi gộp PDF: {e}")
-            raise
-    
-    def cleanup_files(self, files):
-        """Dọn dẹp file tạm"""
-        for file_path in files:
-            try:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                    self.log(f"Đã xóa: {os.path.basename(file_path)}")
-            except Exception as e:
-                self.log(f"Lỗi khi xóa {file_path}: {e}")
+            # Dừng các LibreOffice chạy nền và process render sau khi job kết thúc
+            self.converter.close()
+            if getattr(self, 'runner', None) is not None:
+                self.runner.shutdown_render_executor()
+            self.processing = False
+            self.call_in_ui(lambda: self.start_button.config(state='normal'))
     
     def run(self):
         """Chạy GUI"""
@@ -1040,6 +4076,9 @@ class AutoPriceGUI:
             info_text += "   - Dùng bản Portable: Chỉ cần giải nén cạnh ứng dụng (thư mục 'LibreOfficePortable').\n"
             info_text += "   - Hoặc đặt biến môi trường LIBREOFFICE_PATH trỏ tới 'soffice.exe' hoặc 'soffice.com'.\n"
             info_text += "   - Hoặc chọn đường dẫn thủ công bằng nút 'Chọn'.\n\n"
+            info_text += "3. LibreOffice Server (chạy nền qua UNO):\n"
+            info_text += "   - Cần LibreOffice và module Python 'uno' (Linux: cài python3-uno).\n"
+            info_text += "   - Số instance chạy song song: 'lo_server_instances' trong config.json.\n\n"
             
             info_text += "=== LƯU Ý ===\n"
             info_text += "- Ưu tiên python-docx2pdf. Nếu lỗi sẽ fallback sang LibreOffice.\n"
@@ -1058,21 +4097,160 @@ class AutoPriceGUI:
             
         except Exception as e:
             messagebox.showerror("Lỗi", f"Không thể hiển thị thông tin công cụ: {e}")
+    
+    def show_page_cache(self):
+        """Hiển thị dung lượng cache trang và cho phép xóa"""
+        try:
+            page_cache = PriceJobRunner.get_page_cache({**self.config.config, 'page_cache': True})
+            stats = page_cache.stats()
+            message = (f"Thư mục: {stats['folder']}\n"
+                       f"Số trang: {stats['entries']}\n"
+                       f"Dung lượng: {stats['bytes'] / 1024 / 1024:.1f} / {stats['max_bytes'] / 1024 / 1024:.0f} MB\n\n"
+                       "Xóa toàn bộ cache trang?")
+            if messagebox.askyesno("Cache trang", message):
+                page_cache.clear()
+                self.log("Đã xóa cache trang")
+        except Exception as e:
+            messagebox.showerror("Lỗi", f"Không thể đọc cache trang: {e}")
+
+# Mã thoát của chế độ dòng lệnh (dùng cho cron / hệ thống điều phối)
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+EXIT_NO_TOOL = 3
+EXIT_PARTIAL = 4  # Đã tạo file tổng nhưng có bản ghi lỗi
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(
+        prog="AUTO-PRICE",
+        description="Tạo bảng giá A4/A5 từ Excel và template Word, không mở GUI.",
+        epilog="Mã thoát: 0 thành công, 1 lỗi, 2 sai tham số, 3 không có công cụ chuyển đổi, "
+               "4 hoàn thành nhưng có bản ghi lỗi.")
+    parser.add_argument("--format", choices=sorted(PriceJobRunner.FORMATS),
+                        help="Định dạng bảng giá (mặc định: default_format trong config)")
+    parser.add_argument("--excel", help="File Excel dữ liệu")
+    parser.add_argument("--template", help="Template Word")
+    parser.add_argument("--output", help="Thư mục xuất")
+    parser.add_argument("--tool", choices=["docx2pdf", "libreoffice_server", "libreoffice"],
+                        help="Công cụ chuyển đổi PDF (mặc định: preferred_tool hoặc tự chọn)")
+    parser.add_argument("--engine", choices=["word", "overlay", "native"],
+                        help="'word' = template Word + chuyển đổi PDF, 'overlay' = template chuyển đổi một lần "
+                             "làm nền + vẽ chữ, 'native' = vẽ thẳng ra PDF (không cần Office)")
+    parser.add_argument("--layout", help="File layout JSON cho --engine native/overlay")
+    parser.add_argument("--impose", metavar="GRID",
+                        help="Xếp trang lên tờ in: 2up, 4up, 8up hoặc CỘTxHÀNG (imposition)")
+    parser.add_argument("--profile", action="store_true", default=None,
+                        help="Chạy kèm cProfile, ghi file .prof cạnh file PDF tổng")
+    parser.add_argument("--metrics", action="store_true", default=None,
+                        help="Ghi file .metrics.json (thời gian từng giai đoạn) cạnh file PDF tổng")
+    parser.add_argument("--workers", type=int, help="Số process render Word (render_workers)")
+    parser.add_argument("--batch-size", type=int, help="Số file mỗi lần gọi công cụ chuyển đổi")
+    parser.add_argument("--pipeline", action="store_true", default=None,
+                        help="Chạy render / chuyển đổi / gộp chồng lấp")
+    parser.add_argument("--config", default="config.json", help="File cấu hình (mặc định: config.json)")
+    parser.add_argument("--summary", metavar="FILE",
+                        help="Ghi tóm tắt JSON ra file thay vì in ra stdout")
+    parser.add_argument("--quiet", action="store_true", help="Không in log tiến trình ra stderr")
+    return parser
+
+def run_command_line(argv=None):
+    """Chạy một job không cần GUI; trả về mã thoát và in tóm tắt JSON (một dòng)"""
+    args = build_arg_parser().parse_args(argv)
+    started = time.time()
+    
+    def log(message):
+        if not args.quiet and sys.stderr is not None:
+            print(f"[{time.strftime('%H:%M:%S')}] {message}", file=sys.stderr, flush=True)
+    
+    config = dict(ConfigManager(args.config).config)
+    format_name = args.format or config.get('default_format', 'A5')
+    spec = PriceJobRunner.FORMATS[format_name]
+    overrides = {
+        spec['excel']: args.excel,
+        spec['template']: args.template,
+        "output_folder": args.output,
+        "preferred_tool": args.tool,
+        "render_workers": args.workers,
+        "batch_size": args.batch_size,
+        "pipeline": args.pipeline,
+        "render_engine": args.engine,
+        spec['layout']: args.layout,
+        "imposition": args.impose,
+        "profile": args.profile,
+        "metrics_file": args.metrics,
+    }
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    
+    summary = {"status": "error", "format": format_name, "output": None, "pages": 0,
+               "reused_pages": 0, "imposed": None, "metrics": None, "errors": [], "tool": None, "elapsed_seconds": 0}
+    exit_code = EXIT_FAILED
+    converter = None
+    runner = None
+    # print() của các công cụ chuyển đổi đi ra stderr, stdout chỉ dành cho tóm tắt JSON
+    with contextlib.redirect_stdout(sys.stderr if sys.stderr is not None else io.StringIO()):
+        try:
+            converter = PDFConverter(config)
+            if config.get('render_engine') == 'native':
+                summary["tool"] = "native"  # Vẽ thẳng ra PDF, không dò công cụ chuyển đổi
+            else:
+                try:
+                    preferred_tool = config.get('preferred_tool')
+                    if preferred_tool:
+                        if not converter.available_tools.get(preferred_tool, {}).get('available'):
+                            raise Exception(f"Công cụ không khả dụng: {preferred_tool}")
+                        converter.current_tool = preferred_tool
+                    summary["tool"] = converter.current_tool  # Không có công cụ nào thì báo lỗi ngay
+                except Exception as e:
+                    summary["errors"].append(str(e))
+                    exit_code = EXIT_NO_TOOL
+                    raise
+                log(f"Công cụ chuyển đổi: {converter.current_tool}")
+            
+            runner = PriceJobRunner(converter, log=log)
+            merged_pdf = runner.run_format(format_name, config)
+            
+            from pypdf import PdfReader
+            summary.update(output=os.path.abspath(merged_pdf), pages=len(PdfReader(merged_pdf).pages),
+                           reused_pages=runner.reused_pages, errors=runner.errors,
+                           imposed=runner.imposed_pdf and os.path.abspath(runner.imposed_pdf),
+                           metrics=runner.metrics_file and os.path.abspath(runner.metrics_file))
+            summary["status"] = "partial" if runner.errors else "ok"
+            exit_code = EXIT_PARTIAL if runner.errors else EXIT_OK
+        except Exception as e:
+            if exit_code != EXIT_NO_TOOL:
+                if runner is not None:
+                    summary["errors"] = runner.errors
+                summary["errors"].append(str(e))
+            log(f"Lỗi: {e}")
+        finally:
+            if converter is not None:
+                converter.close()
+            if runner is not None:
+                runner.shutdown_render_executor()
+    
+    summary["elapsed_seconds"] = round(time.time() - started, 3)
+    summary["exit_code"] = exit_code
+    text = json.dumps(summary, ensure_ascii=False)
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    elif sys.stdout is not None:
+        print(text, flush=True)
+    return exit_code
 
 def main():
-    """Hàm chính"""
+    """Hàm chính: có tham số dòng lệnh thì chạy không GUI, ngược lại mở GUI"""
+    if len(sys.argv) > 1:
+        sys.exit(run_command_line(sys.argv[1:]))
     try:
         app = AutoPriceGUI()
         app.run()
     except Exception as e:
         print(f"Lỗi khởi động GUI: {e}")
-        # Fallback về command line nếu GUI lỗi
-        run_command_line()
-
-def run_command_line():
-    """Chạy phiên bản command line cũ"""
-    print("Khởi động phiên bản command line...")
-    print("Vui lòng sử dụng A4-AUTO.py hoặc A5-AUTO.py cho command line")
+        print("Chạy không cần GUI: AUTO-PRICE --format A4|A5 [--excel ...] (xem --help)")
+        sys.exit(EXIT_FAILED)
 
 if __name__ == "__main__":
+    # Cần cho process pool khi đóng gói bằng PyInstaller
+    multiprocessing.freeze_support()
     main()
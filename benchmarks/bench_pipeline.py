@@ -0,0 +1,307 @@
+"""Đo tốc độ các giai đoạn của AUTO-PRICE với dữ liệu giả lập.
+
+Tạo file Excel giả (đủ các cột thật) và template A4/A5 tối giản, rồi đo từng giai đoạn
+(đọc Excel, tạo context, render Word, chuyển đổi PDF, gộp PDF) và chạy trọn job. Mặc định
+dùng công cụ chuyển đổi giả (ghi ra PDF một trang trắng) nên chạy được trên máy không có
+Word hay LibreOffice; thêm --real-converter để đo với công cụ thật.
+
+Ví dụ:
+    python benchmarks/bench_pipeline.py --rows 1000 10000 --format A4 --json ket-qua.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COLUMNS = ["NganhHang", "Hang", "SAP", "Model", "GiaNiemYet", "GiaKM", "GiaKm", "G", "Qua", "ThoiGian"]
+
+def load_app():
+    """Nạp AUTO-PRICE.py như một module (tên file có dấu gạch ngang nên không import trực tiếp được)"""
+    spec = importlib.util.spec_from_file_location("autoprice", os.path.join(ROOT, "AUTO-PRICE.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["autoprice"] = module  # Để process render con tìm thấy render_job
+    spec.loader.exec_module(module)
+    return module
+
+def peak_rss_mb():
+    """Bộ nhớ RSS lớn nhất của process tới thời điểm gọi (MB), None nếu không đo được"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+class StageTimer:
+    """Ghi thời gian của từng phần tử trong một giai đoạn"""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self.latencies = []
+        self.items = 0
+        self.started = None
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.started
+        return False
+
+    def measure(self, func, *args, items=1):
+        start = time.perf_counter()
+        result = func(*args)
+        self.latencies.append(time.perf_counter() - start)
+        self.items += items
+        return result
+
+    def result(self):
+        ms = [value * 1000 for value in self.latencies]
+        return {
+            "stage": self.name,
+            "rows": self.size,
+            "items": self.items,
+            "seconds": round(self.elapsed, 3),
+            "rows_per_second": round(self.items / self.elapsed, 1) if self.elapsed else None,
+            "p50_ms": _round(percentile(ms, 50)),
+            "p95_ms": _round(percentile(ms, 95)),
+            "p99_ms": _round(percentile(ms, 99)),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+def _round(value):
+    return None if value is None else round(value, 2)
+
+class FakeConverter:
+    """Công cụ chuyển đổi giả: mỗi file Word thành một PDF một trang trắng, cùng giao diện PDFConverter"""
+
+    current_tool = "fake"
+    available_tools = {"fake": {"available": True}}
+
+    def __init__(self):
+        from pypdf import PdfWriter
+        import io
+        writer = PdfWriter()
+        writer.add_blank_page(595, 842)
+        buffer = io.BytesIO()
+        writer.write(buffer)
+        self.pdf_bytes = buffer.getvalue()
+
+    def convert_to_pdf(self, word_file):
+        pdf_file = os.path.splitext(word_file)[0] + ".pdf"
+        with open(pdf_file, "wb") as f:
+            f.write(self.pdf_bytes)
+        return pdf_file
+
+    def convert_batch(self, word_files, timings=None):
+        started = time.perf_counter()
+        results = [self.convert_to_pdf(word_file) for word_file in word_files]
+        if timings is not None:
+            timings.append(time.perf_counter() - started)
+        return results
+
+    def producer_of(self, pdf_file):
+        return self.current_tool
+
+    def tool_signature(self, tool=None):
+        return "fake:1"
+
+    def close(self):
+        pass
+
+def make_excel(path, rows, seed=1):
+    """File Excel giả với đủ các cột thật, giá trị đa dạng (ô trống, giảm giá dạng số và chuỗi)"""
+    from openpyxl import Workbook
+    rng = random.Random(seed)
+    categories = ["Tủ lạnh inverter", "Máy giặt cửa trước", "Điều hòa 2 chiều", "Tivi 4K", "Nồi cơm điện tử"]
+    brands = ["Samsung", "LG", "Panasonic", "Sharp", "Toshiba"]
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(COLUMNS)
+    for i in range(rows):
+        price = rng.randrange(1000, 50000) * 1000
+        promo = price - rng.randrange(1, 20) * 100000
+        ws.append([
+            f"{rng.choice(categories)} tiết kiệm điện {i}",
+            rng.choice(brands),
+            100000 + i,
+            f"MD-{i:06d}",
+            price,
+            promo if i % 3 else None,
+            f"{promo:,}" if i % 5 else promo,
+            rng.choice([10, 15, "20%", None]),
+            f"Quà tặng {i}" if i % 4 == 0 else None,
+            "01/10-31/10",
+        ])
+    wb.save(path)
+
+def make_template(path, suffixes):
+    """Template Word tối giản: mỗi trường một đoạn, suffixes = ['', '1'] cho A5"""
+    from docx import Document
+    document = Document()
+    for suffix in suffixes:
+        for field in ["NganhHang", "Hang", "SAP", "Model", "GiaNiemYet", "GiaKM", "G", "Qua", "ThoiGian"]:
+            document.add_paragraph(f"{field}: {{{{{field}{suffix}}}}}")
+    document.save(path)
+
+def bench_size(app, format_name, rows, work_dir, args, converter):
+    """Đo tất cả giai đoạn cho một kích thước dữ liệu, trả về danh sách kết quả"""
+    spec = app.PriceJobRunner.FORMATS[format_name]
+    records_per_page = spec["records_per_page"]
+    excel_file = os.path.join(work_dir, f"{format_name}-{rows}.xlsx")
+    template_file = os.path.join(work_dir, f"{format_name}.docx")
+    make_excel(excel_file, rows)
+    make_template(template_file, [""] if records_per_page == 1 else ["", "1"])
+    results = []
+
+    config = dict(app.ConfigManager(os.path.join(work_dir, "config.json")).config)
+    config.update({
+        spec["excel"]: excel_file,
+        spec["template"]: template_file,
+        "output_folder": os.path.join(work_dir, f"out-{rows}"),
+        "render_workers": args.workers,
+        "page_cache": False,
+        "delta_mode": False,
+        "render_engine": args.engine,
+    })
+    runner = app.PriceJobRunner(converter, log=lambda message: None)
+
+    # 1. Đọc Excel
+    reader = runner.open_excel(excel_file, config, spec["promo_column"])
+    chunks = []
+    with StageTimer("excel_read", rows) as timer:
+        iterator = iter(reader)
+        while True:
+            chunk = timer.measure(next, iterator, None, items=0)
+            if chunk is None:
+                timer.latencies.pop()
+                break
+            timer.items += len(chunk)
+            chunks.append(chunk)
+    results.append(timer.result())
+
+    # 2. Tạo context
+    prepare = app.prepare_a4_contexts if format_name == "A4" else app.prepare_a5_contexts
+    contexts = []
+    with StageTimer("context_build", rows) as timer:
+        for chunk in chunks:
+            contexts.extend(timer.measure(prepare, chunk, items=len(chunk)))
+    results.append(timer.result())
+    del chunks
+
+    # 3-5. Render / chuyển đổi / gộp trên một mẫu (render Word chậm, không chạy hết 100k dòng)
+    sample = contexts[:max(1, args.sample // records_per_page)]
+    stage_dir = tempfile.mkdtemp(prefix="stages_", dir=work_dir)
+    word_files = [os.path.join(stage_dir, f"temp_output_{i + 1}.docx") for i in range(len(sample))]
+    if args.engine == "word":
+        with StageTimer("render", len(sample) * records_per_page) as timer:
+            for word_file, context in zip(word_files, sample):
+                timer.measure(app.render_job, template_file, context, word_file, items=records_per_page)
+        results.append(timer.result())
+
+        pdf_files = []
+        with StageTimer("convert", len(sample) * records_per_page) as timer:
+            for start in range(0, len(word_files), args.batch_size):
+                batch = word_files[start:start + args.batch_size]
+                pdf_files.extend(timer.measure(converter.convert_batch, batch,
+                                               items=len(batch) * records_per_page))
+        results.append(timer.result())
+
+        merger = app.StreamingPdfMerger(os.path.join(stage_dir, "merged.pdf"))
+        with StageTimer("merge", len(sample) * records_per_page) as timer:
+            for pdf_file in pdf_files:
+                timer.measure(merger.append, pdf_file, items=records_per_page)
+            merger.close()
+        results.append(timer.result())
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    del contexts, sample
+
+    # 6. Trọn job trên file mẫu cùng kích thước
+    sample_file = excel_file
+    if rows > args.sample:
+        sample_file = os.path.join(work_dir, f"{format_name}-{args.sample}.xlsx")
+        make_excel(sample_file, args.sample)
+    config[spec["excel"]] = sample_file
+    with StageTimer("end_to_end", min(rows, args.sample)) as timer:
+        timer.measure(runner.run_format, format_name, config, items=min(rows, args.sample))
+    runner.shutdown_render_executor()
+    results.append(timer.result())
+    return results
+
+def print_table(results):
+    headers = ["stage", "rows", "seconds", "rows_per_second", "p50_ms", "p95_ms", "p99_ms", "peak_rss_mb"]
+    widths = [max(len(h), *(len(str(r[h])) for r in results)) for h in headers]
+    print("  ".join(h.ljust(w) for h, w in zip(headers, widths)))
+    for result in results:
+        print("  ".join(str(result[h]).ljust(w) for h, w in zip(headers, widths)))
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="Đo tốc độ các giai đoạn AUTO-PRICE với dữ liệu giả lập")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000],
+                        help="Số dòng Excel cần thử (mặc định: 1000 10000; thêm 100000 cho sheet lớn)")
+    parser.add_argument("--format", choices=["A4", "A5"], default="A4")
+    parser.add_argument("--sample", type=int, default=500,
+                        help="Số dòng dùng cho render/chuyển đổi/gộp và chạy trọn job (mặc định: 500)")
+    parser.add_argument("--engine", choices=["word", "overlay", "native"], default="word",
+                        help="render_engine cho bước chạy trọn job")
+    parser.add_argument("--workers", type=int, default=1, help="render_workers cho bước chạy trọn job")
+    parser.add_argument("--batch-size", type=int, default=10, help="Số file mỗi lần gọi công cụ chuyển đổi")
+    parser.add_argument("--real-converter", action="store_true",
+                        help="Dùng công cụ chuyển đổi thật (PDFConverter) thay vì công cụ giả")
+    parser.add_argument("--work-dir", help="Thư mục chứa dữ liệu giả (mặc định: thư mục tạm, tự xóa)")
+    parser.add_argument("--json", metavar="FILE", help="Ghi kết quả ra file JSON")
+    return parser
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+    app = load_app()
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="autoprice_bench_")
+    os.makedirs(work_dir, exist_ok=True)
+    converter = None
+    try:
+        if args.real_converter:
+            converter = app.PDFConverter(app.ConfigManager(os.path.join(work_dir, "config.json")).config)
+            print(f"Công cụ chuyển đổi: {converter.current_tool}", file=sys.stderr)
+        else:
+            converter = FakeConverter()
+        results = []
+        for rows in args.rows:
+            print(f"Đang đo {args.format} với {rows} dòng...", file=sys.stderr)
+            results.extend(bench_size(app, args.format, rows, work_dir, args, converter))
+        print_table(results)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump({"format": args.format, "converter": converter.current_tool,
+                           "python": sys.version.split()[0], "results": results}, f, indent=2)
+    finally:
+        if converter is not None:
+            converter.close()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())